@@ -0,0 +1,136 @@
+############################################################################
+#    Copyright (C) 2008 by Michael Goerz                                   #
+#    http://www.physik.fu-berlin.de/~goerz                                 #
+#                                                                          #
+#    This program is free software; you can redistribute it and#or modify  #
+#    it under the terms of the GNU General Public License as published by  #
+#    the Free Software Foundation; either version 3 of the License, or     #
+#    (at your option) any later version.                                   #
+#                                                                          #
+#    This program is distributed in the hope that it will be useful,       #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of        #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         #
+#    GNU General Public License for more details.                          #
+#                                                                          #
+#    You should have received a copy of the GNU General Public License     #
+#    along with this program; if not, write to the                         #
+#    Free Software Foundation, Inc.,                                       #
+#    59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.             #
+############################################################################
+
+""" This module contains the FlagRegistry class, which maps IMAP flags to
+    bit positions, so that the flags of a message can be stored and
+    compared as a single integer bitmask.
+
+    The system flags always have the same bits (SEEN, ANSWERED, FLAGGED,
+    DELETED, DRAFT, RECENT). Keywords like $Forwarded get the next free bit
+    when they are registered. All messages and mailboxes share the registry
+    REGISTRY, so bitmasks from different mailboxes can be compared directly.
+    ImapMailbox registers the PERMANENTFLAGS of a mailbox when it is
+    selected.
+
+        >>> mask = REGISTRY.mask(['\\Seen', '$Junk'])
+        >>> bool(mask & SEEN) and not (mask & DELETED)
+        True
+"""
+
+import threading
+
+SYSTEM_FLAGS = ('\\Seen', '\\Answered', '\\Flagged', '\\Deleted', '\\Draft',
+                '\\Recent')
+
+SEEN = 1 << 0
+ANSWERED = 1 << 1
+FLAGGED = 1 << 2
+DELETED = 1 << 3
+DRAFT = 1 << 4
+RECENT = 1 << 5
+
+
+class FlagRegistry(object):
+    """ A bidirectional mapping between flag names and bit positions.
+        Flag names are case-insensitive; the spelling of the first
+        registration is kept. Flags may be registered from several threads.
+    """
+    def __init__(self, keywords=()):
+        """ Create a registry containing the system flags and the given
+            keywords
+        """
+        self._names = []
+        self._bits = {}
+        self._lock = threading.Lock()
+        for flag in SYSTEM_FLAGS:
+            self.register(flag)
+        for flag in keywords:
+            self.register(flag)
+
+    def register(self, flag):
+        """ Return the bitmask for a single flag, assigning the next free
+            bit to it if it is not known yet
+        """
+        key = flag.upper()
+        try:
+            return self._bits[key]
+        except KeyError:
+            pass
+        self._lock.acquire()
+        try:
+            if key not in self._bits:
+                self._names.append(flag)
+                self._bits[key] = 1 << (len(self._names) - 1)
+            return self._bits[key]
+        finally:
+            self._lock.release()
+
+    def mask(self, flags):
+        """ Return the bitmask for an iterable of flag names, or for a
+            single flag name given as a string. Unknown flags are registered.
+        """
+        if isinstance(flags, str):
+            flags = [flags]
+        bits = self._bits
+        mask = 0
+        for flag in flags:
+            try:
+                mask |= bits[flag.upper()]
+            except KeyError:
+                mask |= self.register(flag)
+        return mask
+
+    def names(self, mask):
+        """ Return the list of flag names for a bitmask, in the order of
+            their bits
+        """
+        names = self._names
+        result = []
+        bit = 0
+        while mask:
+            if mask & 1:
+                result.append(names[bit])
+            mask >>= 1
+            bit += 1
+        return result
+
+    def flagstring(self, mask):
+        """ Return the bitmask as a parenthesized list of flags for use in
+            IMAP commands, e.g. '(\\Seen $Junk)'
+        """
+        return "(%s)" % ' '.join(self.names(mask))
+
+    def keywords(self):
+        """ Return the list of registered flags that are not system flags """
+        return self._names[len(SYSTEM_FLAGS):]
+
+    def __contains__(self, flag):
+        """ Return True if the flag is registered """
+        return flag.upper() in self._bits
+
+    def __len__(self):
+        """ Return the number of registered flags """
+        return len(self._names)
+
+    def __repr__(self):
+        return "<FlagRegistry %s>" % ' '.join(self._names)
+
+
+REGISTRY = FlagRegistry()
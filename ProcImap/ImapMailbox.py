@@ -24,18 +24,29 @@
 """
 
 import imaplib
-from email.generator import Generator
+import os
+import re
+import time
+from email.utils import parsedate_tz, mktime_tz
 from mailbox import Mailbox
 from mailbox import Message
 import sys
 
 if sys.version_info > (3, 0):
-    from io import StringIO
+    from io import BytesIO
+    from email.generator import BytesGenerator
 else:
-    from cStringIO import StringIO
+    from cStringIO import StringIO as BytesIO
+    from email.generator import Generator as BytesGenerator
 
-from ProcImap.ImapServer import ImapServer
-from ProcImap.ImapMessage import ImapMessage
+from ProcImap.ImapServer import ImapServer, STANDARD_IMAPLIB
+from ProcImap.ImapMessage import ImapMessage, LazyImapMessage
+from ProcImap.UIDSet import UIDSet
+from ProcImap.ImapParser import parse_fetch, parse_thread, fetch_item
+from ProcImap.ImapParser import ParseError
+from ProcImap.ImapStructures import Envelope, BodyStructure
+from ProcImap.ImapMetadata import MetadataTable
+from ProcImap.ImapFlags import REGISTRY
 
 
 FIX_BUGGY_IMAP_FROMLINE = False # I used this for the standard IMAP server
@@ -44,6 +55,18 @@ FIX_BUGGY_IMAP_FROMLINE = False # I used this for the standard IMAP server
                                 # with an escaped(!) envelope-header. Don't
                                 # use that server!
 
+FETCH_BATCH_SIZE = 500 # max number of UIDs in a single FETCH command when
+                       # data for many messages is downloaded at once
+
+TRANSFER_BATCH_SIZE = 100 # number of messages that ImapMailbox.transfer
+                          # downloads with one FETCH command, and after
+                          # which it writes a checkpoint
+
+MESSAGE_ID_PATTERN = re.compile(r'<[^<>\s]+>')
+
+APPENDUID_PATTERN = re.compile(r'\[APPENDUID\s+\d+\s+(?P<uids>[0-9:,]+)\]',
+                               re.IGNORECASE)
+
 
 
 class ImapNotOkError(Exception):
@@ -92,6 +115,9 @@ class ImapMailbox(Mailbox):
         server           ImapServer object (readonly, see below)
         trash            Trash folder
         readonly         True if mailbox is readonly, false otherwise
+        lazy             If True, messages are returned as instances of
+                         LazyImapMessage, which are only parsed when
+                         their content is accessed. Default is False.
         
         The 'trash' attribute may a string, another instance 
         of ImapMailbox, or an instance of mailbox.Mailbox.
@@ -138,11 +164,15 @@ class ImapMailbox(Mailbox):
             raise TypeError("path must be a tuple, consisting of an "\
                             + " instance of ImapServer and a string")
         self._server.select(name, create)
+        self._permanentflags = _register_flags(self._server.permanentflags)
         self._cached_uid = None
         self._cached_mailbox = None
         self._cached_text = None
+        self._metadata_cache = {}
+        self._metadata_uidvalidity = self._server.uidvalidity
         self.trash = None
         self.readonly = readonly
+        self.lazy = False
         server.locked = True
 
     name = property(lambda self: self._server.mailboxname, None, 
@@ -151,6 +181,10 @@ class ImapMailbox(Mailbox):
     server = property(lambda self: self._server, None,
             doc="Instance of the ImapServer that is being used as a backend")
 
+    permanentflags = property(lambda self: self._permanentflags, None,
+            doc="Bitmask of the flags that can be stored permanently in "
+                "the mailbox (see ProcImap.ImapFlags)")
+
     def reconnect(self):
         """ Renew the connection to the mailbox """
         name = self.name
@@ -174,8 +208,11 @@ class ImapMailbox(Mailbox):
             raise TypeError("name must be the name of a mailbox " \
                             + "as a string")
         self._server.select(name, create)
+        self._permanentflags = _register_flags(self._server.permanentflags)
         self._cached_uid = None
         self._cached_text = None
+        self._metadata_cache = {}
+        self._metadata_uidvalidity = self._server.uidvalidity
         self.readonly = readonly
 
     def search(self, criteria='ALL', charset=None ):
@@ -235,7 +272,18 @@ class ImapMailbox(Mailbox):
 
         Example:    search('FLAGGED SINCE 1-Feb-1994 NOT FROM "Smith"')
                     search('TEXT "string not in mailbox"')
+
+        If the server supports ESEARCH (RFC 4731), the UIDs are transferred
+        as a compact sequence set, and the result is an instance of UIDSet
+        instead of a list. UIDSet supports len(), iteration, membership
+        tests and indexing just like the list.
         """
+        if self._server.has_capability('ESEARCH'):
+            result = self._esearch('MIN MAX COUNT ALL', criteria, charset)
+            try:
+                return UIDSet(result.get('ALL', ''))
+            except ValueError:
+                raise ImapNotOkError("received unparsable response.")
         (code, data) = self._server.uid('search', charset, "(%s)" % criteria)
         uidlist = data[0].split()
         if code != 'OK':
@@ -245,6 +293,32 @@ class ImapMailbox(Mailbox):
         except ValueError:
             raise ImapNotOkError("received unparsable response.")
 
+    def count(self, criteria='ALL', charset=None):
+        """ Return the number of messages in the mailbox that match the
+            search criteria (see the search method).
+            If the server supports ESEARCH, only the count is transferred,
+            not the UIDs.
+        """
+        if self._server.has_capability('ESEARCH'):
+            result = self._esearch('COUNT', criteria, charset)
+            try:
+                return int(result.get('COUNT', 0))
+            except ValueError:
+                raise ImapNotOkError("received unparsable response.")
+        return len(self.search(criteria, charset))
+
+    def _esearch(self, returnopts, criteria, charset=None):
+        """ Run an extended search with the given RETURN options and
+            return a dict of the result items, e.g.
+            {'MIN': '1', 'MAX': '9', 'COUNT': '5', 'ALL': '1:3,8:9'}.
+            Raise ImapNotOkError if a non-OK response is received.
+        """
+        (code, data) = self._server.esearch(returnopts, "(%s)" % criteria,
+                                            charset)
+        if code != 'OK':
+            raise ImapNotOkError("%s in search" % code)
+        return _parse_esearch(data)
+
     def get_unseen_uids(self):
         """ Get a list of all the unseen UIDs in the mailbox
             Equivalent to search(None, "UNSEEN UNDELETED")
@@ -258,9 +332,239 @@ class ImapMailbox(Mailbox):
         """
         return(self.search("UNDELETED"))
 
+    def sorted_uids(self, criteria='DATE', search='ALL', charset='UTF-8'):
+        """ Return a list of the UIDs of all messages that match the
+            'search' criteria (see search method), sorted according to the
+            sort criteria defined in RFC 5256: a string of one or more of
+            ARRIVAL, CC, DATE, FROM, SIZE, SUBJECT, TO, each optionally
+            preceded by REVERSE. For example
+
+                sorted_uids('REVERSE DATE')
+                sorted_uids('FROM SUBJECT', 'UNSEEN')
+
+            If the server supports SORT, the sorting is done on the server.
+            Otherwise, the envelopes of the messages are downloaded (once;
+            they are cached for later calls) and the UIDs are sorted on
+            the client side.
+        """
+        if self._server.has_capability('SORT'):
+            (code, data) = self._server.uid('sort', "(%s)" % criteria,
+                                            charset, "(%s)" % search)
+            if code != 'OK':
+                raise ImapNotOkError("%s in sorted_uids" % code)
+            if data[0] is None:
+                return []
+            try:
+                return [int(uid) for uid in data[0].split()]
+            except ValueError:
+                raise ImapNotOkError("received unparsable response.")
+        return _client_sort(criteria, self._metadata(self.search(search)))
+
+    def thread_uids(self, algorithm='REFERENCES', search='ALL',
+                    charset='UTF-8'):
+        """ Return the messages that match the 'search' criteria (see search
+            method) grouped into threads, according to the threading
+            'algorithm' defined in RFC 5256 ('ORDEREDSUBJECT' or
+            'REFERENCES').
+            The result is a list of threads. Each thread is a list of UIDs in
+            which a nested list stands for a branch, e.g. the server
+            response '(2)(3 6 (4 23)(44 7 96))' is returned as
+            [[2], [3, 6, [4, 23], [44, 7, 96]]]
+
+            If the server supports the requested algorithm, the threading is
+            done on the server. Otherwise, the envelopes of the messages are
+            downloaded (once; they are cached for later calls) and the
+            threads are built on the client side.
+        """
+        algorithm = algorithm.upper()
+        if self._server.has_capability('THREAD=%s' % algorithm):
+            (code, data) = self._server.uid('thread', algorithm, charset,
+                                            "(%s)" % search)
+            if code != 'OK':
+                raise ImapNotOkError("%s in thread_uids" % code)
+            try:
+                return parse_thread(data)
+            except ParseError:
+                raise ImapNotOkError("received unparsable response.")
+        metadata = self._metadata(self.search(search))
+        if algorithm == 'ORDEREDSUBJECT':
+            return _client_thread_orderedsubject(metadata)
+        elif algorithm == 'REFERENCES':
+            return _client_thread_references(metadata)
+        raise NotSupportedError("Unknown threading algorithm %s" % algorithm)
+
+    def _metadata(self, uids):
+        """ Return a dict that maps the given UIDs to the parsed FETCH
+            attributes INTERNALDATE, RFC822.SIZE, ENVELOPE and the
+            References header. Only messages that are not in the cache yet
+            are fetched from the server, in batches of FETCH_BATCH_SIZE.
+            UIDs of messages that do not exist are left out. The cache is
+            cleared when the UIDVALIDITY of the mailbox changes, since the
+            UIDs then refer to different messages.
+        """
+        if self._metadata_uidvalidity != self._server.uidvalidity:
+            self._metadata_cache = {}
+            self._metadata_uidvalidity = self._server.uidvalidity
+        missing = [uid for uid in uids if uid not in self._metadata_cache]
+        self._metadata_cache.update(self._fetch(missing,
+                "INTERNALDATE RFC822.SIZE ENVELOPE "
+                "BODY.PEEK[HEADER.FIELDS (REFERENCES)]"))
+        return dict([(uid, self._metadata_cache[uid]) for uid in uids
+                     if uid in self._metadata_cache])
+
+    def _fetch(self, uids, items):
+        """ Fetch the data items (a string like 'FLAGS RFC822.SIZE') for all
+            the given UIDs, in batches of FETCH_BATCH_SIZE, and return a
+            dict that maps each UID to a dict of parsed data items (see
+            ProcImap.ImapParser.parse_fetch). 'uids' may be a single UID,
+            a list of UIDs, a UIDSet or a sequence set string. UIDs of
+            messages that do not exist are left out.
+        """
+        if isinstance(uids, int):
+            uids = [uids]
+        result = {}
+        for uidset in UIDSet(uids).batches(FETCH_BATCH_SIZE):
+            (code, data) = self._server.uid('fetch', uidset.sequence_set(),
+                                            "(UID %s)" % items)
+            if code != 'OK':
+                raise ImapNotOkError("%s in fetch %s: %s" \
+                                                         % (code, items, data))
+            try:
+                result.update(parse_fetch(data))
+            except ParseError:
+                raise ImapNotOkError("received unparsable response.")
+        return result
+
+    def fetch_part(self, uid, section='', offset=None, length=None,
+                   peek=True):
+        """ Return the raw content (as bytes, not decoded) of the MIME part
+            'section' of the message with UID. The section is a part
+            specifier like '1' or '1.2' (see BodyStructure.section), or one
+            of 'HEADER', 'TEXT', '1.MIME' etc.; the default '' stands for
+            the entire message. If 'length' is given, only 'length' octets
+            starting at 'offset' (default 0) are downloaded, e.g.
+                fetch_part(uid, '1', 0, 200)
+            returns a short preview of the first part.
+            Unless 'peek' is False, the \\Seen flag of the message is not
+            changed.
+            Raise KeyError if there is no message with that UID.
+        """
+        result = self.fetch_parts([uid], section, offset, length, peek)
+        try:
+            return result[int(uid)]
+        except KeyError:
+            raise KeyError("No UID %s in fetch_part" % uid)
+
+    def fetch_parts(self, uids, section='', offset=None, length=None,
+                    peek=True):
+        """ Return a dict that maps the given UIDs (a list or UIDSet) to the
+            raw content of the MIME part 'section' of the message, see
+            fetch_part. The parts are downloaded with one FETCH command per
+            FETCH_BATCH_SIZE messages. UIDs of messages that do not exist
+            are left out; if a message does not have the requested part,
+            its value is an empty string.
+        """
+        item = 'BODY'
+        if peek:
+            item = 'BODY.PEEK'
+        item += "[%s]" % section
+        if length is not None:
+            item += "<%s.%s>" % (offset or 0, length)
+        result = {}
+        for (uid, attributes) in self._fetch(uids, item).items():
+            content = fetch_item(attributes, "BODY[%s]" % section)
+            if content is None:
+                content = b''
+            elif not isinstance(content, bytes):
+                content = content.encode('utf-8')
+            result[uid] = content
+        return result
+
+    def get_message_ids(self, uids=None):
+        """ Return a dict that maps the given UIDs (a list or UIDSet; default
+            is all messages in the mailbox) to the Message-IDs of the
+            messages, e.g. '<1234@example.com>'. The Message-ID header fields
+            are downloaded with one FETCH command per FETCH_BATCH_SIZE
+            messages. Messages without a Message-ID are left out.
+        """
+        if uids is None:
+            uids = self.search('ALL')
+        result = {}
+        for (uid, header) in self.fetch_parts(uids,
+                                     'HEADER.FIELDS (MESSAGE-ID)').items():
+            match = MESSAGE_ID_PATTERN.search(header.decode('ascii',
+                                                            'replace'))
+            if match is not None:
+                result[uid] = match.group(0)
+        return result
+
+    def get_metadata(self, uids=None, table=None):
+        """ Return a MetadataTable (see ProcImap.ImapMetadata) with the
+            flags, internal dates and sizes of the messages with the given
+            UIDs (a list or UIDSet; default is all messages in the mailbox).
+            The data is downloaded with one FETCH command per
+            FETCH_BATCH_SIZE messages. If 'table' is given, the records are
+            added to it instead of to a new table, replacing existing
+            records for the same UIDs.
+        """
+        if uids is None:
+            uids = self.search('ALL')
+        if table is None:
+            table = MetadataTable()
+        attributes = self._fetch(uids, "FLAGS INTERNALDATE RFC822.SIZE")
+        for uid in sorted(attributes.keys()):
+            table.append(uid, attributes[uid].get('FLAGS') or [],
+                         int(_arrival(attributes[uid])),
+                         int(attributes[uid].get('RFC822.SIZE') or 0))
+        return table
+
+    def get_envelope(self, uid):
+        """ Return an instance of ProcImap.ImapStructures.Envelope for the
+            message with UID, which contains the most important header
+            fields (Date, Subject, From, To, ...), as parsed by the server.
+            Raise KeyError if there if there is no message with that UID.
+        """
+        try:
+            return self.get_envelopes([uid])[int(uid)]
+        except KeyError:
+            raise KeyError("No UID %s in get_envelope" % uid)
+
+    def get_envelopes(self, uids):
+        """ Return a dict that maps the given UIDs (a list or UIDSet) to
+            instances of ProcImap.ImapStructures.Envelope. The envelopes are
+            downloaded with one FETCH command per FETCH_BATCH_SIZE messages.
+            UIDs of messages that do not exist are left out.
+        """
+        result = {}
+        for (uid, attributes) in self._fetch(uids, 'ENVELOPE').items():
+            result[uid] = Envelope.from_response(attributes['ENVELOPE'])
+        return result
+
+    def get_bodystructure(self, uid):
+        """ Return an instance of ProcImap.ImapStructures.BodyStructure
+            describing the MIME structure of the message with UID.
+            Raise KeyError if there if there is no message with that UID.
+        """
+        try:
+            return self.get_bodystructures([uid])[int(uid)]
+        except KeyError:
+            raise KeyError("No UID %s in get_bodystructure" % uid)
+
+    def get_bodystructures(self, uids):
+        """ Return a dict that maps the given UIDs (a list or UIDSet) to
+            instances of ProcImap.ImapStructures.BodyStructure. UIDs of
+            messages that do not exist are left out.
+        """
+        result = {}
+        for (uid, attributes) in self._fetch(uids, 'BODYSTRUCTURE').items():
+            result[uid] = BodyStructure.from_response(
+                                                 attributes['BODYSTRUCTURE'])
+        return result
+
     def _cache_message(self, uid):
         """ Download the RFC822 text of the message with UID and put
-            in in the cache. Return the RFC822 text of the message. If the
+            in in the cache. Return the RFC822 text of the message as bytes,
+            exactly as it was received. If the
             message is already in the cache, it is returned directly.
             Raise KeyError if there if there is no message with that UID.
         """
@@ -298,16 +602,16 @@ class ImapMailbox(Mailbox):
                             continue
                         if attempts > 10:
                             break
-                        chunksize = chunksize / (attempts + 1)
+                        chunksize = chunksize // (attempts + 1)
                     try:
                         chunks.append(data[0][1])
                     except TypeError:
                         raise KeyError("No message %s in _cache_message" % uid)
                     octets_read += chunksize
-                rfc822string = ''.join(chunks)
+                rfc822string = b''.join(chunks)
             if FIX_BUGGY_IMAP_FROMLINE:
-                if rfc822string.startswith(">From "):
-                    rfc822string = rfc822string[rfc822string.find("\n")+1:]
+                if rfc822string.startswith(b">From "):
+                    rfc822string = rfc822string[rfc822string.find(b"\n")+1:]
             self._cached_uid = uid
             self._cached_mailbox = self.name
             self._cached_text = rfc822string
@@ -315,17 +619,33 @@ class ImapMailbox(Mailbox):
 
     def get_message(self, uid):
         """ Return an ImapMessage object created from the message with UID.
+            If the 'lazy' attribute is set, the message is a LazyImapMessage.
             Raise KeyError if there if there is no message with that UID.
         """
         rfc822string = self._cache_message(uid)
-        result = ImapMessage(rfc822string)
-        result.set_imapflags(self.get_imapflags(uid))
-        result.internaldate = self.get_internaldate(uid)
-        result.size = self.get_size(uid)
+        if self.lazy:
+            result = LazyImapMessage(rfc822string)
+        else:
+            result = ImapMessage(rfc822string)
+        self._set_message_attributes(uid, result)
         if self._factory is ImapMessage:
             return result
         return self._factory(result)
 
+    def _set_message_attributes(self, uid, message):
+        """ Set the flags, internaldate and size of the ImapMessage from the
+            server, with a single FETCH.
+            Raise KeyError if there if there is no message with that UID.
+        """
+        try:
+            attributes = self._fetch(uid, "FLAGS INTERNALDATE RFC822.SIZE")
+            attributes = attributes[int(uid)]
+        except KeyError:
+            raise KeyError("No UID %s" % uid)
+        message.set_imapflags(attributes.get('FLAGS') or [])
+        message.internaldate = _internaldate(attributes)
+        message.size = int(attributes.get('RFC822.SIZE') or 0)
+
     def __getitem__(self, uid):
         """ Return an ImapMessage object created from the message with UID.
             Raise KeyError if there if there is no message with that UID.
@@ -341,23 +661,39 @@ class ImapMailbox(Mailbox):
         except KeyError:
             return default
 
+    def get_bytes(self, uid):
+        """ Return the RFC822 representation of the message corresponding
+            to key as bytes, exactly as received from the server, or raise
+            a KeyError exception if no such message exists.
+        """
+        return self._cache_message(uid)
+
     def get_string(self, uid):
         """ Return a RFC822 string representation of the message
             corresponding to key, or raise a KeyError exception if no
-            such message exists.
+            such message exists. Non-ASCII bytes are kept as surrogate
+            escapes, so that the original can be restored with
+            encode('utf-8', 'surrogateescape'); use get_bytes instead if
+            possible.
         """
-        return self._cache_message(uid)
+        rfc822string = self._cache_message(uid)
+        if isinstance(rfc822string, bytes) and \
+        not isinstance(rfc822string, str):
+            return rfc822string.decode('utf-8', 'surrogateescape')
+        return rfc822string
 
     def get_file(self, uid):
-        """ Return a cStringIO.StringIO of the message corresponding
-            to key, or raise a KeyError exception if no such message
-            exists.
+        """ Return a binary file-like object (BytesIO) of the message
+            corresponding to key, or raise a KeyError exception if no such
+            message exists.
         """
-        return StringIO(self._cache_message(uid))
+        return BytesIO(self._cache_message(uid))
 
     def has_key(self, uid):
         """ Return True if key corresponds to a message, False otherwise.
         """
+        if self._server.has_capability('ESEARCH'):
+            return (self.count("UID %s" % uid) > 0)
         return (uid in self.search('ALL'))
 
     def __contains__(self, uid):
@@ -367,7 +703,7 @@ class ImapMailbox(Mailbox):
 
     def __len__(self):
         """ Return a count of messages in the mailbox. """
-        return len(self.search('ALL'))
+        return self.count('ALL')
 
     def clear(self):
         """ Delete all messages from the mailbox and expunge"""
@@ -456,9 +792,7 @@ class ImapMailbox(Mailbox):
         except TypeError:
             raise KeyError("No UID %s in get_header" % uid)
         result = ImapMessage(rfc822string)
-        result.set_imapflags(self.get_imapflags(uid))
-        result.internaldate = self.get_internaldate(uid)
-        result.size = self.get_size(uid)
+        self._set_message_attributes(uid, result)
         if self._factory is ImapMessage:
             return result
         return self._factory(result)
@@ -485,34 +819,36 @@ class ImapMailbox(Mailbox):
      
     def get_size(self, uid):
         """ Get the number of bytes contained in the message with UID """
+        attributes = self._fetch(uid, "RFC822.SIZE")
+        if int(uid) not in attributes:
+            raise NoSuchUIDError("No message %s in get_size" % uid)
         try:
-            (code, data) = self._server.uid('fetch', uid, '(RFC822.SIZE)')
-            sizeresult = data[0]
-            if code != 'OK':
-                raise ImapNotOkError("%s in get_imapflags(%s)" % (code, uid))
-            if sizeresult is None:
-                raise NoSuchUIDError("No message %s in get_size" % uid)
-            startindex = sizeresult.find('SIZE') + 5
-            stopindex = sizeresult.find(' ', startindex)
-            return int(sizeresult[startindex:stopindex])
-        except (TypeError, ValueError):
-            raise ValueError("Unexpected results while fetching flags " \
+            return int(attributes[int(uid)]['RFC822.SIZE'])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError("Unexpected results while fetching size " \
                               + "from server for message %s" % uid)
 
     def get_imapflags(self, uid):
         """ Return a list of imap flags for the message with UID
             Raise exception if there if there is no message with that UID.
         """
+        attributes = self._fetch(uid, "FLAGS")
         try:
-            (code, data) = self._server.uid('fetch', uid, '(FLAGS)')
-            flagresult = data[0]
-            if code != 'OK':
-                raise ImapNotOkError("%s in get_imapflags(%s)" % (code, uid))
-            return list(imaplib.ParseFlags(flagresult))
-        except (TypeError, ValueError):
+            return list(attributes[int(uid)]['FLAGS'])
+        except (KeyError, TypeError):
             raise ValueError("Unexpected results while fetching flags " \
-                         + "from server for message %s; response was (%s, %s)" \
-                                                             % (uid, code, data))
+                         + "from server for message %s; response was %s" \
+                                                          % (uid, attributes))
+
+    def get_flagmask(self, uid):
+        """ Return the imap flags of the message with UID as a bitmask
+            (see ProcImap.ImapFlags)
+            Raise KeyError if there if there is no message with that UID.
+        """
+        try:
+            return REGISTRY.mask(self._fetch(uid, "FLAGS")[int(uid)]['FLAGS'])
+        except KeyError:
+            raise KeyError("No UID %s in get_flagmask" % uid)
 
     def get_internaldate(self, uid):
         """ Return a time tuple representing the internal date for the
@@ -548,6 +884,66 @@ class ImapMailbox(Mailbox):
         """
         return (not (self == other))
 
+    def transfer(self, uids, target, batch_size=TRANSFER_BATCH_SIZE,
+                 checkpoint=None):
+        """ Copy the messages with the given UIDs (a list or UIDSet) to the
+            ImapMailbox 'target', which is usually on a different server.
+            The messages are downloaded with one FETCH command per
+            'batch_size' messages, and uploaded with MULTIAPPEND or
+            pipelined APPEND commands (see add_many). They are transferred
+            as raw bytes, without being parsed. The flags (except \\Recent)
+            and the internal dates are preserved. If the target is on the
+            same server, the messages are copied on the server instead.
+            Neither mailbox is expunged.
+
+            If 'checkpoint' is the name of a file, the UIDs of all messages
+            that have been transferred are written to that file after each
+            batch. If transfer is called again with the same checkpoint
+            file, these messages are skipped, so that an interrupted
+            transfer can be resumed. The checkpoint file is ignored if the
+            UIDVALIDITY of the mailbox has changed in the meantime.
+
+            Return a list of (uid, target_uid, error) tuples for all
+            messages that were transferred in this call. target_uid and
+            error are as described for add_many; if the messages were
+            copied on the server, target_uid is None.
+        """
+        if target.readonly:
+            raise ReadOnlyError("Tried to transfer to a read-only mailbox")
+        uidvalidity = self._server.uidvalidity
+        done = _read_checkpoint(checkpoint, uidvalidity)
+        pending = UIDSet([uid for uid in UIDSet(uids) if uid not in done])
+        result = []
+        for batch in pending.batches(batch_size):
+            if target.server == self._server:
+                (code, data) = self._server.uid('copy', batch.sequence_set(),
+                                                target.name)
+                if code != 'OK':
+                    raise ImapNotOkError("%s in transfer: %s" % (code, data))
+                result.extend([(uid, None, None) for uid in batch])
+                done = done.union(batch)
+            else:
+                attributes = self._fetch(batch, "FLAGS INTERNALDATE BODY.PEEK[]")
+                batch_uids = sorted(attributes.keys())
+                messages = []
+                for uid in batch_uids:
+                    raw = fetch_item(attributes[uid], 'BODY[]') or b''
+                    if not isinstance(raw, bytes):
+                        raw = raw.encode('utf-8')
+                    messages.append(LazyImapMessage(raw,
+                                            attributes[uid].get('FLAGS') or [],
+                                            _internaldate(attributes[uid])))
+                transferred = []
+                for (uid, (target_uid, error)) in zip(batch_uids,
+                                                target.add_many(messages)):
+                    result.append((uid, target_uid, error))
+                    if error is None:
+                        transferred.append(uid)
+                done = done.union(transferred)
+            if checkpoint is not None:
+                _write_checkpoint(checkpoint, uidvalidity, done)
+        return result
+
     def copy(self, uid, targetmailbox, exact=False):
         """ Copy the message with UID to the targetmailbox and try to return
             the key that was assigned to the copied message in the
@@ -560,8 +956,12 @@ class ImapMailbox(Mailbox):
             downloaded) if the targetmailbox is on the same server.
             Do nothing and return None if there if there is no message with
             that UID.
+            If targetmailbox is an ImapMailbox on a different server, the
+            message is copied with the transfer method, and the return value
+            is the new UID if the server reports it (UIDPLUS).
             Unless 'exact' is set to True, the return value will be None if
-            the targetmailbox is an ImapMailbox. This is because finding out
+            the targetmailbox is an ImapMailbox on the same server. This is
+            because finding out
             the new UID of the copied message on an IMAP server is non-trivial.
             Giving 'exact' as True means that additional work will be done to
             find the accurate result. This operation can be relatively
@@ -573,16 +973,17 @@ class ImapMailbox(Mailbox):
         if isinstance(targetmailbox, ImapMailbox):
             if targetmailbox.server == self._server:
                 targetmailbox = targetmailbox.name # set as string
-        if isinstance(targetmailbox, Mailbox):
+        if isinstance(targetmailbox, ImapMailbox):
+            if self != targetmailbox:
+                transferred = self.transfer([uid], targetmailbox)
+                if transferred:
+                    (uid, result, error) = transferred[0]
+                    if error is not None:
+                        raise error
+        elif isinstance(targetmailbox, Mailbox):
             if self != targetmailbox:
                 targetmailbox.lock()
                 result = targetmailbox.add(self[uid])
-                if isinstance(targetmailbox, ImapMailbox):
-                    result = None
-                    targetmailbox.flush()
-                    if exact:
-                        pass
-                        # TODO: get more exact result
                 targetmailbox.unlock()
         elif isinstance(targetmailbox, str):
             if targetmailbox != self.name:
@@ -730,29 +1131,95 @@ class ImapMailbox(Mailbox):
             Message can be an instance of email.Message.Message
             (including instaces of mailbox.Message and its subclasses );
             or an open file handle or a string containing an RFC822 message.
-            Return the highest UID in the mailbox, which should be, but
-            is not guaranteed to be, the UID of the message that was added.
+            Messages that were downloaded from a mailbox and not modified
+            since, as well as messages given as bytes, are uploaded exactly
+            as they are, without being serialized again.
+            Return the UID of the message that was added, as reported by
+            the server (UIDPLUS, RFC 4315). If the server does not report
+            the UID, return the highest UID in the mailbox, which should be,
+            but is not guaranteed to be, the UID of the message that was
+            added.
             Raise ImapNotOkError if a non-OK response is received from
             the server
         """
         if self.readonly:
             raise ReadOnlyError("Tried to add to a read-only mailbox")
-        message = ImapMessage(message)
-        flags = message.flagstring()
-        date_time = message.internaldatestring()
-        memoryfile = StringIO()
-        generator = Generator(memoryfile, mangle_from_=False)
-        generator.flatten(message)
-        message_str = memoryfile.getvalue()
+        (flags, date_time, message_str) = self._append_args(message)
         (code, data) = self._server.append(self.name, flags, \
                                       date_time, message_str)
         if code != 'OK':
             raise ImapNotOkError("%s in add: %s" % (code, data))
+        uids = _appenduids(data)
+        if uids:
+            return uids[0]
         try:
             return self.get_all_uids()[-1]
         except IndexError:
             return 0
 
+    def add_many(self, messages):
+        """ Add all the messages in the iterable 'messages' to the mailbox.
+            Each message can be anything that is accepted by the add method.
+            If the server supports MULTIAPPEND (RFC 3502), all messages are
+            uploaded in one single command, and the server stores either all
+            of them or none. Otherwise (or with imaplib2, which cannot send
+            MULTIAPPEND), the messages are uploaded with pipelined APPEND
+            commands (see ImapServer.append_many).
+
+            Return a list of (uid, error) tuples, one for each message, in
+            order. For messages that were added, error is None and uid is
+            the UID assigned by the server, or None if the server does not
+            report UIDs (UIDPLUS). For messages that could not be added,
+            uid is None and error is an instance of ImapNotOkError.
+        """
+        if self.readonly:
+            raise ReadOnlyError("Tried to add to a read-only mailbox")
+        prepared = [self._append_args(message) for message in messages]
+        if len(prepared) == 0:
+            return []
+        if STANDARD_IMAPLIB and self._server.has_capability('MULTIAPPEND'):
+            (code, data) = self._server.multiappend(self.name, prepared)
+            if code != 'OK':
+                error = ImapNotOkError("%s in add_many: %s" % (code, data))
+                return [(None, error) for message in prepared]
+            uids = _appenduids(data)
+            if len(uids) != len(prepared):
+                uids = [None] * len(prepared)
+            return [(uid, None) for uid in uids]
+        result = []
+        for (code, data) in self._server.append_many(self.name, prepared):
+            if code != 'OK':
+                result.append((None, ImapNotOkError("%s in add_many: %s" \
+                                                    % (code, data))))
+                continue
+            uids = _appenduids(data)
+            if uids:
+                result.append((uids[0], None))
+            else:
+                result.append((None, None))
+        return result
+
+    def _append_args(self, message):
+        """ Return a tuple (flags, date_time, message_str) for appending
+            message to the mailbox. If the message is given as bytes, or is
+            an ImapMessage that was not modified since it was created from
+            bytes (see ImapMessage.get_original), the bytes are used as
+            they are, without parsing and serializing the message.
+        """
+        if isinstance(message, bytes):
+            message = LazyImapMessage(message)
+        elif not isinstance(message, ImapMessage):
+            message = ImapMessage(message)
+        flags = message.flagstring()
+        date_time = message.internaldatestring()
+        original = message.get_original()
+        if original is not None:
+            return (flags, date_time, original)
+        memoryfile = BytesIO()
+        generator = BytesGenerator(memoryfile, mangle_from_=False)
+        generator.flatten(message)
+        return (flags, date_time, memoryfile.getvalue())
+
 
     def add_imapflag(self, uid, *flags):
         """ Add imap flag to message with UID.
@@ -784,11 +1251,13 @@ class ImapMailbox(Mailbox):
         """ Set imap flags for message with UID
             flags must be an iterable of flags, or a string.
             If flags is a string, it is taken as the single flag
-            to be set.
+            to be set. flags may also be a bitmask (see ProcImap.ImapFlags).
         """
         if self.readonly:
             raise ReadOnlyError(
                       "Tried to set imap flags for message in read-only mailbox")
+        if isinstance(flags, int):
+            flags = REGISTRY.names(flags)
         if isinstance(flags, str):
             flags = [flags]
         flagstring = "(%s)" % ' '.join(flags)
@@ -811,3 +1280,246 @@ class ImapMailbox(Mailbox):
             raise ReadOnlyError("Tried to expunge read-only mailbox")
         self._server.expunge()
 
+
+def _parse_esearch(data):
+    """ Parse the data of an untagged ESEARCH response, e.g.
+        '(TAG "A285") UID MIN 7 MAX 3800 COUNT 15 ALL 7,9,12:3800'
+        into a dict {'MIN': '7', 'MAX': '3800', 'COUNT': '15',
+        'ALL': '7,9,12:3800'}. Data that is None (no ESEARCH response was
+        received, which means there were no matches) results in an empty
+        dict.
+    """
+    result = {}
+    for response in data:
+        if response is None:
+            continue
+        if isinstance(response, bytes):
+            response = response.decode('ascii')
+        response = response.strip()
+        if response.startswith('('):
+            response = response[response.find(')')+1:]
+        tokens = response.split()
+        if tokens and tokens[0].upper() == 'UID':
+            tokens = tokens[1:]
+        for (name, value) in zip(tokens[::2], tokens[1::2]):
+            result[name.upper()] = value
+    return result
+
+def _appenduids(data):
+    """ Extract the list of UIDs from the APPENDUID response code (RFC 4315)
+        in the data of a tagged APPEND response, e.g.
+        '[APPENDUID 38505 3955:3957] APPEND completed'.
+        Return an empty list if there is no APPENDUID response code.
+    """
+    for response in data:
+        if isinstance(response, bytes):
+            response = response.decode('ascii', 'replace')
+        if not isinstance(response, str):
+            continue
+        match = APPENDUID_PATTERN.search(response)
+        if match:
+            return list(UIDSet(match.group('uids')))
+    return []
+
+def _read_checkpoint(filename, uidvalidity):
+    """ Return the UIDSet stored in the checkpoint file of
+        ImapMailbox.transfer, or an empty UIDSet if the file does not exist
+        or was written for a different UIDVALIDITY
+    """
+    if filename is None or not os.path.exists(filename):
+        return UIDSet()
+    checkpointfile = open(filename)
+    try:
+        lines = checkpointfile.read().split()
+    finally:
+        checkpointfile.close()
+    if len(lines) < 1 or lines[0] != "%s" % uidvalidity:
+        return UIDSet()
+    if len(lines) < 2:
+        return UIDSet()
+    return UIDSet(lines[1])
+
+def _write_checkpoint(filename, uidvalidity, uids):
+    """ Write the UIDVALIDITY and the UIDSet of transferred messages to the
+        checkpoint file, replacing it atomically
+    """
+    tempname = filename + ".tmp"
+    checkpointfile = open(tempname, "w")
+    try:
+        checkpointfile.write("%s\n%s\n" % (uidvalidity, uids.sequence_set()))
+    finally:
+        checkpointfile.close()
+    getattr(os, 'replace', os.rename)(tempname, filename)
+
+
+# Client side implementation of SORT and THREAD (RFC 5256), used if the
+# server does not support these extensions. All functions work on the dict
+# returned by ImapMailbox._metadata
+
+_SUBJECT_LEADER = re.compile(r'^(\s*(re|fwd?)\s*(\[[^\]]*\])?\s*:|\s*\[[^\]]*\])+',
+                             re.IGNORECASE)
+_SUBJECT_TRAILER = re.compile(r'(\s*\(fwd\))+\s*$', re.IGNORECASE)
+
+def _base_subject(subject):
+    """ Return the base subject (RFC 5256, simplified): lower case, with
+        'Re:', 'Fwd:' and '[list]' prefixes and '(fwd)' trailers removed
+    """
+    if subject is None:
+        return ''
+    if isinstance(subject, bytes):
+        subject = subject.decode('utf-8', 'replace')
+    subject = ' '.join(subject.split())
+    while True:
+        stripped = _SUBJECT_TRAILER.sub('', _SUBJECT_LEADER.sub('', subject))
+        stripped = stripped.strip()
+        if stripped == subject:
+            return subject.lower()
+        subject = stripped
+
+def _register_flags(flags):
+    """ Register the flags (PERMANENTFLAGS) in the flag registry and return
+        their bitmask. The special flag \\* is skipped.
+    """
+    return REGISTRY.mask([flag for flag in flags if flag != '\\*'])
+
+def _internaldate(attributes):
+    """ Return the INTERNALDATE in the parsed FETCH attributes of a message
+        as a time tuple, or None
+    """
+    try:
+        return imaplib.Internaldate2tuple(
+              ('INTERNALDATE "%s"' % attributes['INTERNALDATE']).encode())
+    except (KeyError, TypeError, ValueError, OverflowError):
+        return None
+
+def _arrival(attributes):
+    """ Return the internal date of a message as seconds since the epoch """
+    try:
+        return time.mktime(_internaldate(attributes))
+    except (TypeError, ValueError, OverflowError):
+        return 0
+
+def _sent_date(attributes):
+    """ Return the sent date (Date header) of a message as seconds since the
+        epoch, falling back to the internal date
+    """
+    try:
+        date = parsedate_tz(attributes['ENVELOPE'][0])
+        if date is not None:
+            return mktime_tz(date)
+    except (KeyError, IndexError, TypeError, ValueError, OverflowError):
+        pass
+    return _arrival(attributes)
+
+def _first_mailbox(attributes, index):
+    """ Return the lower case local part of the first address in the
+        envelope field with the given index (2: From, 5: To, 6: Cc)
+    """
+    try:
+        return (attributes['ENVELOPE'][index][0][2] or '').lower()
+    except (KeyError, IndexError, TypeError):
+        return ''
+
+_SORT_KEYS = {
+    'ARRIVAL' : _arrival,
+    'CC'      : lambda attributes: _first_mailbox(attributes, 6),
+    'DATE'    : _sent_date,
+    'FROM'    : lambda attributes: _first_mailbox(attributes, 2),
+    'SIZE'    : lambda attributes: int(attributes.get('RFC822.SIZE', 0)),
+    'SUBJECT' : lambda attributes: _base_subject(
+                                   (attributes.get('ENVELOPE') or [None]*2)[1]),
+    'TO'      : lambda attributes: _first_mailbox(attributes, 5),
+}
+
+def _client_sort(criteria, metadata):
+    """ Sort the UIDs in metadata according to the RFC 5256 sort criteria.
+        Ties are broken by UID.
+    """
+    keys = []
+    reverse = False
+    for criterion in criteria.upper().split():
+        if criterion == 'REVERSE':
+            reverse = True
+            continue
+        if criterion not in _SORT_KEYS:
+            raise NotSupportedError("Unknown sort criterion %s" % criterion)
+        keys.append((_SORT_KEYS[criterion], reverse))
+        reverse = False
+    result = sorted(metadata.keys())
+    # Python's sort is stable, so sorting by the last key first gives the
+    # right order
+    for (key, reverse) in reversed(keys):
+        result.sort(key=lambda uid: key(metadata[uid]), reverse=reverse)
+    return result
+
+def _thread_list(uid, children):
+    """ Convert the tree below uid into the nested list representation of a
+        thread. children maps UIDs to the sorted list of child UIDs
+    """
+    result = [uid]
+    branches = children.get(uid, [])
+    while len(branches) == 1:
+        uid = branches[0]
+        result.append(uid)
+        branches = children.get(uid, [])
+    for branch in branches:
+        result.append(_thread_list(branch, children))
+    return result
+
+def _client_thread_orderedsubject(metadata):
+    """ Thread the messages by base subject (ORDEREDSUBJECT) """
+    by_date = lambda uid: (_sent_date(metadata[uid]), uid)
+    threads = {}
+    for uid in metadata:
+        subject = _base_subject((metadata[uid].get('ENVELOPE') or [None]*2)[1])
+        threads.setdefault(subject, []).append(uid)
+    result = []
+    for uids in threads.values():
+        uids.sort(key=by_date)
+        result.append(_thread_list(uids[0], {uids[0]: uids[1:]}))
+    result.sort(key=lambda thread: by_date(thread[0]))
+    return result
+
+def _client_thread_references(metadata):
+    """ Thread the messages by their Message-ID, In-Reply-To and References
+        headers (REFERENCES). This is a simplified version of the algorithm
+        in RFC 5256: a message becomes the child of the closest referenced
+        message that is part of the result; messages whose references are
+        all missing start a new thread.
+    """
+    by_date = lambda uid: (_sent_date(metadata[uid]), uid)
+    uid_for_id = {}
+    for uid in sorted(metadata):
+        envelope = metadata[uid].get('ENVELOPE') or [None]*10
+        if envelope[9] and envelope[9] not in uid_for_id:
+            uid_for_id[envelope[9]] = uid
+    parent = {}
+    for uid in metadata:
+        envelope = metadata[uid].get('ENVELOPE') or [None]*10
+        references = fetch_item(metadata[uid], 'BODY[HEADER.FIELDS') or b''
+        if isinstance(references, bytes):
+            references = references.decode('utf-8', 'replace')
+        ids = MESSAGE_ID_PATTERN.findall(references)
+        if not ids and envelope[8]:
+            ids = MESSAGE_ID_PATTERN.findall(envelope[8])
+        for message_id in reversed(ids):
+            candidate = uid_for_id.get(message_id)
+            if candidate is None or candidate == uid:
+                continue
+            ancestor = candidate # make sure we do not create a loop
+            while ancestor is not None and ancestor != uid:
+                ancestor = parent.get(ancestor)
+            if ancestor is None:
+                parent[uid] = candidate
+                break
+    children = {}
+    roots = []
+    for uid in metadata:
+        if uid in parent:
+            children.setdefault(parent[uid], []).append(uid)
+        else:
+            roots.append(uid)
+    for uids in children.values():
+        uids.sort(key=by_date)
+    roots.sort(key=by_date)
+    return [_thread_list(root, children) for root in roots]
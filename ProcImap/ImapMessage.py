@@ -24,9 +24,15 @@
     implemented.
 """
 
+import email.parser
 import imaplib
 import mailbox
+import re
+import sys
 import time
+from email.utils import parsedate_tz, mktime_tz
+
+from ProcImap.ImapFlags import REGISTRY, DELETED, RECENT
 
 INTTIME_FROM_MESSAGE = True # Some mailboxes do not support the notion of an
     # internal time (e.g. mbox). If you convert a message coming from one of 
@@ -38,6 +44,14 @@ INTTIME_FROM_MESSAGE = True # Some mailboxes do not support the notion of an
     # upload time. Note that his flag has no effect if the message that is
     # being converted comes from a mailbox format that supports internal times
 
+# attributes of email.message.Message that are set by parsing the header
+# resp. the body of a message. LazyImapMessage fills them on first access.
+_HEADER_ATTRIBUTES = ('policy', '_headers', '_unixfrom', '_default_type')
+_BODY_ATTRIBUTES = ('_payload', '_charset', 'preamble', 'epilogue', 'defects')
+
+_HEADER_END_PATTERN = re.compile(r'\r?\n\r?\n')
+_HEADER_END_PATTERN_BYTES = re.compile(br'\r?\n\r?\n')
+
 class ImapMessage(mailbox.Message):
     """ Message with IMAP-specific properties. This class holds information 
         about an IMAP email message that.
@@ -50,6 +64,14 @@ class ImapMessage(mailbox.Message):
         internaldate    the date and time when the IMAP server received
                         the message (time tuple)
         size            number of bytes of the message, 0 if unknown
+
+        If the message is created from bytes (e.g. as downloaded from the
+        server), the original bytes are kept as long as the message is not
+        modified, see get_original(). ImapMailbox.add then uploads them
+        directly instead of serializing the message again. Only
+        modifications through the methods of the message itself are
+        noticed: if you change a subpart of a multipart message in place,
+        call set_modified().
     """
     def __init__(self, message=None):
         """ If message is omitted, create new instance in a default, empty 
@@ -62,10 +84,12 @@ class ImapMessage(mailbox.Message):
             mailbox.mboxMessage or mailbox.MMDFMessage instance, the 
             Status: and X-Status: headers are omitted.
         """
-        self._imapflags = []
+        self._flagmask = 0
         self.internaldate = time.localtime()
         self.size = 0
         mailbox.Message.__init__(self, message)
+        if isinstance(message, bytes):
+            self._original = message
         self._get_explanation_from(message)
         if isinstance(message, (mailbox.mboxMessage, mailbox.MMDFMessage)):
             del self['status']
@@ -73,61 +97,37 @@ class ImapMessage(mailbox.Message):
 
     def _get_explanation_from(self, message):
         """Copy specific state from message to self insofar as possible."""
-        if isinstance(message, mailbox.Message):
+        if isinstance(message, mailbox.Message) \
+        and not isinstance(message, ImapMessage):
+            self.__dict__.pop('_original', None)
+            self._flagmask = flagmask_from_message(message) & ~RECENT
             if isinstance(message, mailbox.MaildirMessage):
-                self._imapflags = imapflags_from_maildir_message(message)
                 self.internaldate = time.localtime(message.get_date())
-            elif isinstance(message, mailbox.mboxMessage):
-                self._imapflags = imapflags_from_mbox_message(message)
-                if INTTIME_FROM_MESSAGE:
-                    try:
-                        date = message['Date']
-                        internaldate = seconds_from_date(date) # FIXME: what's this?
-                        if internaldate is not None:
-                            self.internaldate = internaldate
-                    except KeyError:
-                        pass
-            elif isinstance(message, mailbox.MHMessage):
-                self._imapflags = imapflags_from_mh_message(message)
-                if INTTIME_FROM_MESSAGE:
-                    try:
-                        self.internaldate_from_string(message['Date'])
-                    except KeyError:
-                        pass
-            elif isinstance(message, mailbox.BabylMessage):
-                self._imapflags = imapflags_from_babyl_message(message)
-                if INTTIME_FROM_MESSAGE:
-                    try:
-                        self.internaldate_from_string(message['Date'])
-                    except KeyError:
-                        pass
-            elif isinstance(message, mailbox.MMDFMessage):
-                self._imapflags = imapflags_from_mmdf_message(message)
-                if INTTIME_FROM_MESSAGE:
-                    try:
-                        self.internaldate_from_string(message['Date'])
-                    except KeyError:
-                        pass
+            elif INTTIME_FROM_MESSAGE:
+                internaldate = _internaldate_from_header(message)
+                if internaldate is not None:
+                    self.internaldate = internaldate
 
     def _explain_to(self, message):
         """Copy IMAP-specific state to message insofar as possible."""
         if isinstance(message, ImapMessage):
-            message._imapflags = self._imapflags
+            message._flagmask = self._flagmask
             message.internaldate = self.internaldate
             message.size = self.size
-        elif isinstance(message, mailbox.MaildirMessage):
-            for flag in maildirflags_from_imap_message(self):
-                message.add_flag(flag)
+            return
+        message.__dict__.pop('_original', None)
+        if isinstance(message, mailbox.MaildirMessage):
+            message.add_flag(_MAILDIR_FLAGS.flags(self._flagmask))
             message.set_date(time.mktime(self.internaldate))
         elif isinstance(message, (mailbox.mboxMessage, mailbox.MMDFMessage)):
-            for flag in mboxflags_from_imap_message(self):
-                message.add_flag(flag)
-            message.set_from('MAILER-DAEMON', time.mktime(self.internaldate))
+            message.add_flag(_MBOX_FLAGS.flags(self._flagmask))
+            message.set_from('MAILER-DAEMON',
+                             time.gmtime(time.mktime(self.internaldate)))
         elif isinstance(message, mailbox.MHMessage):
-            for sequence in mhsequences_from_imap_message(self):
+            for sequence in _MH_SEQUENCES.flags(self._flagmask):
                 message.add_sequence(sequence)
         elif isinstance(message, mailbox.BabylMessage):
-            for label in babyllabels_from_imap_message(self):
+            for label in _BABYL_LABELS.flags(self._flagmask):
                 message.add_label(label)
         elif isinstance(message, mailbox.Message):
             pass
@@ -138,7 +138,7 @@ class ImapMessage(mailbox.Message):
 
     def flagstring(self):
         """ Return string for imap flags """
-        return "(%s)" % ' '.join(self._imapflags)
+        return REGISTRY.flagstring(self._flagmask)
     
     
     def flags_from_string(self, flagstring):
@@ -149,43 +149,53 @@ class ImapMessage(mailbox.Message):
     
     def delete(self):
         """ Add the \Deleted flag to the list of imap flags """
-        if not "\\Deleted" in self._imapflags:
-            self._imapflags.append("\\Deleted")
+        self._flagmask |= DELETED
     
     def remove_imapflag(self, *flags):
         """ Remove flags from the list of imap flags. Do nothing if the 
             flag does not exist. Remember that this is a local modification.
         """
-        new_imapflags = []
-        flags = [flag.upper() for flag in flags]
-        for flagname in self._imapflags:
-            if not flagname.upper() in flags:
-                new_imapflags.append(flagname)
-        self._imapflags = new_imapflags
+        self._flagmask &= ~REGISTRY.mask(flags)
 
     def add_imapflag(self, *flags):
         """ Add a flag to the list of imap flags. 
             You cannot add "\RECENT" as a flag.
         """
-        for flag in flags:
-            if (flag.upper() != "\\RECENT"):
-                if flag not in self._imapflags:
-                    self._imapflags.append(flag)
+        self._flagmask |= REGISTRY.mask(flags) & ~RECENT
     
     def set_imapflags(self, flags):
         """ Set imap flags to flags """
-        if isinstance(flags, str):
-            flags = [flags]
-        self._imapflags = []
-        for flag in flags:
-            if (flag.upper() != "\\RECENT"):
-                if flag not in self._imapflags:
-                    self._imapflags.append(flag)
+        self._flagmask = REGISTRY.mask(flags) & ~RECENT
 
     def get_imapflags(self):
         """ Return a list of imap flags """
-        return self._imapflags
+        return REGISTRY.names(self._flagmask)
+
+    def get_flagmask(self):
+        """ Return the imap flags as a bitmask (see ProcImap.ImapFlags) """
+        return self._flagmask
+
+    def set_flagmask(self, mask):
+        """ Set the imap flags from a bitmask (see ProcImap.ImapFlags) """
+        self._flagmask = mask & ~RECENT
+
+    def has_imapflag(self, *flags):
+        """ Return True if all the given flags are set """
+        mask = REGISTRY.mask(flags)
+        return (self._flagmask & mask) == mask
     
+    def get_original(self):
+        """ Return the bytes the message was created from, if the message
+            has not been modified since. Otherwise, return None.
+        """
+        return self.__dict__.get('_original')
+
+    def set_modified(self):
+        """ Mark the message as modified, so that the original bytes are no
+            longer used (see get_original)
+        """
+        self.__dict__.pop('_original', None)
+
     def internaldatestring(self):
         """ Return string for internaldate.
             Return None if internaldate is None.
@@ -196,146 +206,296 @@ class ImapMessage(mailbox.Message):
     
     def internaldate_from_string(self, internaldatestring):
         """ Set the internaldate from a string as it is returned
-            by self.internaldatestring()
+            by self.internaldatestring(), with or without the quotes.
+            Raise ValueError if the string is not a valid date.
+        """
+        internaldate = internaldate_from_string(internaldatestring)
+        if internaldate is None:
+            raise ValueError("Invalid internal date %r" % internaldatestring)
+        self.internaldate = internaldate
+
+
+class LazyImapMessage(ImapMessage):
+    """ ImapMessage that holds on to the raw RFC822 string (or bytes) of the
+        message and postpones parsing it until its content is accessed.
+        Flags, internaldate and size are available without any parsing.
+        The first access to a header parses only the header of the message;
+        the body (including the MIME structure) is only parsed when the
+        payload is accessed, e.g. by get_payload(), walk() or as_string().
+
+        This makes it cheap to go through a large number of messages when
+        only the flags or a few header fields are needed. Apart from that,
+        a LazyImapMessage behaves exactly like an ImapMessage.
+    """
+    def __init__(self, message=None, imapflags=None, internaldate=None,
+                 size=None):
+        """ If message is a string or bytes containing an RFC 2822 message,
+            it is kept unparsed. Anything else is handled as in ImapMessage,
+            i.e. parsed immediately.
+            The imapflags, internaldate and size attributes can be given
+            directly. If size is not given, it is the length of the raw
+            message.
+        """
+        if not isinstance(message, (str, bytes)):
+            ImapMessage.__init__(self, message)
+        else:
+            self._raw = message
+            if isinstance(message, bytes):
+                self._original = message
+            self._flagmask = 0
+            self.internaldate = time.localtime()
+            self.size = len(message)
+        if imapflags is not None:
+            self.set_imapflags(imapflags)
+        if internaldate is not None:
+            self.internaldate = internaldate
+        if size is not None:
+            self.size = size
+
+    def __getattr__(self, name):
+        """ Parse the header or the body of the raw message when one of the
+            attributes of email.message.Message is accessed for the first
+            time.
         """
-        self.internaldate = imaplib.Internaldate2tuple(internaldatestring)
+        if '_raw' in self.__dict__:
+            if name in _HEADER_ATTRIBUTES:
+                self._parse_header()
+                return self.__dict__[name]
+            if name in _BODY_ATTRIBUTES:
+                self._parse_body()
+                return self.__dict__[name]
+        raise AttributeError("%r object has no attribute %r"
+                             % (self.__class__.__name__, name))
 
+    def _explain_to(self, message):
+        """ Copy IMAP-specific state to message insofar as possible. If the
+            raw message was copied to a class that cannot parse it lazily,
+            parse it now.
+        """
+        if not isinstance(message, LazyImapMessage):
+            raw = message.__dict__.pop('_raw', None)
+            if raw is not None:
+                _parse_into(message, raw, False,
+                            _HEADER_ATTRIBUTES + _BODY_ATTRIBUTES)
+        ImapMessage._explain_to(self, message)
+
+    def _parse_header(self):
+        """ Parse only the header of the raw message """
+        raw = self.__dict__['_raw']
+        if isinstance(raw, bytes) and not isinstance(raw, str):
+            match = _HEADER_END_PATTERN_BYTES.search(raw)
+        else:
+            match = _HEADER_END_PATTERN.search(raw)
+        if match is not None:
+            raw = raw[:match.end()]
+        _parse_into(self, raw, True, _HEADER_ATTRIBUTES)
+
+    def _parse_body(self):
+        """ Parse the entire raw message """
+        _parse_into(self, self.__dict__['_raw'], False,
+                    _HEADER_ATTRIBUTES + _BODY_ATTRIBUTES)
+        del self.__dict__['_raw']
+
+    def is_parsed(self):
+        """ Return True if the message has been parsed completely """
+        return '_raw' not in self.__dict__
+
+# methods of email.message.Message that change the content of a message
+_MODIFYING_METHODS = ('__setitem__', '__delitem__', 'add_header',
+                      'replace_header', 'set_payload', 'attach', 'set_charset',
+                      'set_param', 'del_param', 'set_type', 'set_boundary',
+                      'set_unixfrom', 'set_default_type', 'set_raw')
+
+def _modifying(method):
+    """ Wrap a method of email.message.Message so that calling it marks an
+        ImapMessage as modified
+    """
+    def wrapper(self, *args, **kwargs):
+        self.__dict__.pop('_original', None)
+        return method(self, *args, **kwargs)
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+for _name in _MODIFYING_METHODS:
+    if hasattr(mailbox.Message, _name): # set_raw is new in Python 3
+        setattr(ImapMessage, _name,
+                _modifying(getattr(mailbox.Message, _name)))
+del _name
+
+def _parse_into(message, text, headersonly, attributes):
+    """ Parse text and set all the given attributes of message that are
+        not yet set from the result. Attributes that have been set or
+        modified already are never overwritten.
+    """
+    if isinstance(text, bytes) and not isinstance(text, str):
+        parsed = email.parser.BytesParser().parsebytes(text, headersonly)
+    else:
+        parsed = email.parser.Parser().parsestr(text, headersonly)
+    for name in attributes:
+        if name not in message.__dict__ and name in parsed.__dict__:
+            message.__dict__[name] = parsed.__dict__[name]
 
 
 # Helper functions for conversion to/from other mailbox.Message instances
 
-def _reverse_mappings(mappings):
-    """ Switch key and value in the mappings dict
-        Make new keys upper case
+class _FlagConversion(object):
+    """ Precomputed conversion between the flags of another mailbox format
+        (maildir letters, mbox letters, MH sequences, Babyl labels) and IMAP
+        flag bitmasks. The table for the direction bitmask -> flags contains
+        an entry for every combination of the flags the format knows about.
     """
-    result = {}
-    for (key, value) in mappings.items():
-        value = value.upper()
-        result[value] = key
-    return result
+    __slots__ = ('_to_mask', '_from_mask', '_bits', '_as_string')
+
+    def __init__(self, mappings, as_string):
+        """ mappings is a sequence of (format flag, IMAP flag) tuples. If
+            as_string is True, the format flags are single letters that
+            are combined into a string, otherwise they are combined into a
+            list.
+        """
+        self._to_mask = {}
+        self._bits = 0
+        for (key, imapflag) in mappings:
+            bit = REGISTRY.register(imapflag)
+            self._to_mask[key] = bit
+            self._bits |= bit
+        self._as_string = as_string
+        self._from_mask = {}
+        keys = sorted(self._to_mask.keys())
+        for combination in range(2 ** len(keys)):
+            mask = 0
+            selected = []
+            for (index, key) in enumerate(keys):
+                if combination & (1 << index):
+                    mask |= self._to_mask[key]
+                    selected.append(key)
+            if as_string:
+                self._from_mask[mask] = ''.join(selected)
+            else:
+                self._from_mask[mask] = tuple(selected)
+
+    def mask(self, flags):
+        """ Return the IMAP bitmask for an iterable of format flags """
+        to_mask = self._to_mask
+        mask = 0
+        for flag in flags:
+            mask |= to_mask.get(flag, 0)
+        return mask
+
+    def flags(self, mask):
+        """ Return the format flags for an IMAP bitmask, as a string or as
+            a list
+        """
+        result = self._from_mask[mask & self._bits]
+        if self._as_string:
+            return result
+        return list(result)
+
+    def imapflags(self, flags):
+        """ Return the list of IMAP flags for an iterable of format flags """
+        return REGISTRY.names(self.mask(flags))
+
+
+_MAILDIR_FLAGS = _FlagConversion((
+    ('D', '\\Draft'),
+    ('F', '\\Flagged'),
+    ('P', '$Forwarded'),
+    ('R', '\\Answered'),
+    ('S', '\\Seen'),
+    ('T', '\\Deleted')), as_string=True)
+
+_MBOX_FLAGS = _FlagConversion((
+    ('F', '\\Flagged'),
+    ('A', '\\Answered'),
+    ('R', '\\Seen'),
+    ('D', '\\Deleted')), as_string=True)
+
+_MH_SEQUENCES = _FlagConversion((
+    ('flagged', '\\Flagged'),
+    ('replied', '\\Answered')), as_string=False)
+
+_BABYL_LABELS = _FlagConversion((
+    ('forwarded', '$Forwarded'),
+    ('answered', '\\Answered'),
+    ('deleted', '\\Deleted')), as_string=False)
+
+def _internaldate_from_header(message):
+    """ Return the time tuple for the Date header of message, or None """
+    date = parsedate_tz(message.get('Date', ''))
+    if date is None:
+        return None
+    try:
+        return time.localtime(mktime_tz(date))
+    except (OverflowError, ValueError):
+        return None
+
+def internaldate_from_string(internaldatestring):
+    """ Return the time tuple for an internal date string like
+        '"17-Jul-1996 02:44:25 -0700"' (the quotes are optional), as
+        returned by ImapMessage.internaldatestring(). Return None if the
+        string is not a valid internal date.
+    """
+    if isinstance(internaldatestring, bytes):
+        internaldatestring = internaldatestring.decode('ascii', 'replace')
+    internaldatestring = internaldatestring.strip().strip('"')
+    response = 'INTERNALDATE "%s"' % internaldatestring
+    if sys.version_info > (3, 0):
+        response = response.encode('ascii', 'replace')
+    return imaplib.Internaldate2tuple(response)
+
+def flagmask_from_message(message):
+    """ Return the IMAP flags bitmask for an instance of mailbox.Message or
+        of one of its subclasses
+    """
+    if isinstance(message, ImapMessage):
+        return message.get_flagmask()
+    if isinstance(message, mailbox.MaildirMessage):
+        return _MAILDIR_FLAGS.mask(message.get_flags())
+    if isinstance(message, (mailbox.mboxMessage, mailbox.MMDFMessage)):
+        return _MBOX_FLAGS.mask(message.get_flags())
+    if isinstance(message, mailbox.MHMessage):
+        return _MH_SEQUENCES.mask(message.get_sequences())
+    if isinstance(message, mailbox.BabylMessage):
+        return _BABYL_LABELS.mask(message.get_labels())
+    return 0
+
+def flagmasks_from_messages(messages):
+    """ Return a list of the IMAP flags bitmasks of all the messages in the
+        iterable (see flagmask_from_message)
+    """
+    return [flagmask_from_message(message) for message in messages]
 
 def imapflags_from_maildir_message(message):
     """ Return a list of IMAP flags from an MaildirMessage"""
-    flagstring = message.get_flags()
-    flags = []
-    mappings = {
-        'D' : '\\Draft',
-        'F' : '\\Flagged',
-        'P' : '$Forwarded',
-        'R' : '\\Answered',
-        'S' : '\\Seen',
-        'T' : '\\Deleted'
-    }
-    for (letter, imapflag) in mappings.items():
-        if letter in flagstring:
-            flags.append(imapflag)
-    return flags
-
+    return _MAILDIR_FLAGS.imapflags(message.get_flags())
 
 def maildirflags_from_imap_message(message):
     """ Return a string of maildir flags from an ImapMessage"""
-    result = ""
-    imapflags = message.imapflags()
-    mappings = {
-        'D' : '\\Draft',
-        'F' : '\\Flagged',
-        'P' : '$Forwarded',
-        'R' : '\\Answered',
-        'S' : '\\Seen',
-        'T' : '\\Deleted'
-    }
-    mappings = _reverse_mappings(mappings)
-    for imapflag in imapflags:
-        if mappings.has_key(imapflag):
-            result += mappings[imapflag]
-    return result
+    return _MAILDIR_FLAGS.flags(message.get_flagmask())
 
 def imapflags_from_mbox_message(message):
     """ Return a list of IMAP flags from an mboxMessage"""
-    flagstring = message.get_flags()
-    flags = []
-    mappings = {
-        'F' : '\\Flagged',
-        'A' : '\\Answered',
-        'R' : '\\Seen',
-        'D' : '\\Deleted'
-    }
-    for (letter, imapflag) in mappings.items():
-        if letter in flagstring:
-            flags.append(imapflag)
-    return flags
-        
+    return _MBOX_FLAGS.imapflags(message.get_flags())
+
 def mboxflags_from_imap_message(message):
     """ Return a string of mbox flags from an ImapMessage"""
-    result = ""
-    imapflags = message.imapflags()
-    mappings = {
-        'F' : '\\Flagged',
-        'A' : '\\Answered',
-        'R' : '\\Seen',
-        'D' : '\\Deleted'
-    }
-    mappings = _reverse_mappings(mappings)
-    for imapflag in imapflags:
-        if mappings.has_key(imapflag):
-            result += mappings[imapflag]
-    return result
+    return _MBOX_FLAGS.flags(message.get_flagmask())
 
 def imapflags_from_mh_message(message):
     """ Return a list of IMAP flags from an MHMessage"""
-    sequences = message.get_sequences()
-    flags = []
-    mappings = {
-        'flagged' : '\\Flagged',
-        'replied' : '\\Answered'
-    }
-    for (sequence, imapflag) in mappings.items():
-        if sequence in sequences:
-            flags.append(imapflag)
-    return flags
+    return _MH_SEQUENCES.imapflags(message.get_sequences())
 
 def mhsequences_from_imap_message(message):
     """ Return a list of MH sequences from an ImapMessage"""
-    result = []
-    imapflags = message.imapflags()
-    mappings = {
-        'flagged' : '\\Flagged',
-        'replied' : '\\Answered'
-    }
-    mappings = _reverse_mappings(mappings)
-    for imapflag in imapflags:
-        if mappings.has_key(imapflag):
-            result.append(mappings[imapflag])
-    return result
+    return _MH_SEQUENCES.flags(message.get_flagmask())
 
 def imapflags_from_babyl_message(message):
     """ Return a list of IMAP flags from an BabylMessage"""
-    labels = message.get_labels()
-    flags = []
-    mappings = {
-        'forwarded' : '$Forwarded',
-        'answered' : '\\Answered',
-        'deleted' : '\\Deleted'
-    }
-    for (label, imapflag) in mappings.items():
-        if label in labels:
-            flags.append(imapflag)
-    return flags
-        
+    return _BABYL_LABELS.imapflags(message.get_labels())
+
 def babyllabels_from_imap_message(message):
     """ Return a list of Babyl lables from an ImapMessage"""
-    result = []
-    imapflags = message.imapflags()
-    mappings = {
-        'forwarded' : '$Forwarded',
-        'answered' : '\\Answered',
-        'deleted' : '\\Deleted'
-    }
-    mappings = _reverse_mappings(mappings)
-    for imapflag in imapflags:
-        if mappings.has_key(imapflag):
-            result.append(mappings[imapflag])
-    return result
+    return _BABYL_LABELS.flags(message.get_flagmask())
 
 def imapflags_from_mmdf_message(message):
     """ Return a list of IMAP flags from an MMDFMessage"""
@@ -0,0 +1,287 @@
+############################################################################
+#    Copyright (C) 2008 by Michael Goerz                                   #
+#    http://www.physik.fu-berlin.de/~goerz                                 #
+#                                                                          #
+#    This program is free software; you can redistribute it and#or modify  #
+#    it under the terms of the GNU General Public License as published by  #
+#    the Free Software Foundation; either version 3 of the License, or     #
+#    (at your option) any later version.                                   #
+#                                                                          #
+#    This program is distributed in the hope that it will be useful,       #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of        #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         #
+#    GNU General Public License for more details.                          #
+#                                                                          #
+#    You should have received a copy of the GNU General Public License     #
+#    along with this program; if not, write to the                         #
+#    Free Software Foundation, Inc.,                                       #
+#    59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.             #
+############################################################################
+
+""" This module contains compact representations of the metadata of
+    messages (UID, flags, internal date, and size), for keeping track of
+    folders with a very large number of messages.
+
+    MessageRecord holds the metadata of a single message in an object with
+    __slots__. MetadataTable stores the metadata of a whole folder in
+    columns of arrays, which takes about 28 bytes per message.
+
+    In both, the flags are an integer bitmask as defined by the flag
+    registry in ProcImap.ImapFlags, and the internal date is stored as
+    seconds since the epoch. Selecting messages by their flags works on the
+    whole flags column at once:
+
+        >>> unread = table.select(none_of=SEEN|DELETED)
+"""
+
+import time
+from array import array
+from bisect import bisect_left
+
+from ProcImap.ImapFlags import REGISTRY
+from ProcImap.ImapMessage import ImapMessage
+from ProcImap.UIDSet import UIDSet
+
+
+def _epoch(internaldate):
+    """ Convert a time tuple into seconds since the epoch (0 for None) """
+    if internaldate is None:
+        return 0
+    return int(time.mktime(internaldate))
+
+
+class MessageRecord(object):
+    """ The metadata of a single message
+
+        Attributes are:
+        uid             UID of the message
+        flags           bitmask of flags (see module documentation)
+        internaldate    internal date in seconds since the epoch
+        size            size of the message in octets
+    """
+    __slots__ = ('uid', 'flags', 'internaldate', 'size')
+
+    def __init__(self, uid, flags=0, internaldate=0, size=0):
+        self.uid = uid
+        self.flags = flags
+        self.internaldate = internaldate
+        self.size = size
+
+    def from_message(cls, uid, message):
+        """ Create a MessageRecord from an ImapMessage """
+        return cls(uid, message.get_flagmask(), _epoch(message.internaldate),
+                   message.size)
+    from_message = classmethod(from_message)
+
+    def to_message(self, message=None):
+        """ Set the flags, internal date and size of message (an
+            ImapMessage) from the record and return it. If message is None,
+            a new, empty ImapMessage is created.
+        """
+        if message is None:
+            message = ImapMessage()
+        message.set_flagmask(self.flags)
+        message.internaldate = time.localtime(self.internaldate)
+        message.size = self.size
+        return message
+
+    def has_flags(self, mask):
+        """ Return True if all the flags in mask are set """
+        return (self.flags & mask) == mask
+
+    def __repr__(self):
+        return "MessageRecord(%r, %r, %r, %r)" \
+               % (self.uid, self.flags, self.internaldate, self.size)
+
+    def __eq__(self, other):
+        if not isinstance(other, MessageRecord):
+            return NotImplemented
+        return ((self.uid, self.flags, self.internaldate, self.size)
+                == (other.uid, other.flags, other.internaldate, other.size))
+
+    def __ne__(self, other):
+        return not (self == other)
+
+
+class MetadataTable(object):
+    """ The metadata of many messages, stored column-wise in arrays and
+        sorted by UID.
+
+        Iterating over the table yields MessageRecord instances. The table
+        is indexed by UID:
+
+            table[uid]              MessageRecord for the UID
+            uid in table            True if there is a record for the UID
+
+        Flags are selected for all messages at once with select() and
+        count(), e.g. all UIDs of messages that are seen but not deleted:
+
+            table.select(all_of=SEEN, none_of=DELETED)
+    """
+    def __init__(self):
+        """ Create an empty table """
+        self._uids = array('I')
+        self._flags = array('Q')
+        self._dates = array('q')
+        self._sizes = array('Q')
+        self._sorted = True
+
+    def append(self, uid, flags=0, internaldate=0, size=0):
+        """ Add the metadata of a message. flags may be a bitmask or a list
+            of flag names, internaldate may be seconds since the epoch or a
+            time tuple.
+            If there is a record for the UID already, it is replaced.
+        """
+        uid = int(uid)
+        if not isinstance(flags, int):
+            flags = REGISTRY.mask(flags)
+        if not isinstance(internaldate, (int, float)):
+            internaldate = _epoch(internaldate)
+        if self._uids and uid <= self._uids[-1]:
+            if self._sorted:
+                index = bisect_left(self._uids, uid)
+                if self._uids[index] == uid:
+                    self._set_flags(index, flags)
+                    self._dates[index] = int(internaldate)
+                    self._sizes[index] = int(size)
+                    return
+            # records appended out of order are only sorted (and
+            # duplicates removed) when the table is read
+            self._sorted = False
+        self._uids.append(uid)
+        self._dates.append(int(internaldate))
+        self._sizes.append(int(size))
+        self._flags.append(0)
+        self._set_flags(len(self._uids) - 1, flags)
+
+    def append_message(self, uid, message):
+        """ Add the metadata of an ImapMessage """
+        self.append(uid, message.get_flagmask(), message.internaldate,
+                    message.size)
+
+    def _set_flags(self, index, mask):
+        """ Store the flags bitmask at index, switching the flags column to
+            a list if the mask does not fit into 64 bits
+        """
+        try:
+            self._flags[index] = mask
+        except OverflowError:
+            self._flags = list(self._flags)
+            self._flags[index] = mask
+
+    def _sort(self):
+        """ Sort all columns by UID. Of several records for the same UID,
+            only the one that was appended last is kept.
+        """
+        if self._sorted:
+            return
+        order = sorted(range(len(self._uids)), key=self._uids.__getitem__)
+        order = [index for (position, index) in enumerate(order)
+                 if position + 1 == len(order)
+                 or self._uids[order[position + 1]] != self._uids[index]]
+        for name in ('_uids', '_flags', '_dates', '_sizes'):
+            column = getattr(self, name)
+            sorted_column = [column[index] for index in order]
+            if isinstance(column, array):
+                sorted_column = array(column.typecode, sorted_column)
+            setattr(self, name, sorted_column)
+        self._sorted = True
+
+    def _index(self, uid):
+        """ Return the row of the UID, or raise KeyError """
+        self._sort()
+        index = bisect_left(self._uids, uid)
+        if index < len(self._uids) and self._uids[index] == uid:
+            return index
+        raise KeyError("No UID %s in MetadataTable" % uid)
+
+    def _record(self, index):
+        """ Return the row at index as a MessageRecord """
+        return MessageRecord(self._uids[index], self._flags[index],
+                             self._dates[index], self._sizes[index])
+
+    def uids(self):
+        """ Return the UIDs in the table as a UIDSet """
+        self._sort()
+        return UIDSet(self._uids)
+
+    def select(self, all_of=0, none_of=0):
+        """ Return a UIDSet of all messages that have all the flags in the
+            bitmask 'all_of' and none of the flags in the bitmask 'none_of'.
+            Lists of flag names are accepted as well.
+        """
+        if not isinstance(all_of, int):
+            all_of = REGISTRY.mask(all_of)
+        if not isinstance(none_of, int):
+            none_of = REGISTRY.mask(none_of)
+        self._sort()
+        selected = all_of | none_of
+        return UIDSet([uid for (uid, flags) in zip(self._uids, self._flags)
+                       if flags & selected == all_of])
+
+    def count(self, all_of=0, none_of=0):
+        """ Return the number of messages that have all the flags in
+            'all_of' and none of the flags in 'none_of' (see select)
+        """
+        if not isinstance(all_of, int):
+            all_of = REGISTRY.mask(all_of)
+        if not isinstance(none_of, int):
+            none_of = REGISTRY.mask(none_of)
+        self._sort()
+        selected = all_of | none_of
+        return len([flags for flags in self._flags
+                    if flags & selected == all_of])
+
+    def total_size(self):
+        """ Return the sum of the sizes of all messages """
+        self._sort()
+        return sum(self._sizes)
+
+    def get_flags(self, uid):
+        """ Return the flags bitmask of the message with UID """
+        return self._flags[self._index(int(uid))]
+
+    def set_flags(self, uid, mask):
+        """ Replace the flags of the message with UID by the bitmask """
+        self._set_flags(self._index(int(uid)), mask)
+
+    def add_flags(self, uid, mask):
+        """ Set the flags in the bitmask for the message with UID """
+        index = self._index(int(uid))
+        self._set_flags(index, self._flags[index] | mask)
+
+    def remove_flags(self, uid, mask):
+        """ Clear the flags in the bitmask for the message with UID """
+        index = self._index(int(uid))
+        self._set_flags(index, self._flags[index] & ~mask)
+
+    def to_message(self, uid, message=None):
+        """ Set the flags, internal date and size of message (an
+            ImapMessage, created if None) from the record for the UID and
+            return it
+        """
+        return self[uid].to_message(message)
+
+    def __getitem__(self, uid):
+        """ Return the MessageRecord for the UID """
+        return self._record(self._index(int(uid)))
+
+    def __contains__(self, uid):
+        try:
+            self._index(int(uid))
+            return True
+        except (KeyError, TypeError, ValueError):
+            return False
+
+    def __len__(self):
+        self._sort()
+        return len(self._uids)
+
+    def __iter__(self):
+        """ Iterate over all records, in the order of their UIDs """
+        self._sort()
+        for index in range(len(self._uids)):
+            yield self._record(index)
+
+    def __repr__(self):
+        return "<MetadataTable of %s messages>" % len(self)
@@ -0,0 +1,185 @@
+############################################################################
+#    Copyright (C) 2008 by Michael Goerz                                   #
+#    http://www.physik.fu-berlin.de/~goerz                                 #
+#                                                                          #
+#    This program is free software; you can redistribute it and#or modify  #
+#    it under the terms of the GNU General Public License as published by  #
+#    the Free Software Foundation; either version 3 of the License, or     #
+#    (at your option) any later version.                                   #
+#                                                                          #
+#    This program is distributed in the hope that it will be useful,       #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of        #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         #
+#    GNU General Public License for more details.                          #
+#                                                                          #
+#    You should have received a copy of the GNU General Public License     #
+#    along with this program; if not, write to the                         #
+#    Free Software Foundation, Inc.,                                       #
+#    59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.             #
+############################################################################
+
+""" This module contains functions for parsing the data that imaplib
+    returns for FETCH, THREAD and similar commands into Python objects.
+
+    imaplib hands back the untagged responses as a list in which each
+    literal is split off into a (text, literal) tuple. The functions in
+    this module join those pieces again and convert them into nested
+    lists, where
+        atoms and numbers       become strings
+        quoted strings          become strings
+        NIL                     becomes None
+        literals                become bytes (they are not decoded)
+        parenthesized lists     become lists
+
+    Data items with a section, like BODY[HEADER.FIELDS (FROM)]<0>, are
+    returned as a single atom.
+"""
+
+import re
+
+
+_TOKEN_PATTERN = re.compile(br'''
+      (?P<space>[ \r\n]+)
+    | (?P<open>\()
+    | (?P<close>\))
+    | (?P<literal>\{\d+\+?\}$)
+    | "(?P<quoted>(?:[^"\\]|\\.)*)"
+    | (?P<atom>[^ ()"\[\r\n]+(?:\[[^\]]*\](?:<\d+>)?)?
+              |\[[^\]]*\][^ ()"\r\n]*)
+''', re.VERBOSE)
+
+_QUOTED_PAIR = re.compile(br'\\(.)')
+
+
+class ParseError(Exception):
+    """ Raised if a server response cannot be parsed """
+    pass
+
+
+def _decode(value):
+    """ Convert bytes from the protocol stream to a string """
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    return value
+
+def _scan(text):
+    """ Yield the tokens in the bytes 'text' as tuples (kind, value),
+        where kind is one of 'open', 'close', 'atom', 'string'.
+        A literal marker at the end of the text is skipped; the literal
+        itself is delivered separately by imaplib.
+    """
+    if not isinstance(text, bytes):
+        text = text.encode('utf-8')
+    position = 0
+    while position < len(text):
+        match = _TOKEN_PATTERN.match(text, position)
+        if match is None:
+            raise ParseError("cannot parse response at: %r"
+                             % text[position:position+40])
+        position = match.end()
+        kind = match.lastgroup
+        if kind in ('space', 'literal'):
+            continue
+        elif kind == 'quoted':
+            yield ('string',
+                   _decode(_QUOTED_PAIR.sub(br'\1', match.group('quoted'))))
+        elif kind == 'atom':
+            yield ('atom', _decode(match.group('atom')))
+        else:
+            yield (kind, None)
+
+def _tokens(data):
+    """ Yield the tokens of an imaplib response data list """
+    if isinstance(data, (bytes, str)):
+        data = [data]
+    for item in data:
+        if item is None:
+            continue
+        if isinstance(item, tuple):
+            for token in _scan(item[0]):
+                yield token
+            yield ('literal', item[1])
+        else:
+            for token in _scan(item):
+                yield token
+
+def parse(data):
+    """ Parse an imaplib response data list (or a single bytes string)
+        into a list of Python objects, as described in the module docstring.
+    """
+    result = []
+    stack = [result]
+    for (kind, value) in _tokens(data):
+        if kind == 'open':
+            new_list = []
+            stack[-1].append(new_list)
+            stack.append(new_list)
+        elif kind == 'close':
+            if len(stack) == 1:
+                raise ParseError("unbalanced parentheses in response")
+            stack.pop()
+        elif kind == 'atom':
+            if value.upper() == 'NIL':
+                value = None
+            stack[-1].append(value)
+        else:
+            stack[-1].append(value)
+    if len(stack) != 1:
+        raise ParseError("unbalanced parentheses in response")
+    return result
+
+def parse_fetch(data):
+    """ Parse the data of a (UID) FETCH response into a dict that maps
+        each UID (as an integer) to a dict of data items. The names of the
+        data items are upper case, e.g.
+            {5: {'UID': '5', 'FLAGS': ['\\Seen'], 'RFC822.SIZE': '1234',
+                 'BODY[HEADER.FIELDS (FROM)]': b'From: ...'}}
+        If the response does not contain UIDs (a FETCH without UID), the
+        message sequence numbers are used as keys.
+    """
+    result = {}
+    tokens = parse(data)
+    for index in range(0, len(tokens) - 1, 2):
+        (number, items) = (tokens[index], tokens[index+1])
+        if not isinstance(items, list):
+            raise ParseError("unexpected FETCH response: %r" % (tokens,))
+        attributes = {}
+        for (name, value) in zip(items[::2], items[1::2]):
+            attributes[name.upper()] = value
+        try:
+            key = int(attributes.get('UID', number))
+        except (TypeError, ValueError):
+            raise ParseError("unexpected FETCH response: %r" % (tokens,))
+        if key in result:
+            result[key].update(attributes)
+        else:
+            result[key] = attributes
+    return result
+
+def fetch_item(attributes, prefix):
+    """ Return the value of the first data item in the 'attributes' dict
+        (as returned by parse_fetch for one message) whose name starts with
+        'prefix', e.g. 'BODY[HEADER.FIELDS'. Servers do not always echo the
+        item names exactly as they were requested, so this is more robust
+        than a direct lookup. Return None if there is no such item.
+    """
+    prefix = prefix.upper()
+    for (name, value) in attributes.items():
+        if name.startswith(prefix):
+            return value
+    return None
+
+def parse_thread(data):
+    """ Parse the data of a THREAD response (RFC 5256) like
+        '(2)(3 6 (4 23)(44 7 96))' into a list of threads. Each thread is a
+        list of UIDs (as integers), in which a nested list stands for a
+        branch: [[2], [3, 6, [4, 23], [44, 7, 96]]]
+    """
+    def convert(node):
+        if isinstance(node, list):
+            return [convert(child) for child in node]
+        return int(node)
+    try:
+        return [convert(thread) for thread in parse(data)]
+    except (TypeError, ValueError):
+        raise ParseError("unexpected THREAD response: %r" % (data,))
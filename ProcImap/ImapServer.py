@@ -34,6 +34,14 @@ STANDARD_IMAPLIB = True    # this module can use the multithreaded imaplib2
 IDLE_TIMEOUT = 120 # max time to wait in the idle command (this must be less
                    # than 29 minutes)
 
+APPEND_PIPELINE_DEPTH = 32 # max number of APPEND commands that are sent to
+                           # the server before waiting for the first of them
+                           # to complete. Only relevant if the server supports
+                           # non-synchronizing literals (LITERAL+/LITERAL-)
+
+LITERAL_MINUS_MAX = 4096 # LITERAL- (RFC 7888) only allows non-synchronizing
+                         # literals up to this many octets
+
 if STANDARD_IMAPLIB:
     import imaplib
     IDLE_TIMEOUT = 5 # that's how long we sleep in the bogus idle
@@ -45,6 +53,11 @@ else:
 import time
 import re
 
+from ProcImap.UIDSet import UIDSet
+
+_CAPABILITY_CODE_PATTERN = re.compile(r'\[CAPABILITY ([^\]]*)\]',
+                                      re.IGNORECASE)
+
 
 class ClosedMailboxError(Exception):
     """ Raised if a method is called on a closed mailbox """
@@ -83,6 +96,9 @@ class ImapServer:
             'open' : False          # opened a mailbox? select/close
         }
         self.mailboxname = None
+        self.permanentflags = []
+        self.uidvalidity = None
+        self._capabilities = None # CAPABILITY response after login
         self.connect()
         self.login()
 
@@ -109,6 +125,7 @@ class ImapServer:
             if self.port is None:
                 self.port = 143
             self._server = imaplib.IMAP4(self.servername, self.port)
+        self._capabilities = None
         self._flags['connected'] = True
 
     def disconnect(self):
@@ -137,8 +154,26 @@ class ImapServer:
                 self.reconnect()
                 result =  self._server.login(self.username, self.password)
             self._flags['logged_in'] = True
+            self._refresh_capabilities(result)
             return result
 
+    def _refresh_capabilities(self, response):
+        """ Store the capabilities of the server after authentication. Many
+            servers announce more capabilities (e.g. ESEARCH or MULTIAPPEND)
+            after login than in their greeting. They are taken from the
+            [CAPABILITY ...] response code of the (code, data) login
+            response if there is one, otherwise a CAPABILITY command is
+            sent.
+        """
+        text = ' '.join([_text(line) for line in response[1] or []])
+        match = _CAPABILITY_CODE_PATTERN.search(text)
+        if match is not None:
+            self._capabilities = tuple(match.group(1).upper().split())
+            return
+        (code, data) = self._server.capability()
+        if code == 'OK' and data and data[-1]:
+            self._capabilities = tuple(_text(data[-1]).upper().split())
+
     def reconnect(self):
         """ Close and then reopen the connection to the server """
         try:
@@ -184,11 +219,200 @@ class ImapServer:
 
     def append(self, mailbox, flags, date_time, messagestr):
         """ Append message to named mailbox. All parameters are strings which
-            need to be in the appropriate format as described in RFC3501"""
+            need to be in the appropriate format as described in RFC3501
+            If the server supports non-synchronizing literals (LITERAL+ or
+            LITERAL-, RFC 7888), the message is sent without waiting for
+            the server's continuation response.
+        """
+        return self.append_many(mailbox, [(flags, date_time, messagestr)])[0]
+
+    def append_many(self, mailbox, messages):
+        """ Append several messages to the named mailbox. 'messages' is an
+            iterable of (flags, date_time, messagestr) tuples, as for the
+            append method. Return a list of (code, data) tuples, one for
+            each message, in the same order.
+
+            If the server supports non-synchronizing literals, the APPEND
+            commands are pipelined: up to APPEND_PIPELINE_DEPTH commands are
+            sent back to back before waiting for their responses, so that
+            uploading is limited by bandwidth instead of latency. Otherwise,
+            each message is appended with a separate round trip.
+
+            A message that the server rejects with BAD gets a ('BAD', [text])
+            result; the responses to the other messages are still read. If
+            the connection is lost, it is dropped (see _drop_connection) and
+            the exception is raised.
+        """
         if not self._flags['open']:
             raise ClosedMailboxError("called append on closed mailbox")
-        flags = flags.replace("\\Recent", '')
-        return self._server.append(mailbox, flags, date_time, messagestr)
+        results = []
+        pending = [] # tags of commands that have been sent, in order
+        for (flags, date_time, messagestr) in messages:
+            if flags is not None:
+                flags = flags.replace("\\Recent", '')
+            if STANDARD_IMAPLIB:
+                messagestr = _literal_from_string(messagestr)
+            if self._nonsync_literal_ok(len(messagestr)):
+                if len(pending) >= APPEND_PIPELINE_DEPTH:
+                    results.extend(self._append_responses(pending[:1]))
+                    del pending[:1]
+                pending.append(self._send_append(mailbox, [(flags,
+                                                 date_time, messagestr)]))
+            else:
+                results.extend(self._append_responses(pending))
+                pending = []
+                try:
+                    results.append(self._server.append(mailbox, flags,
+                                                       date_time, messagestr))
+                except self._server.abort:
+                    self._drop_connection()
+                    raise
+                except self._server.error as data:
+                    results.append(('BAD', [str(data)]))
+        results.extend(self._append_responses(pending))
+        return results
+
+    def _append_responses(self, tags):
+        """ Wait for the tagged responses of the pipelined APPEND commands
+            with the given tags, and return them as a list of (code, data)
+            tuples, in order. A BAD response is returned as
+            ('BAD', [text]) instead of being raised, so that the responses
+            of the following commands are still read from the connection.
+            If the connection is lost, the responses of the remaining
+            commands cannot be read: the connection is dropped and the
+            exception is raised.
+        """
+        results = []
+        for tag in tags:
+            try:
+                results.append(self._server._command_complete('APPEND', tag))
+            except self._server.abort:
+                self._drop_connection()
+                raise
+            except self._server.error as data:
+                results.append(('BAD', [str(data)]))
+        return results
+
+    def _drop_connection(self):
+        """ Close a broken connection without logging out. The next login
+            connects again.
+        """
+        try:
+            self._server.shutdown()
+        except (OSError, IOError):
+            pass
+        self._server = None
+        for flag in self._flags:
+            self._flags[flag] = False
+
+    def _nonsync_literal_ok(self, size):
+        """ Return True if a literal of the given size can be sent as a
+            non-synchronizing literal. This is only supported with the
+            standard imaplib module.
+        """
+        if not STANDARD_IMAPLIB:
+            return False
+        if self.has_capability('LITERAL+'):
+            return True
+        return (self.has_capability('LITERAL-') and size <= LITERAL_MINUS_MAX)
+
+    def multiappend(self, mailbox, messages):
+        """ Append all messages to the named mailbox in a single APPEND
+            command (RFC 3502). 'messages' is a list of
+            (flags, date_time, messagestr) tuples, as for the append method.
+            The server either stores all of the messages, or none of them.
+            Return the (code, data) response of the command.
+            The server must support the MULTIAPPEND capability.
+            With imaplib2, MULTIAPPEND is not available; the messages are
+            then appended one by one, so that some of them may be stored
+            even if the command fails for another. The response of the first
+            failed APPEND is returned, or that of the last one.
+        """
+        if not self._flags['open']:
+            raise ClosedMailboxError("called multiappend on closed mailbox")
+        if not STANDARD_IMAPLIB:
+            response = ('OK', [None])
+            for (flags, date_time, messagestr) in messages:
+                response = self.append(mailbox, flags, date_time, messagestr)
+                if response[0] != 'OK':
+                    break
+            return response
+        prepared = []
+        synchronizing = False
+        for (flags, date_time, messagestr) in messages:
+            if flags is not None:
+                flags = flags.replace("\\Recent", '')
+            messagestr = _literal_from_string(messagestr)
+            if not self._nonsync_literal_ok(len(messagestr)):
+                synchronizing = True
+            prepared.append((flags, date_time, messagestr))
+        tag = self._send_append(mailbox, prepared, synchronizing)
+        return self._server._command_complete('APPEND', tag)
+
+    def _send_append(self, mailbox, messages, synchronizing=False):
+        """ Send an APPEND command for the given list of
+            (flags, date_time, messagestr) tuples and return the tag of the
+            command without waiting for the tagged response. More than one
+            message is only allowed if the server supports MULTIAPPEND.
+            Unless 'synchronizing' is True, the messages are sent as
+            non-synchronizing literals. Otherwise, the server's continuation
+            response is awaited before each literal; if the server rejects
+            the command instead, sending stops.
+        """
+        tag = self._server._new_tag()
+        data = tag + b' APPEND ' + _quote_mailbox(mailbox).encode('utf-8')
+        try:
+            for (flags, date_time, messagestr) in messages:
+                if flags:
+                    if (flags[0], flags[-1]) != ('(', ')'):
+                        flags = "(%s)" % flags
+                    data += b' ' + flags.encode('ascii')
+                if date_time:
+                    data += b' ' \
+                         + imaplib.Time2Internaldate(date_time).encode('ascii')
+                literal = _literal_from_string(messagestr)
+                if synchronizing:
+                    data += (' {%s}' % len(literal)).encode('ascii')
+                    self._server.send(data + imaplib.CRLF)
+                    while self._server._get_response():
+                        if self._server.tagged_commands[tag]: # NO/BAD
+                            return tag
+                    data = literal
+                else:
+                    data += (' {%s+}' % len(literal)).encode('ascii') \
+                         + imaplib.CRLF + literal
+            self._server.send(data + imaplib.CRLF)
+        except (OSError, IOError) as val:
+            raise self._server.abort('socket error: %s' % val)
+        return tag
+
+    def has_capability(self, capability):
+        """ Return True if the server announced 'capability' (e.g. 'ESEARCH'
+            or 'LITERAL+') in its CAPABILITY response, False otherwise.
+            After login, the capabilities announced for the authenticated
+            state are used.
+        """
+        capabilities = self._capabilities
+        if capabilities is None:
+            capabilities = [cap.upper() for cap
+                            in getattr(self._server, 'capabilities', ())]
+        return capability.upper() in capabilities
+
+    def esearch(self, returnopts, criteria, charset=None):
+        """ Execute an extended UID SEARCH (RFC 4731), requesting the result
+            options in the string 'returnopts', e.g. 'MIN MAX COUNT ALL'.
+            Returns (code, data), where data is the list of untagged ESEARCH
+            responses, or [None] if the server did not send one.
+            The server must support the ESEARCH capability.
+        """
+        if not self._flags['open']:
+            raise ClosedMailboxError("called esearch on closed mailbox")
+        args = ['SEARCH', 'RETURN', "(%s)" % returnopts]
+        if charset is not None:
+            args += ['CHARSET', charset]
+        args.append(criteria)
+        (code, data) = self._server._simple_command('UID', *args)
+        return self._server._untagged_response(code, data, 'ESEARCH')
 
     def uid(self, command, *args):
         """ uid(command, arg[, ...])
@@ -197,6 +421,7 @@ class ImapServer:
         """
         if not self._flags['open']:
             raise ClosedMailboxError("called uid on closed mailbox")
+        args = [_argument(arg) for arg in args]
         return self._server.uid(command, *args)
 
     def expunge(self):
@@ -223,7 +448,10 @@ class ImapServer:
             If the mailbox does not exist, create it if 'create' is True,
             else raise NoSuchMailboxError.
             The name of the mailbox will be stored in the mailboxname 
-            attribute if selection was successful
+            attribute if selection was successful. The flags that can be
+            changed permanently in the mailbox (PERMANENTFLAGS) are stored
+            as a list in the permanentflags attribute, and the UIDVALIDITY
+            in the uidvalidity attribute.
         """
         if not self._flags['logged_in']:
             self.login()
@@ -233,6 +461,12 @@ class ImapServer:
         if code == 'OK':
             self._flags['open'] = True
             self.mailboxname = mailbox
+            self.permanentflags = self._select_response('PERMANENTFLAGS')
+            self.permanentflags = self.permanentflags.strip('()').split()
+            try:
+                self.uidvalidity = int(self._select_response('UIDVALIDITY'))
+            except ValueError:
+                self.uidvalidity = None
             return int(count)
         else:
             if create:
@@ -242,6 +476,19 @@ class ImapServer:
                 raise NoSuchMailboxError("mailbox %s does not exist." \
                                            % mailbox)
 
+    def _select_response(self, code):
+        """ Return the data of the response code (e.g. 'UIDVALIDITY') that
+            the server sent in reply to SELECT, as a string ('' if there is
+            none)
+        """
+        (typ, data) = self._server.response(code)
+        value = data[-1]
+        if value is None:
+            return ''
+        if isinstance(value, bytes) and not isinstance(value, str):
+            value = value.decode('utf-8', 'replace')
+        return value
+
     def list(self):
         """ Return list mailbox names, or None if the server does
             not send an 'OK' reply.
@@ -294,3 +541,37 @@ class ImapServer:
             servers are unequal if they are not equal
         """
         return (not (self == other))
+
+
+def _quote_mailbox(name):
+    """ Return the mailbox name as an IMAP astring, i.e. quoted if it
+        contains characters that are not allowed in an atom.
+    """
+    if name.startswith('"') and name.endswith('"') and len(name) > 1:
+        return name
+    if name and not re.search(r'[\x00-\x20\x7f(){%*"\\\]]', name):
+        return name
+    return '"%s"' % name.replace('\\', '\\\\').replace('"', '\\"')
+
+def _text(value):
+    """ Return a server response line as a string """
+    if isinstance(value, bytes):
+        return value.decode('ascii', 'replace')
+    return value
+
+def _argument(arg):
+    """ Convert a command argument for imaplib: integers and UIDSets are
+        passed as strings, since imaplib on Python 3 only accepts str and
+        bytes
+    """
+    if isinstance(arg, (int, UIDSet)):
+        return str(arg)
+    return arg
+
+def _literal_from_string(messagestr):
+    """ Return the message as bytes with CRLF line endings, suitable for
+        sending as a literal.
+    """
+    if not isinstance(messagestr, bytes):
+        messagestr = messagestr.encode('utf-8', 'surrogateescape')
+    return imaplib.MapCRLF.sub(imaplib.CRLF, messagestr)
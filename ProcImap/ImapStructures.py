@@ -0,0 +1,301 @@
+############################################################################
+#    Copyright (C) 2008 by Michael Goerz                                   #
+#    http://www.physik.fu-berlin.de/~goerz                                 #
+#                                                                          #
+#    This program is free software; you can redistribute it and#or modify  #
+#    it under the terms of the GNU General Public License as published by  #
+#    the Free Software Foundation; either version 3 of the License, or     #
+#    (at your option) any later version.                                   #
+#                                                                          #
+#    This program is distributed in the hope that it will be useful,       #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of        #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         #
+#    GNU General Public License for more details.                          #
+#                                                                          #
+#    You should have received a copy of the GNU General Public License     #
+#    along with this program; if not, write to the                         #
+#    Free Software Foundation, Inc.,                                       #
+#    59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.             #
+############################################################################
+
+""" This module contains lightweight representations of the ENVELOPE and
+    BODYSTRUCTURE data items that an IMAP server returns for a message.
+    They allow to list messages and to find the interesting MIME parts of a
+    message without downloading (and parsing) the message itself.
+
+    All classes use __slots__, so that envelopes for a large number of
+    messages can be kept in memory cheaply.
+"""
+
+from email.utils import formataddr
+
+
+class Address(object):
+    """ An address from an ENVELOPE
+
+        Attributes are:
+        name        display name (personal name), or None
+        route       source route (obsolete), or None
+        mailbox     local part of the address
+        host        domain part of the address
+    """
+    __slots__ = ('name', 'route', 'mailbox', 'host')
+
+    def __init__(self, name=None, route=None, mailbox=None, host=None):
+        self.name = name
+        self.route = route
+        self.mailbox = mailbox
+        self.host = host
+
+    def from_response(cls, data):
+        """ Create an Address from the parsed list
+            [name, route, mailbox, host] of a server response
+        """
+        return cls(*data[:4])
+    from_response = classmethod(from_response)
+
+    address = property(lambda self: "%s@%s" % (self.mailbox, self.host)
+                       if self.host is not None else (self.mailbox or ''),
+                       doc="The address as 'mailbox@host'")
+
+    def __str__(self):
+        """ Return the address in the form 'Name <mailbox@host>' """
+        return formataddr((self.name or '', self.address))
+
+    def __repr__(self):
+        return "Address(%r, %r, %r, %r)" \
+               % (self.name, self.route, self.mailbox, self.host)
+
+    def __eq__(self, other):
+        if not isinstance(other, Address):
+            return NotImplemented
+        return ((self.name, self.route, self.mailbox, self.host)
+                == (other.name, other.route, other.mailbox, other.host))
+
+    def __ne__(self, other):
+        return not (self == other)
+
+
+class Envelope(object):
+    """ The ENVELOPE of a message, i.e. the most important header fields,
+        as parsed by the server.
+
+        Attributes are:
+        date            Date header (string), or None
+        subject         Subject header (string, not decoded), or None
+        from_           list of Address instances
+        sender          list of Address instances
+        reply_to        list of Address instances
+        to              list of Address instances
+        cc              list of Address instances
+        bcc             list of Address instances
+        in_reply_to     In-Reply-To header (string), or None
+        message_id      Message-ID header (string), or None
+    """
+    __slots__ = ('date', 'subject', 'from_', 'sender', 'reply_to', 'to',
+                 'cc', 'bcc', 'in_reply_to', 'message_id')
+
+    def __init__(self, date=None, subject=None, from_=None, sender=None,
+                 reply_to=None, to=None, cc=None, bcc=None, in_reply_to=None,
+                 message_id=None):
+        self.date = date
+        self.subject = subject
+        self.from_ = from_ or []
+        self.sender = sender or []
+        self.reply_to = reply_to or []
+        self.to = to or []
+        self.cc = cc or []
+        self.bcc = bcc or []
+        self.in_reply_to = in_reply_to
+        self.message_id = message_id
+
+    def from_response(cls, data):
+        """ Create an Envelope from the parsed ENVELOPE list of a server
+            response (see ProcImap.ImapParser)
+        """
+        data = list(data) + [None] * (10 - len(data))
+        addresses = [[Address.from_response(address)
+                      for address in (field or [])] for field in data[2:8]]
+        return cls(data[0], data[1], *(addresses + data[8:10]))
+    from_response = classmethod(from_response)
+
+    def __repr__(self):
+        return "<Envelope %r from %s: %r>" \
+               % (self.message_id, ', '.join([str(a) for a in self.from_]),
+                  self.subject)
+
+
+class BodyStructure(object):
+    """ The BODYSTRUCTURE of a message or of one of its MIME parts.
+
+        Attributes are:
+        maintype        e.g. 'text' or 'multipart' (lower case)
+        subtype         e.g. 'plain' or 'mixed' (lower case)
+        params          dict of content type parameters (lower case keys)
+        id              Content-ID, or None
+        description     Content-Description, or None
+        encoding        Content-Transfer-Encoding (lower case), or None
+        size            size of the (encoded) body in octets
+        lines           number of lines for text and message/rfc822 parts,
+                        None otherwise
+        envelope        Envelope of an attached message/rfc822, or None
+        disposition     tuple (disposition, params-dict), or None
+        parts           list of BodyStructure instances of the subparts
+                        (multipart and message/rfc822), otherwise empty
+        section         part specifier for use in BODY[section], e.g. '1.2'
+                        For a multipart, this is '' at the top level.
+    """
+    __slots__ = ('maintype', 'subtype', 'params', 'id', 'description',
+                 'encoding', 'size', 'lines', 'envelope', 'disposition',
+                 'parts', 'section')
+
+    def __init__(self, maintype='text', subtype='plain', params=None):
+        self.maintype = maintype
+        self.subtype = subtype
+        self.params = params or {}
+        self.id = None
+        self.description = None
+        self.encoding = None
+        self.size = 0
+        self.lines = None
+        self.envelope = None
+        self.disposition = None
+        self.parts = []
+        self.section = ''
+
+    def from_response(cls, data, section=''):
+        """ Create a BodyStructure from the parsed BODYSTRUCTURE (or BODY)
+            list of a server response (see ProcImap.ImapParser). 'section'
+            is the part specifier of the part described by data; leave it
+            empty for the message itself.
+        """
+        if data and isinstance(data[0], list):
+            # multipart: list of parts, followed by the subtype
+            result = cls('multipart')
+            index = 0
+            while index < len(data) and isinstance(data[index], list):
+                if section:
+                    subsection = "%s.%s" % (section, index + 1)
+                else:
+                    subsection = "%s" % (index + 1)
+                result.parts.append(cls.from_response(data[index],
+                                                      subsection))
+                index += 1
+            extension = data[index:] + [None] * 3
+            result.subtype = (extension[0] or '').lower()
+            result.params = _params(extension[1])
+            result.disposition = _disposition(extension[2])
+            result.section = section
+            return result
+        data = list(data) + [None] * (12 - len(data))
+        result = cls((data[0] or 'text').lower(), (data[1] or 'plain').lower(),
+                     _params(data[2]))
+        result.id = data[3]
+        result.description = data[4]
+        result.encoding = (data[5] or '7bit').lower()
+        result.size = _int(data[6])
+        result.section = section or '1'
+        extension = data[7:]
+        if result.maintype == 'text':
+            result.lines = _int(extension[0])
+            extension = extension[1:]
+        elif (result.maintype, result.subtype) == ('message', 'rfc822'):
+            if extension[0]:
+                result.envelope = Envelope.from_response(extension[0])
+            if extension[1]:
+                body = cls.from_response(extension[1], result.section)
+                if body.maintype == 'multipart':
+                    result.parts = body.parts
+                else:
+                    body.section = "%s.1" % result.section
+                    result.parts = [body]
+            result.lines = _int(extension[2])
+            extension = extension[3:]
+        # extension data: md5, disposition, language, location
+        if len(extension) > 1:
+            result.disposition = _disposition(extension[1])
+        return result
+    from_response = classmethod(from_response)
+
+    content_type = property(lambda self: "%s/%s" % (self.maintype,
+                                                    self.subtype),
+                            doc="The content type, e.g. 'text/plain'")
+
+    charset = property(lambda self: self.params.get('charset'),
+                       doc="The charset parameter, or None")
+
+    filename = property(lambda self: (self.disposition and
+                                      self.disposition[1].get('filename'))
+                                      or self.params.get('name'),
+                        doc="The filename of an attachment, or None")
+
+    def is_multipart(self):
+        """ Return True if this is a multipart """
+        return self.maintype == 'multipart'
+
+    def is_attachment(self):
+        """ Return True if the part has an 'attachment' disposition """
+        return (self.disposition is not None
+                and self.disposition[0] == 'attachment')
+
+    def walk(self):
+        """ Iterate over this part and all of its subparts, depth-first """
+        yield self
+        for part in self.parts:
+            for subpart in part.walk():
+                yield subpart
+
+    def find(self, content_type):
+        """ Return the first part (depth-first) with the given content type
+            (e.g. 'text/plain') that is not an attachment, or None
+        """
+        content_type = content_type.lower()
+        for part in self.walk():
+            if part.content_type == content_type \
+            and not part.is_attachment():
+                return part
+        return None
+
+    def text_part(self, preferences=('text/plain', 'text/html')):
+        """ Return the part that is best suited for displaying the message
+            as text: the first part with the first matching content type
+            in 'preferences', otherwise the first non-multipart part.
+        """
+        for content_type in preferences:
+            part = self.find(content_type)
+            if part is not None:
+                return part
+        for part in self.walk():
+            if not part.is_multipart():
+                return part
+        return None
+
+    def __repr__(self):
+        return "<BodyStructure %s section %r, %s parts>" \
+               % (self.content_type, self.section, len(self.parts))
+
+
+def _params(data):
+    """ Convert a parsed parameter list ['CHARSET', 'utf-8', ...] into a
+        dict with lower case keys
+    """
+    if not isinstance(data, list):
+        return {}
+    return dict([((key or '').lower(), value)
+                 for (key, value) in zip(data[::2], data[1::2])])
+
+def _disposition(data):
+    """ Convert a parsed disposition ['ATTACHMENT', [params]] into a tuple
+        ('attachment', params-dict), or None
+    """
+    if not isinstance(data, list) or not data:
+        return None
+    return ((data[0] or '').lower(), _params(data[1] if len(data) > 1
+                                             else None))
+
+def _int(value):
+    """ Convert a number from a server response to int """
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
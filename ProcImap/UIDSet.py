@@ -0,0 +1,231 @@
+############################################################################
+#    Copyright (C) 2008 by Michael Goerz                                   #
+#    http://www.physik.fu-berlin.de/~goerz                                 #
+#                                                                          #
+#    This program is free software; you can redistribute it and#or modify  #
+#    it under the terms of the GNU General Public License as published by  #
+#    the Free Software Foundation; either version 3 of the License, or     #
+#    (at your option) any later version.                                   #
+#                                                                          #
+#    This program is distributed in the hope that it will be useful,       #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of        #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         #
+#    GNU General Public License for more details.                          #
+#                                                                          #
+#    You should have received a copy of the GNU General Public License     #
+#    along with this program; if not, write to the                         #
+#    Free Software Foundation, Inc.,                                       #
+#    59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.             #
+############################################################################
+
+""" This module contains the UIDSet class, a compact representation of
+    a set of UIDs as a sorted list of ranges. It is used as the result of
+    searches on servers that support ESEARCH (RFC 4731), where the server
+    returns the matching UIDs as an IMAP sequence set like '1:500,502,510:900'
+"""
+
+from bisect import bisect_right
+
+
+class UIDSet(object):
+    """ An immutable, sorted set of UIDs, stored as a list of inclusive
+        (start, stop) ranges. For the typical mailbox, where most UIDs are
+        consecutive, this takes a few bytes instead of a list of millions
+        of integers.
+
+        UIDSet supports the read-only part of the list interface, so it can
+        be used wherever ImapMailbox.search used to return a list: len(),
+        iteration, membership tests, and indexing (including negative
+        indices) all work without expanding the ranges.
+    """
+    __slots__ = ('_ranges', '_offsets', '_count')
+
+    def __init__(self, uids=None):
+        """ Initialize the UIDSet from an iterable of integers, or from a
+            string containing an IMAP sequence set such as '1:5,7,9:12'.
+            The '*' wildcard is not allowed in the sequence set.
+        """
+        if uids is None:
+            uids = []
+        if isinstance(uids, bytes):
+            uids = uids.decode('ascii')
+        if isinstance(uids, str):
+            ranges = _ranges_from_sequence_set(uids)
+        elif isinstance(uids, UIDSet):
+            ranges = list(uids._ranges)
+        else:
+            ranges = [(int(uid), int(uid)) for uid in uids]
+        self._set_ranges(_merge_ranges(ranges))
+
+    def _set_ranges(self, ranges):
+        """ Set the list of sorted, non-overlapping ranges """
+        self._ranges = ranges
+        self._offsets = []
+        count = 0
+        for (start, stop) in self._ranges:
+            self._offsets.append(count)
+            count += stop - start + 1
+        self._count = count
+
+    def sequence_set(self):
+        """ Return the UIDs as an IMAP sequence set string, e.g.
+            '1:5,7,9:12'. Return an empty string if the set is empty.
+        """
+        parts = []
+        for (start, stop) in self._ranges:
+            if start == stop:
+                parts.append("%s" % start)
+            else:
+                parts.append("%s:%s" % (start, stop))
+        return ','.join(parts)
+
+    def ranges(self):
+        """ Return a list of (start, stop) tuples of inclusive ranges """
+        return list(self._ranges)
+
+    def batches(self, size):
+        """ Iterate over UIDSets of at most 'size' UIDs each, which together
+            contain all UIDs in the set, in ascending order. Use this to
+            split up commands on large sets of messages.
+        """
+        batch = []
+        count = 0
+        for (start, stop) in self._ranges:
+            while start <= stop:
+                take = min(stop - start + 1, size - count)
+                batch.append((start, start + take - 1))
+                count += take
+                start += take
+                if count == size:
+                    result = UIDSet()
+                    result._set_ranges(batch)
+                    yield result
+                    batch = []
+                    count = 0
+        if batch:
+            result = UIDSet()
+            result._set_ranges(batch)
+            yield result
+
+    def union(self, uids):
+        """ Return a new UIDSet that contains the UIDs of this set and of
+            uids (anything accepted by the constructor)
+        """
+        result = UIDSet()
+        result._set_ranges(_merge_ranges(self._ranges + UIDSet(uids)._ranges))
+        return result
+
+    def min(self):
+        """ Return the smallest UID, or None if the set is empty """
+        if self._count == 0:
+            return None
+        return self._ranges[0][0]
+
+    def max(self):
+        """ Return the largest UID, or None if the set is empty """
+        if self._count == 0:
+            return None
+        return self._ranges[-1][1]
+
+    def __len__(self):
+        """ Return the number of UIDs in the set """
+        return self._count
+
+    def __iter__(self):
+        """ Iterate over all UIDs in ascending order """
+        for (start, stop) in self._ranges:
+            for uid in range(start, stop + 1):
+                yield uid
+
+    def __reversed__(self):
+        """ Iterate over all UIDs in descending order """
+        for (start, stop) in reversed(self._ranges):
+            for uid in range(stop, start - 1, -1):
+                yield uid
+
+    def __contains__(self, uid):
+        """ Return True if uid is in the set """
+        try:
+            uid = int(uid)
+        except (TypeError, ValueError):
+            return False
+        index = bisect_right(self._ranges, (uid, float('inf'))) - 1
+        if index < 0:
+            return False
+        (start, stop) = self._ranges[index]
+        return start <= uid <= stop
+
+    def __getitem__(self, index):
+        """ Return the UID at position index of the sorted set. Slices
+            return a list of UIDs.
+        """
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._count))]
+        if index < 0:
+            index += self._count
+        if index < 0 or index >= self._count:
+            raise IndexError("UIDSet index out of range")
+        range_index = bisect_right(self._offsets, index) - 1
+        return self._ranges[range_index][0] + index \
+               - self._offsets[range_index]
+
+    def __eq__(self, other):
+        """ UIDSets are equal to other UIDSets or lists containing the same
+            UIDs in the same order
+        """
+        if isinstance(other, UIDSet):
+            return self._ranges == other._ranges
+        if isinstance(other, (list, tuple)):
+            return (len(other) == self._count) \
+                    and all(a == b for (a, b) in zip(self, other))
+        return NotImplemented
+
+    def __ne__(self, other):
+        """ Inequality test """
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __bool__(self):
+        return self._count > 0
+
+    __nonzero__ = __bool__
+
+    def __repr__(self):
+        return "UIDSet('%s')" % self.sequence_set()
+
+    def __str__(self):
+        return self.sequence_set()
+
+
+def _ranges_from_sequence_set(sequence_set):
+    """ Convert an IMAP sequence set string into a list of (start, stop)
+        tuples. Raise ValueError if the string cannot be parsed.
+    """
+    ranges = []
+    for part in sequence_set.strip().split(','):
+        if part == '':
+            continue
+        if ':' in part:
+            (start, stop) = part.split(':', 1)
+            (start, stop) = (int(start), int(stop))
+            if start > stop:
+                (start, stop) = (stop, start)
+            ranges.append((start, stop))
+        else:
+            ranges.append((int(part), int(part)))
+    return ranges
+
+def _merge_ranges(ranges):
+    """ Sort the list of (start, stop) tuples and merge overlapping and
+        adjacent ranges
+    """
+    result = []
+    for (start, stop) in sorted(ranges):
+        if result and start <= result[-1][1] + 1:
+            if stop > result[-1][1]:
+                result[-1] = (result[-1][0], stop)
+        else:
+            result.append((start, stop))
+    return result
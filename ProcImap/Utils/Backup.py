@@ -0,0 +1,401 @@
+############################################################################
+#    Copyright (C) 2008 by Michael Goerz                                   #
+#    http://www.physik.fu-berlin.de/~goerz                                 #
+#                                                                          #
+#    This program is free software; you can redistribute it and#or modify  #
+#    it under the terms of the GNU General Public License as published by  #
+#    the Free Software Foundation; either version 3 of the License, or     #
+#    (at your option) any later version.                                   #
+#                                                                          #
+#    This program is distributed in the hope that it will be useful,       #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of        #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         #
+#    GNU General Public License for more details.                          #
+#                                                                          #
+#    You should have received a copy of the GNU General Public License     #
+#    along with this program; if not, write to the                         #
+#    Free Software Foundation, Inc.,                                       #
+#    59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.             #
+############################################################################
+
+""" This module contains the MailboxBackup class, which makes incremental
+    backups of an ImapMailbox into a local mbox file or Maildir.
+
+    Each message is stored exactly as it was downloaded, with the header
+    fields
+        X-ProcImap-UID
+        X-ProcImap-Imapflags
+        X-ProcImap-ImapInternalDate
+    added at the top (see ProcImap.Utils.Restore).
+
+    Next to the backup, in a file named like the backup with the extension
+    '.procimap.json', a sidecar records the UIDVALIDITY of the folder, the
+    highest UID that has been backed up, and the current flags, internal
+    date and Message-ID of each message. On the next run, only messages
+    with a higher UID are downloaded, and the flags of the other messages
+    are updated in the sidecar only. The flags in the X-ProcImap headers
+    are therefore the flags at the time of the first backup; the sidecar
+    has the current ones. If the UIDVALIDITY of the folder has changed,
+    all messages are checked again, but messages whose Message-ID is
+    already in the backup are skipped.
+
+    While a backup runs, the progress after each batch of messages is
+    appended to a journal (extension '.procimap.log'), and the sidecar is
+    only written at the end; the journal is then removed. If a backup is
+    interrupted, the journal is applied to the sidecar when it is read.
+    Before a batch is written, its UIDs are recorded in the journal as
+    well; if the backup was interrupted before the batch was completed,
+    the next run looks up which of these messages are in the backup
+    already (by their X-ProcImap-UID), and does not write them again.
+
+    A backup belongs to one folder: a backup whose sidecar names another
+    folder is not continued.
+"""
+
+import imaplib
+import json
+import mailbox
+import os
+import time
+
+from ProcImap.ImapFlags import REGISTRY
+from ProcImap.UIDSet import UIDSet
+
+BACKUP_BATCH_SIZE = 200 # number of messages that are downloaded with one
+                        # FETCH command; the backup is synced to disk after
+                        # each batch
+
+SIDECAR_EXTENSION = '.procimap.json'
+JOURNAL_EXTENSION = '.procimap.log'
+
+
+class MailboxBackup(object):
+    """ Incremental backup of an ImapMailbox into an mbox file or a
+        Maildir.
+
+            >>> backup = MailboxBackup(mailbox, '/backup/inbox.mbox')
+            >>> (added, updated) = backup.run()
+
+        The class specific attributes are:
+
+        path            path of the mbox file or Maildir
+        format          'mbox' or 'maildir'
+        state           dict with the contents of the sidecar file
+    """
+    def __init__(self, mailbox, path, format='mbox',
+                 batch_size=BACKUP_BATCH_SIZE):
+        """ Prepare a backup of the ImapMailbox 'mailbox' into the mbox file
+            (format='mbox') or Maildir (format='maildir') at 'path'. The
+            sidecar file is read if it exists.
+        """
+        if format not in ('mbox', 'maildir'):
+            raise ValueError("format must be 'mbox' or 'maildir'")
+        self._mailbox = mailbox
+        self.path = path
+        self.format = format
+        self.batch_size = batch_size
+        (self.state, self._pending) = _read_state(path + SIDECAR_EXTENSION)
+        if self.state['folder'] not in (None, mailbox.name):
+            raise ValueError("%s is a backup of the folder %s, not %s"
+                             % (path, self.state['folder'], mailbox.name))
+
+    def run(self):
+        """ Back up all new messages and update the flags of the messages
+            that were backed up before. Return a tuple (added, updated)
+            with the number of messages that were added to the backup, and
+            the number of messages whose flags have changed.
+        """
+        uidvalidity = self._mailbox.server.uidvalidity
+        _set_uidvalidity(self.state, uidvalidity)
+        self.state['folder'] = self._mailbox.name
+        updated = self._update_flags()
+        new_uids = [uid for uid in
+                    self._mailbox.search("UID %s:*" % (self.state['last_uid']
+                                                       + 1))
+                    if uid > self.state['last_uid']]
+        known_ids = set(self.state['message_ids'])
+        written_before = set()
+        if self._pending is not None \
+        and self._pending['uidvalidity'] == uidvalidity:
+            written_before = _backed_up_uids(self.path, self.format) \
+                             & set(self._pending['intent'])
+        self._pending = None
+        writer = _writer(self.path, self.format)
+        added = 0
+        try:
+            for batch in UIDSet(new_uids).batches(self.batch_size):
+                _append_journal(self.path + JOURNAL_EXTENSION,
+                                {'uidvalidity': uidvalidity,
+                                 'intent': list(batch)})
+                entry = {'uidvalidity': uidvalidity, 'last_uid': batch.max(),
+                         'uids': {}, 'message_ids': []}
+                added += self._backup_batch(batch, writer, known_ids, entry,
+                                            written_before)
+                writer.sync()
+                _apply_journal_entry(self.state, entry)
+                _append_journal(self.path + JOURNAL_EXTENSION, entry)
+        finally:
+            writer.close()
+        _write_sidecar(self.path + SIDECAR_EXTENSION, self.state)
+        if os.path.exists(self.path + JOURNAL_EXTENSION):
+            os.unlink(self.path + JOURNAL_EXTENSION)
+        return (added, updated)
+
+    def _update_flags(self):
+        """ Fetch the flags of all messages that have been backed up, and
+            store them in the state. Return the number of messages whose
+            flags have changed.
+        """
+        entries = self.state['uids']
+        if not entries:
+            return 0
+        updated = 0
+        table = self._mailbox.get_metadata(UIDSet(entries.keys()))
+        for record in table:
+            flags = _flagstring(record)
+            entry = entries["%s" % record.uid]
+            if entry['flags'] != flags:
+                entry['flags'] = flags
+                updated += 1
+        return updated
+
+    def _backup_batch(self, batch, writer, known_ids, entry,
+                      written_before=()):
+        """ Download the messages in the UIDSet 'batch' and write them to the
+            backup, skipping messages whose Message-ID is in the set
+            known_ids, and messages whose UID is in written_before (those
+            were written by an interrupted backup). All messages are
+            recorded with their current flags in the journal entry (a dict
+            with the keys 'uids' and 'message_ids', as in the state). Return
+            the number of messages written.
+        """
+        table = self._mailbox.get_metadata(batch)
+        message_ids = self._mailbox.get_message_ids(table.uids())
+        wanted = [uid for uid in table.uids() if uid not in written_before
+                  and message_ids.get(uid) not in known_ids]
+        bodies = {}
+        if wanted:
+            bodies = self._mailbox.fetch_parts(wanted)
+        written = 0
+        for record in table:
+            flags = _flagstring(record)
+            message_id = message_ids.get(record.uid)
+            entry['uids']["%s" % record.uid] = {
+                'flags': flags,
+                'internaldate': record.internaldate,
+                'message_id': message_id}
+            if record.uid in bodies:
+                internaldate = imaplib.Time2Internaldate(record.internaldate)
+                prefix = ("X-ProcImap-UID: %s\n" % record.uid
+                        + "X-ProcImap-Imapflags: %s\n" % flags
+                        + 'X-ProcImap-ImapInternalDate: %s\n' % internaldate)
+                writer.add(prefix.encode('ascii')
+                           + bodies[record.uid].replace(b'\r\n', b'\n'),
+                           record.internaldate)
+                written += 1
+            elif record.uid not in written_before:
+                continue
+            if message_id is not None:
+                known_ids.add(message_id)
+                entry['message_ids'].append(message_id)
+        return written
+
+def backup(mailbox, path, format='mbox', batch_size=BACKUP_BATCH_SIZE):
+    """ Make an incremental backup of mailbox into the mbox file or Maildir
+        at path (see MailboxBackup). Return a tuple (added, updated).
+    """
+    return MailboxBackup(mailbox, path, format, batch_size).run()
+
+def read_sidecar(path):
+    """ Return the sidecar data for the backup at path (the mbox file or
+        Maildir, not the sidecar file itself). See MailboxBackup.state.
+    """
+    return _read_state(path + SIDECAR_EXTENSION)[0]
+
+def _flagstring(record):
+    """ Return the flags of a MessageRecord as a string like '(\\Seen)' """
+    return REGISTRY.flagstring(record.flags)
+
+def _read_state(filename):
+    """ Return a tuple (state, pending). state is the data in the sidecar
+        file, or an empty state, with the journal of an interrupted backup
+        applied. pending is the journal entry that announced a batch that
+        was not completed (a dict with the keys 'uidvalidity' and 'intent',
+        the list of UIDs in the batch), or None.
+    """
+    state = {'folder': None, 'uidvalidity': None, 'last_uid': 0,
+             'uids': {}, 'message_ids': []}
+    if os.path.exists(filename):
+        sidecar = open(filename)
+        try:
+            state.update(json.load(sidecar))
+        finally:
+            sidecar.close()
+    pending = None
+    journal = filename[:-len(SIDECAR_EXTENSION)] + JOURNAL_EXTENSION
+    if os.path.exists(journal):
+        infile = open(journal)
+        try:
+            for line in infile:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break # incomplete last line of an interrupted backup
+                if 'intent' in entry:
+                    pending = entry
+                else:
+                    _apply_journal_entry(state, entry)
+                    pending = None
+        finally:
+            infile.close()
+    return (state, pending)
+
+def _set_uidvalidity(state, uidvalidity):
+    """ Start over with the UIDs in the state if the UIDVALIDITY has
+        changed. The Message-IDs are kept, so that messages are not backed
+        up twice.
+    """
+    if state.get('uidvalidity') != uidvalidity:
+        state['uidvalidity'] = uidvalidity
+        state['last_uid'] = 0
+        state['uids'] = {}
+
+def _apply_journal_entry(state, entry):
+    """ Add the messages of one batch (a journal entry) to the state """
+    _set_uidvalidity(state, entry['uidvalidity'])
+    state['uids'].update(entry['uids'])
+    state['message_ids'].extend(entry['message_ids'])
+    state['last_uid'] = max(state['last_uid'], entry['last_uid'])
+
+def _append_journal(filename, entry):
+    """ Append a journal entry to the journal file, and sync it to disk """
+    journal = open(filename, "a")
+    try:
+        journal.write(json.dumps(entry) + "\n")
+        journal.flush()
+        os.fsync(journal.fileno())
+    finally:
+        journal.close()
+
+def _backed_up_uids(path, format):
+    """ Return the set of UIDs in the X-ProcImap-UID header fields of the
+        messages in the backup. The field is the first line of every
+        message that was written by MailboxBackup.
+    """
+    uids = set()
+    if format == 'maildir':
+        for subdir in ('new', 'cur'):
+            directory = os.path.join(path, subdir)
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                messagefile = open(os.path.join(directory, name), 'rb')
+                try:
+                    _add_backed_up_uid(uids, messagefile.readline())
+                finally:
+                    messagefile.close()
+    elif os.path.exists(path):
+        mboxfile = open(path, 'rb')
+        try:
+            after_from_line = False
+            for line in mboxfile:
+                if after_from_line:
+                    _add_backed_up_uid(uids, line)
+                after_from_line = line.startswith(b'From ')
+        finally:
+            mboxfile.close()
+    return uids
+
+def _add_backed_up_uid(uids, line):
+    """ Add the UID to the set uids if line is an X-ProcImap-UID field """
+    if line.startswith(b'X-ProcImap-UID:'):
+        try:
+            uids.add(int(line[len(b'X-ProcImap-UID:'):]))
+        except ValueError:
+            pass
+
+def _write_sidecar(filename, state):
+    """ Write the state to the sidecar file, replacing it atomically """
+    tempname = filename + ".tmp"
+    sidecar = open(tempname, "w")
+    try:
+        json.dump(state, sidecar)
+        sidecar.flush()
+        os.fsync(sidecar.fileno())
+    finally:
+        sidecar.close()
+    getattr(os, 'replace', os.rename)(tempname, filename)
+
+def _writer(path, format):
+    """ Return a writer for the backup format """
+    if format == 'maildir':
+        return _MaildirWriter(path)
+    return _MboxWriter(path)
+
+
+class _MboxWriter(object):
+    """ Append raw messages to an mbox file. Data is only forced to disk
+        when sync() is called.
+    """
+    def __init__(self, path):
+        self._mbox = mailbox.mbox(path)
+        self._mbox.lock()
+        self._file = open(path, 'ab')
+
+    def add(self, data, internaldate):
+        """ Append the message (bytes with LF line endings) """
+        from_line = "From MAILER-DAEMON %s\n" \
+                    % time.asctime(time.gmtime(internaldate))
+        if not data.endswith(b'\n'):
+            data += b'\n'
+        self._file.write(from_line.encode('ascii')
+                         + data.replace(b'\nFrom ', b'\n>From ') + b'\n')
+
+    def sync(self):
+        """ Force the data written so far to disk """
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        """ Sync and close the file """
+        self.sync()
+        self._file.close()
+        self._mbox.unlock()
+        self._mbox.close()
+
+
+class _MaildirWriter(object):
+    """ Add raw messages to a Maildir. The new files are only forced to
+        disk when sync() is called.
+    """
+    def __init__(self, path):
+        self._maildir = mailbox.Maildir(path, factory=None, create=True)
+        self._path = path
+        self._unsynced = []
+
+    def add(self, data, internaldate):
+        """ Add the message (bytes with LF line endings) """
+        key = self._maildir.add(data)
+        filename = os.path.join(self._path, 'new', key)
+        os.utime(filename, (internaldate, internaldate))
+        self._unsynced.append(filename)
+
+    def sync(self):
+        """ Force the files added since the last sync to disk """
+        for filename in self._unsynced:
+            messagefile = open(filename, 'rb')
+            try:
+                os.fsync(messagefile.fileno())
+            finally:
+                messagefile.close()
+        if self._unsynced:
+            directory = os.open(os.path.join(self._path, 'new'), os.O_RDONLY)
+            try:
+                os.fsync(directory)
+            finally:
+                os.close(directory)
+        self._unsynced = []
+
+    def close(self):
+        """ Sync all files """
+        self.sync()
@@ -0,0 +1,234 @@
+############################################################################
+#    Copyright (C) 2008 by Michael Goerz                                   #
+#    http://www.physik.fu-berlin.de/~goerz                                 #
+#                                                                          #
+#    This program is free software; you can redistribute it and#or modify  #
+#    it under the terms of the GNU General Public License as published by  #
+#    the Free Software Foundation; either version 3 of the License, or     #
+#    (at your option) any later version.                                   #
+#                                                                          #
+#    This program is distributed in the hope that it will be useful,       #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of        #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         #
+#    GNU General Public License for more details.                          #
+#                                                                          #
+#    You should have received a copy of the GNU General Public License     #
+#    along with this program; if not, write to the                         #
+#    Free Software Foundation, Inc.,                                       #
+#    59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.             #
+############################################################################
+
+""" This module decodes and normalizes the From, Date and Subject header
+    fields of many messages at once, for listings and notifications.
+
+        >>> headers = normalize_headers(mailbox, mailbox.get_metadata())
+        >>> for (uid, name, address, date, subject) in headers:
+        ...     print(uid, name or address, time.ctime(date), subject)
+
+    The header fields of all messages are downloaded with one FETCH command
+    per FETCH_BATCH_SIZE messages, and stored column-wise in a HeaderTable.
+
+    RFC 2047 encoded-words (=?charset?encoding?text?=) are decoded one by
+    one, so that a header field that mixes several charsets, or encoded and
+    plain text, is decoded correctly. The decoded text of the last
+    HEADER_CACHE_SIZE encoded-words is cached: in mailing-list traffic, the
+    same encoded sender names and subject prefixes occur over and over.
+"""
+
+import base64
+import binascii
+import email.utils
+import quopri
+import re
+from array import array
+from bisect import bisect_left
+
+from ProcImap.ImapMetadata import MetadataTable
+from ProcImap.Utils.Processing import ListCache
+
+HEADER_CACHE_SIZE = 10000 # number of encoded-words for which the decoded
+                          # text is kept
+
+HEADER_FIELDS = 'HEADER.FIELDS (FROM DATE SUBJECT)'
+
+_ENCODED_WORD_PATTERN = re.compile(r'=\?([^?\s]+)\?([bBqQ])\?([^?\s]*)\?=')
+_FOLDING_PATTERN = re.compile(br'\r?\n(?=[ \t])')
+
+_WORD_CACHE = ListCache(HEADER_CACHE_SIZE)
+
+
+class HeaderTable(object):
+    """ The decoded From, Date and Subject header fields of many messages,
+        stored column-wise and sorted by UID.
+
+        The columns are the attributes (lists, except for dates)
+        uids            UIDs of the messages
+        names           display names of the senders ('' if there is none)
+        addresses       email addresses of the senders
+        dates           dates in seconds since the epoch (0 if the message
+                        has no valid Date), as an array
+        subjects        subjects ('' if there is none)
+        Names and subjects are unicode strings.
+
+        table[uid] is a tuple (name, address, date, subject); iterating
+        over the table yields tuples (uid, name, address, date, subject).
+    """
+    def __init__(self):
+        """ Create an empty table """
+        self.uids = []
+        self.names = []
+        self.addresses = []
+        self.dates = array('q')
+        self.subjects = []
+
+    def append(self, uid, name, address, date, subject):
+        """ Add a row. UIDs must be appended in ascending order. """
+        self.uids.append(int(uid))
+        self.names.append(name)
+        self.addresses.append(address)
+        self.dates.append(int(date))
+        self.subjects.append(subject)
+
+    def append_fields(self, uid, fields):
+        """ Decode the raw header fields of a message (bytes as returned by
+            FETCH BODY[HEADER.FIELDS (...)], or a dict of field values) and
+            add them as a row
+        """
+        if not isinstance(fields, dict):
+            fields = header_fields(fields)
+        (name, address) = email.utils.parseaddr(
+                                           _text(fields.get('from', b'')))
+        self.append(uid, decode_header_value(name), address,
+                    parse_date(fields.get('date')),
+                    decode_header_value(fields.get('subject', b'')))
+
+    def _index(self, uid):
+        """ Return the row of the UID, or raise KeyError """
+        index = bisect_left(self.uids, uid)
+        if index < len(self.uids) and self.uids[index] == uid:
+            return index
+        raise KeyError("No UID %s in HeaderTable" % uid)
+
+    def __getitem__(self, uid):
+        """ Return the tuple (name, address, date, subject) for the UID """
+        index = self._index(int(uid))
+        return (self.names[index], self.addresses[index], self.dates[index],
+                self.subjects[index])
+
+    def __contains__(self, uid):
+        try:
+            self._index(int(uid))
+            return True
+        except (KeyError, TypeError, ValueError):
+            return False
+
+    def __len__(self):
+        return len(self.uids)
+
+    def __iter__(self):
+        """ Iterate over (uid, name, address, date, subject) tuples, in the
+            order of the UIDs
+        """
+        return iter(zip(self.uids, self.names, self.addresses, self.dates,
+                        self.subjects))
+
+    def __repr__(self):
+        return "<HeaderTable of %s messages>" % len(self)
+
+
+def normalize_headers(mailbox, uids=None):
+    """ Return a HeaderTable with the decoded From, Date and Subject header
+        fields of the messages in the ImapMailbox with the given UIDs (a
+        list, UIDSet, or a MetadataTable as returned by
+        mailbox.get_metadata(); default is all messages in the mailbox).
+        UIDs of messages that do not exist are left out.
+    """
+    if uids is None:
+        uids = mailbox.search('ALL')
+    elif isinstance(uids, MetadataTable):
+        uids = uids.uids()
+    table = HeaderTable()
+    headers = mailbox.fetch_parts(uids, HEADER_FIELDS)
+    for uid in sorted(headers.keys()):
+        table.append_fields(uid, headers[uid])
+    return table
+
+def header_fields(data):
+    """ Return a dict that maps the lowercase names of the header fields in
+        the raw header 'data' (bytes) to their unfolded values (bytes). Of
+        fields that occur several times, the first one is kept.
+    """
+    fields = {}
+    for line in _FOLDING_PATTERN.sub(b'', data).splitlines():
+        (name, colon, value) = line.partition(b':')
+        if colon:
+            name = name.strip().lower().decode('ascii', 'replace')
+            fields.setdefault(name, value.strip())
+    return fields
+
+def decode_header_value(value):
+    """ Return the header field value (bytes or string) as a unicode string,
+        with all encoded-words decoded. Whitespace between two adjacent
+        encoded-words is removed, as RFC 2047 requires. Undecodable
+        encoded-words are left as they are.
+    """
+    value = _text(value)
+    if '=?' not in value:
+        return value
+    pieces = []
+    position = 0
+    for match in _ENCODED_WORD_PATTERN.finditer(value):
+        between = value[position:match.start()]
+        if position == 0 or between.strip():
+            pieces.append(between)
+        word = match.group(0)
+        text = _WORD_CACHE.get(word)
+        if text is None:
+            text = _decode_word(match)
+            _WORD_CACHE.put(word, text)
+        pieces.append(text)
+        position = match.end()
+    pieces.append(value[position:])
+    return u''.join(pieces)
+
+def parse_date(value):
+    """ Return the Date header field value (bytes or string) in seconds
+        since the epoch, or 0 if it cannot be parsed
+    """
+    if not value:
+        return 0
+    datetuple = email.utils.parsedate_tz(_text(value))
+    if datetuple is None:
+        return 0
+    try:
+        return int(email.utils.mktime_tz(datetuple))
+    except (OverflowError, ValueError, TypeError):
+        return 0
+
+def _text(value):
+    """ Return the raw header field value as a unicode string. Bytes are
+        decoded as UTF-8, or as Latin-1 if they are not valid UTF-8.
+    """
+    if isinstance(value, bytes):
+        try:
+            return value.decode('utf-8')
+        except UnicodeDecodeError:
+            return value.decode('latin_1')
+    return value
+
+def _decode_word(match):
+    """ Return the decoded text of the encoded-word in the match object """
+    (charset, encoding, text) = match.groups()
+    charset = charset.split('*', 1)[0] # remove RFC 2231 language
+    data = text.encode('ascii', 'replace')
+    if encoding in 'bB':
+        try:
+            data = base64.b64decode(data + b'=' * (-len(data) % 4))
+        except (binascii.Error, ValueError):
+            return match.group(0)
+    else:
+        data = quopri.decodestring(data, header=True)
+    try:
+        return data.decode(charset, 'replace')
+    except LookupError:
+        return data.decode('latin_1')
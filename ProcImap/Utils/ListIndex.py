@@ -0,0 +1,252 @@
+############################################################################
+#    Copyright (C) 2008 by Michael Goerz                                   #
+#    http://www.physik.fu-berlin.de/~goerz                                 #
+#                                                                          #
+#    This program is free software; you can redistribute it and#or modify  #
+#    it under the terms of the GNU General Public License as published by  #
+#    the Free Software Foundation; either version 3 of the License, or     #
+#    (at your option) any later version.                                   #
+#                                                                          #
+#    This program is distributed in the hope that it will be useful,       #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of        #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         #
+#    GNU General Public License for more details.                          #
+#                                                                          #
+#    You should have received a copy of the GNU General Public License     #
+#    along with this program; if not, write to the                         #
+#    Free Software Foundation, Inc.,                                       #
+#    59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.             #
+############################################################################
+
+""" This module contains the ListIndex class, a compiled binary hash table
+    for the list files in ProcImap.Utils.Processing, which is stored next to
+    the list file (with the extension '.idx') and used through mmap.
+    Opening an index does not read the list, and all processes that use the
+    same index share the pages of the file.
+
+        >>> index = open_index('replacements.lst', replacements=True)
+        >>> index.get('noreply@couchsurfing.com')
+        'Couchsurfing <noreply@couchsurfing.com>'
+
+    The index records the modification time, size and inode of the list
+    file it was compiled from. open_index compiles the index again if the
+    list file has changed.
+
+    File format (all integers little-endian):
+        header      magic (8 bytes), mtime (double), size, inode (uint64),
+                    number of entries, number of slots, length of the
+                    longest key in bytes (uint32)
+        slots       uint32 per slot: 0 for an empty slot, otherwise 1 + the
+                    offset of the record in the record area
+        records     key length, value length (uint32), key, value (UTF-8)
+    The slot of a key is its CRC-32 modulo the number of slots (a power of
+    two), with linear probing.
+"""
+
+import mmap
+import os
+import struct
+import tempfile
+import zlib
+
+INDEX_EXTENSION = '.idx'
+
+_ADDRESS_MAGIC = b'PIMADDR1'
+_REPLACEMENT_MAGIC = b'PIMREPL1'
+_HEADER = struct.Struct('<8sdQQIII')
+_SLOT = struct.Struct('<I')
+_RECORD = struct.Struct('<II')
+
+
+class ListIndex(object):
+    """ Read-only hash table of strings (keys) with a string value each,
+        backed by an mmap of an index file.
+
+        Entries added with add() are kept in memory only; they are in the
+        index file once it is compiled again.
+    """
+    def __init__(self, indexfile):
+        """ Open the index file. Raise ValueError if it is not an index. """
+        infile = open(indexfile, 'rb')
+        try:
+            self._map = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            infile.close()
+        if len(self._map) < _HEADER.size:
+            raise ValueError("%s is not a list index" % indexfile)
+        (magic, mtime, size, inode, self._count, self._slots,
+         self.maxlength) = _HEADER.unpack_from(self._map, 0)
+        if magic not in (_ADDRESS_MAGIC, _REPLACEMENT_MAGIC):
+            raise ValueError("%s is not a list index" % indexfile)
+        self.replacements = (magic == _REPLACEMENT_MAGIC)
+        self.signature = (mtime, size, inode)
+        self.filename = indexfile
+        self._records = _HEADER.size + _SLOT.size * self._slots
+        self._added = {}
+
+    def _lookup(self, key):
+        """ Return the value for the key (bytes) in the index file as
+            bytes, or None
+        """
+        data = self._map
+        mask = self._slots - 1
+        slot = zlib.crc32(key) & mask
+        while True:
+            (offset,) = _SLOT.unpack_from(data, _HEADER.size
+                                                + _SLOT.size * slot)
+            if offset == 0:
+                return None
+            position = self._records + offset - 1
+            (keylength, valuelength) = _RECORD.unpack_from(data, position)
+            position += _RECORD.size
+            if keylength == len(key) \
+            and data[position:position + keylength] == key:
+                position += keylength
+                return data[position:position + valuelength]
+            slot = (slot + 1) & mask
+
+    def get(self, key, default=None):
+        """ Return the value for key, or default if the key is not in the
+            index
+        """
+        if key in self._added:
+            return self._added[key]
+        value = self._lookup(key.encode('utf-8'))
+        if value is None:
+            return default
+        return value.decode('utf-8')
+
+    def search(self, text):
+        """ Return a key that occurs in text, or None. All substrings of
+            text up to the length of the longest key are looked up.
+        """
+        for key in self._added:
+            if key in text:
+                return key
+        encoded = text.encode('utf-8')
+        maxlength = self.maxlength
+        for start in range(len(encoded)):
+            for end in range(start + 1,
+                             min(len(encoded), start + maxlength) + 1):
+                if self._lookup(encoded[start:end]) is not None:
+                    return encoded[start:end].decode('utf-8', 'replace')
+        return None
+
+    def add(self, key, value=''):
+        """ Add an entry in memory """
+        self._added[key] = value
+
+    def close(self):
+        """ Close the mmap """
+        self._map.close()
+
+    def __setitem__(self, key, value):
+        self.add(key, value)
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        """ Return the number of entries in the index file """
+        return self._count
+
+    def __repr__(self):
+        return "<ListIndex %s with %s entries>" % (self.filename, self._count)
+
+
+def compile_index(filename, replacements=False, indexfile=None):
+    """ Compile the list file filename into an index, and return the name
+        of the index file (by default, filename with the extension '.idx'
+        appended). If replacements is True, the file contains lines
+        'original :: replacement', otherwise one entry per line. Later lines
+        replace earlier lines with the same key. The index file is replaced
+        atomically, and has the same permissions as the list file.
+        Raise IOError/OSError if the index file cannot be written.
+    """
+    if indexfile is None:
+        indexfile = filename + INDEX_EXTENSION
+    stat = os.stat(filename)
+    entries = {}
+    order = []
+    infile = open(filename)
+    try:
+        for line in infile:
+            line = line.strip()
+            if not line:
+                continue
+            value = ''
+            if replacements:
+                (line, value) = line.split("::", 1)
+                (line, value) = (line.strip(), value.strip())
+            key = line.encode('utf-8')
+            if key not in entries:
+                order.append(key)
+            entries[key] = value.encode('utf-8')
+    finally:
+        infile.close()
+    slots = 8
+    while slots < 2 * len(order):
+        slots *= 2
+    table = [0] * slots
+    records = []
+    offset = 0
+    maxlength = 0
+    for key in order:
+        slot = zlib.crc32(key) & (slots - 1)
+        while table[slot]:
+            slot = (slot + 1) & (slots - 1)
+        table[slot] = offset + 1
+        record = _RECORD.pack(len(key), len(entries[key])) + key + entries[key]
+        records.append(record)
+        offset += len(record)
+        maxlength = max(maxlength, len(key))
+    magic = _ADDRESS_MAGIC
+    if replacements:
+        magic = _REPLACEMENT_MAGIC
+    # a unique temporary file, so that processes that compile the same
+    # index at the same time do not write into each other's file
+    (handle, tempname) = tempfile.mkstemp(
+                                   dir=os.path.dirname(indexfile) or '.',
+                                   prefix=os.path.basename(indexfile) + '.',
+                                   suffix='.tmp')
+    try:
+        outfile = os.fdopen(handle, 'wb')
+        try:
+            outfile.write(_HEADER.pack(magic, stat.st_mtime, stat.st_size,
+                                       stat.st_ino, len(order), slots,
+                                       maxlength))
+            outfile.write(struct.pack('<%sI' % slots, *table))
+            outfile.write(b''.join(records))
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        finally:
+            outfile.close()
+        os.chmod(tempname, stat.st_mode & 0o666)
+        getattr(os, 'replace', os.rename)(tempname, indexfile)
+    except BaseException:
+        os.unlink(tempname)
+        raise
+    return indexfile
+
+def open_index(filename, replacements=False):
+    """ Return a ListIndex for the list file filename, compiling the index
+        first if it does not exist, or if the list file has changed since it
+        was compiled. Raise IOError/OSError if the index has to be compiled
+        but cannot be written (e.g. because the directory is read-only).
+    """
+    indexfile = filename + INDEX_EXTENSION
+    stat = os.stat(filename)
+    signature = (stat.st_mtime, stat.st_size, stat.st_ino)
+    if os.path.exists(indexfile):
+        index = ListIndex(indexfile)
+        if index.signature == signature \
+        and index.replacements == replacements:
+            return index
+        index.close()
+    return ListIndex(compile_index(filename, replacements, indexfile))
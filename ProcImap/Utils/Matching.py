@@ -0,0 +1,325 @@
+############################################################################
+#    Copyright (C) 2008 by Michael Goerz                                   #
+#    http://www.physik.fu-berlin.de/~goerz                                 #
+#                                                                          #
+#    This program is free software; you can redistribute it and#or modify  #
+#    it under the terms of the GNU General Public License as published by  #
+#    the Free Software Foundation; either version 3 of the License, or     #
+#    (at your option) any later version.                                   #
+#                                                                          #
+#    This program is distributed in the hope that it will be useful,       #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of        #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         #
+#    GNU General Public License for more details.                          #
+#                                                                          #
+#    You should have received a copy of the GNU General Public License     #
+#    along with this program; if not, write to the                         #
+#    Free Software Foundation, Inc.,                                       #
+#    59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.             #
+############################################################################
+
+""" This module contains matchers that check a string against a large list
+    of entries at once, as used by the list files in
+    ProcImap.Utils.Processing.
+
+    SubstringMatcher finds out whether any of the entries occurs in a string
+    (Aho-Corasick automaton). The time for a lookup depends only on the
+    length of the string, not on the number of entries.
+
+        >>> matcher = SubstringMatcher(['@gmail.com', 'spam'])
+        >>> matcher.search('someone@gmail.com')
+        '@gmail.com'
+
+    RegexMatcher combines a list of regular expressions into a few large
+    alternations, and reports which of the expressions matched first.
+
+        >>> matcher = RegexMatcher([r'.*@spam\.com', r'.*\.ru$'])
+        >>> matcher.match('someone@mail.ru')
+        1
+
+    DomainMatcher understands the structure of email addresses: its entries
+    are addresses, and domains that match either exactly or including all
+    their subdomains.
+
+        >>> matcher = DomainMatcher(['@gmail.com', 'example.org'])
+        >>> matcher.search('Someone <someone@lists.example.org>')
+        'example.org'
+        >>> matcher.search('someone@gmail.com.evil') is None
+        True
+"""
+
+import re
+from email.utils import parseaddr
+
+MAX_GROUPS = 99 # maximum number of groups in a combined regular expression
+
+PENDING_LIMIT = 64 # number of patterns added to a SubstringMatcher after
+                   # which the automaton is extended
+
+# keys in the nodes of the DomainMatcher trie (labels are always strings)
+_EXACT = 0
+_SUBDOMAINS = 1
+
+# Expressions that cannot be combined with others without changing their
+# meaning: backreferences to numbered or named groups, conditional
+# expressions, and global inline flags
+_INCOMPATIBLE_PATTERN = re.compile(r'\\[1-9]|\(\?P=|\(\?\(|\(\?[aiLmsux]+\)')
+
+
+class SubstringMatcher(object):
+    """ Aho-Corasick automaton for a list of strings (patterns). The
+        automaton is built once; search() then scans the lookup string a
+        single time. Empty patterns are ignored.
+
+        Patterns that are added later are checked one by one, until there
+        are more than PENDING_LIMIT of them; then they are inserted into
+        the automaton.
+    """
+    def __init__(self, patterns):
+        """ Build the automaton for the iterable of strings 'patterns' """
+        self.patterns = []
+        self._goto = [{}]     # state -> {character: next state}
+        self._fail = [0]      # state -> fallback state
+        self._output = [-1]   # state -> index of a pattern ending here
+        self._pending = []    # patterns that are not in the automaton yet
+        for pattern in patterns:
+            if pattern:
+                self._insert(pattern)
+        self._link()
+
+    def add(self, pattern):
+        """ Add a pattern """
+        if not pattern:
+            return
+        self._pending.append(pattern)
+        if len(self._pending) > PENDING_LIMIT:
+            for pending in self._pending:
+                self._insert(pending)
+            self._pending = []
+            self._link()
+
+    def _insert(self, pattern):
+        """ Add the states for pattern to the trie """
+        goto = self._goto
+        state = 0
+        for character in pattern:
+            try:
+                state = goto[state][character]
+            except KeyError:
+                goto.append({})
+                self._fail.append(0)
+                self._output.append(-1)
+                goto[state][character] = len(goto) - 1
+                state = len(goto) - 1
+        if self._output[state] < 0:
+            self._output[state] = len(self.patterns)
+        self.patterns.append(pattern)
+
+    def _link(self):
+        """ Compute the fail links in breadth-first order. The output of
+            each state is extended with the output of its fail state, so
+            that every state knows whether some pattern ends there.
+        """
+        goto = self._goto
+        fail = self._fail
+        output = self._output
+        queue = list(goto[0].values())
+        position = 0
+        while position < len(queue):
+            state = queue[position]
+            position += 1
+            for (character, target) in goto[state].items():
+                queue.append(target)
+                fallback = fail[state]
+                while fallback and character not in goto[fallback]:
+                    fallback = fail[fallback]
+                fail[target] = goto[fallback].get(character, 0)
+                if output[target] < 0:
+                    output[target] = output[fail[target]]
+
+    def search(self, text):
+        """ Return a pattern that occurs in text, or None. If several
+            patterns occur, the one that ends first in text is returned.
+        """
+        goto = self._goto
+        fail = self._fail
+        output = self._output
+        state = 0
+        for character in text:
+            while state and character not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(character, 0)
+            if output[state] >= 0:
+                return self.patterns[output[state]]
+        for pattern in self._pending:
+            if pattern in text:
+                return pattern
+        return None
+
+    def __len__(self):
+        """ Return the number of patterns """
+        return len(self.patterns) + len(self._pending)
+
+    def __repr__(self):
+        return "<SubstringMatcher for %s patterns>" % len(self)
+
+
+class RegexMatcher(object):
+    """ Matcher for a list of regular expressions (patterns), which finds
+        the first pattern in the list that matches at the beginning of a
+        string, as re.match does.
+
+        Consecutive patterns are combined into a single alternation
+        (?P<_0>pattern0)|(?P<_1>pattern1)|... Since the alternatives are
+        tried from left to right, the result is the same as trying each
+        pattern in turn. Patterns that would behave differently inside an
+        alternation (backreferences, named groups, global inline flags)
+        are compiled on their own. Empty patterns are ignored.
+    """
+    def __init__(self, patterns):
+        """ Compile the iterable of strings 'patterns'. Raise re.error if
+            one of them is not a valid regular expression.
+        """
+        self.patterns = []
+        self._regexes = [] # list of (compiled regex, index or None)
+        self._pieces = []  # named groups of the last alternation
+        self._groups = 0   # number of groups in the last alternation
+        self._open = False # True if the last alternation can be extended
+        for pattern in patterns:
+            self._append(pattern)
+        self._flush()
+
+    def add(self, pattern):
+        """ Add a pattern at the end of the list. Only the last
+            alternation is compiled again.
+        """
+        self._append(pattern)
+        self._flush()
+
+    def _append(self, pattern):
+        """ Add a pattern to the last alternation, or as a separate
+            expression, without compiling the alternation
+        """
+        index = len(self.patterns)
+        self.patterns.append(pattern)
+        if not pattern:
+            return
+        regex = re.compile(pattern)
+        if regex.groupindex or _INCOMPATIBLE_PATTERN.search(pattern):
+            self._close()
+            self._regexes.append((regex, index))
+            return
+        if self._groups + regex.groups + 1 > MAX_GROUPS:
+            self._close()
+        self._pieces.append("(?P<_%s>%s)" % (index, pattern))
+        self._groups += regex.groups + 1
+
+    def _flush(self):
+        """ Compile the last alternation, replacing the previously compiled
+            version
+        """
+        if not self._pieces:
+            return
+        regex = re.compile('|'.join(self._pieces))
+        if self._open:
+            self._regexes[-1] = (regex, None)
+        else:
+            self._regexes.append((regex, None))
+            self._open = True
+
+    def _close(self):
+        """ Compile the last alternation and start a new one """
+        self._flush()
+        self._pieces = []
+        self._groups = 0
+        self._open = False
+
+    def match(self, text):
+        """ Return the index of the first pattern that matches at the
+            beginning of text, or None
+        """
+        for (regex, index) in self._regexes:
+            match = regex.match(text)
+            if match is not None:
+                if index is None:
+                    return int(match.lastgroup[1:])
+                return index
+        return None
+
+    def __len__(self):
+        """ Return the number of patterns """
+        return len(self.patterns)
+
+    def __repr__(self):
+        return "<RegexMatcher for %s patterns in %s expressions>" \
+               % (len(self.patterns), len(self._regexes))
+
+
+class DomainMatcher(object):
+    """ Matcher for a list of email addresses and domains (entries):
+
+        user@example.com    matches this address only
+        @example.com        matches all addresses at example.com, but not
+                            at its subdomains
+        example.com         matches all addresses at example.com and at
+        .example.com        any of its subdomains
+
+        Addresses are kept in a dict, domains in a trie of their labels in
+        reverse order (com -> example -> ...), so that a lookup takes one
+        dict access per label of the domain. Lookups and entries are
+        normalized with email.utils.parseaddr and converted to lowercase.
+    """
+    def __init__(self, entries):
+        """ Build the matcher for the iterable of strings 'entries' """
+        self.entries = []
+        self._addresses = {} # normalized address -> entry
+        self._trie = {}      # label -> node (dict with the same structure)
+        for entry in entries:
+            self.add(entry)
+
+    def add(self, entry):
+        """ Add an entry. Empty entries are ignored. """
+        entry = entry.strip()
+        if not entry:
+            return
+        self.entries.append(entry)
+        key = entry.lower()
+        if '@' in key[1:]:
+            address = parseaddr(key)[1] or key
+            self._addresses.setdefault(address, entry)
+            return
+        if key.startswith('@'):
+            marker = _EXACT
+        else:
+            marker = _SUBDOMAINS
+        node = self._trie
+        for label in reversed(key.strip('@.').split('.')):
+            node = node.setdefault(label, {})
+        node.setdefault(marker, entry)
+
+    def search(self, text):
+        """ Return the entry that matches the email address in text (which
+            may also be a header value like 'Name <user@example.com>'), or
+            None
+        """
+        address = parseaddr(text)[1].lower()
+        if '@' not in address:
+            return None
+        if address in self._addresses:
+            return self._addresses[address]
+        domain = address.rsplit('@', 1)[1].rstrip('.')
+        node = self._trie
+        for label in reversed(domain.split('.')):
+            node = node.get(label)
+            if node is None:
+                return None
+            if _SUBDOMAINS in node:
+                return node[_SUBDOMAINS]
+        return node.get(_EXACT)
+
+    def __len__(self):
+        """ Return the number of entries """
+        return len(self.entries)
+
+    def __repr__(self):
+        return "<DomainMatcher for %s entries>" % len(self.entries)
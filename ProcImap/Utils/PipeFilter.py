@@ -0,0 +1,395 @@
+############################################################################
+#    Copyright (C) 2008 by Michael Goerz                                   #
+#    http://www.physik.fu-berlin.de/~goerz                                 #
+#                                                                          #
+#    This program is free software; you can redistribute it and#or modify  #
+#    it under the terms of the GNU General Public License as published by  #
+#    the Free Software Foundation; either version 3 of the License, or     #
+#    (at your option) any later version.                                   #
+#                                                                          #
+#    This program is distributed in the hope that it will be useful,       #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of        #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         #
+#    GNU General Public License for more details.                          #
+#                                                                          #
+#    You should have received a copy of the GNU General Public License     #
+#    along with this program; if not, write to the                         #
+#    Free Software Foundation, Inc.,                                       #
+#    59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.             #
+############################################################################
+
+""" This module contains the FilterPool class, which pipes many messages
+    through a filter program (e.g. for decryption), using several filter
+    processes in parallel, with a timeout for each message.
+
+    A filter that is started once and then handles many messages has to
+    speak a simple framing protocol on its stdin and stdout. Each message
+    is sent as
+        <length in bytes>\\n<message>
+    and the filter answers with
+        OK <length in bytes>\\n<filtered message>
+    or, if the message cannot be filtered, with
+        ERR <length in bytes>\\n<error message>
+    A filter written in Python can use the serve() function of this module
+    for this:
+
+        #!/usr/bin/env python
+        from ProcImap.Utils.PipeFilter import serve
+        serve(lambda message: message.replace(b'foo', b'bar'))
+
+    Any other program can be used with framed=False; it is then started
+    once for every message, which receives the message on stdin and
+    writes the filtered message to stdout (as in
+    ProcImap.Utils.Processing.pipe_message).
+
+    The filter processes are only used through select() on their pipes,
+    so that a filter that stalls or does not read its input never blocks
+    the caller for longer than the timeout. This requires a POSIX system.
+"""
+
+import os
+import select
+import signal
+import subprocess
+import sys
+import threading
+import time
+from multiprocessing import cpu_count
+
+if sys.version_info > (3, 0):
+    import queue
+    from io import BytesIO
+    from email.generator import BytesGenerator
+    # Popen arguments that start a child in a new session (process group);
+    # preexec_fn is not safe while other threads are running
+    _NEW_SESSION = {'start_new_session': True}
+else:
+    import Queue as queue
+    from cStringIO import StringIO as BytesIO
+    from email.generator import Generator as BytesGenerator
+    _NEW_SESSION = {'preexec_fn': os.setsid}
+
+from ProcImap.ImapMessage import ImapMessage
+
+FILTER_TIMEOUT = 60 # seconds that a filter may take for a single message
+
+EXIT_POLL_INTERVAL = 0.01 # seconds between checks whether a filter that has
+                          # closed its output has exited
+
+_CHUNK_SIZE = getattr(select, 'PIPE_BUF', 512) # bytes that can be written
+                                               # to a writable pipe without
+                                               # blocking
+
+
+class FilterError(Exception):
+    """ Raised if a filter process reports an error, exits unexpectedly, or
+        sends a response that does not follow the framing protocol
+    """
+    pass
+
+class FilterTimeoutError(FilterError):
+    """ Raised if a filter process does not finish a message in time. The
+        process is killed.
+    """
+    pass
+
+
+class _FilterProcess(object):
+    """ A filter program running as a child process, which is talked to
+        over non-blocking pipes with a deadline
+    """
+    def __init__(self, command):
+        self.command = command
+        self._process = subprocess.Popen(command, shell=True,
+                        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                        close_fds=True, **_NEW_SESSION)
+        self._buffer = bytearray()
+
+    def request(self, data, timeout):
+        """ Send data as one frame of the framing protocol and return the
+            payload of the answer. Raise FilterError or FilterTimeoutError.
+        """
+        deadline = time.time() + timeout
+        self._write(("%s\n" % len(data)).encode('ascii'), deadline)
+        self._write(data, deadline)
+        line = self._readline(deadline)
+        try:
+            (status, length) = line.split()
+            length = int(length)
+        except ValueError:
+            raise FilterError("Invalid response from filter %s: %r"
+                              % (self.command, line))
+        payload = self._read(length, deadline)
+        if status != b'OK':
+            raise FilterError("Filter %s: %s" % (self.command,
+                              payload.decode('utf-8', 'replace')))
+        return payload
+
+    def communicate(self, data, timeout):
+        """ Write data to the stdin of the process and close it, while
+            reading everything from stdout until the process closes it and
+            exits. Return the output. Raise FilterTimeoutError if this takes
+            longer than timeout seconds.
+        """
+        deadline = time.time() + timeout
+        stdin = self._process.stdin.fileno()
+        stdout = self._process.stdout.fileno()
+        view = memoryview(data)
+        if not view:
+            self._process.stdin.close()
+        result = []
+        while True:
+            writers = []
+            if view:
+                writers = [stdin]
+            (readable, writable) = self._wait([stdout], writers, deadline)
+            if writable:
+                try:
+                    written = os.write(stdin, view[:_CHUNK_SIZE])
+                except OSError:
+                    # the filter has closed its stdin; take what it writes
+                    written = len(view)
+                view = view[written:]
+                if not view:
+                    self._process.stdin.close()
+            if readable:
+                chunk = os.read(stdout, 65536)
+                if not chunk:
+                    break
+                result.append(chunk)
+        while self._process.poll() is None:
+            if time.time() > deadline:
+                raise FilterTimeoutError("Filter %s timed out" % self.command)
+            time.sleep(EXIT_POLL_INTERVAL)
+        return b''.join(result)
+
+    def _wait(self, readers, writers, deadline):
+        """ Wait until one of the file descriptors is ready. Raise
+            FilterTimeoutError if the deadline has passed.
+        """
+        remaining = deadline - time.time()
+        if remaining > 0:
+            (readable, writable, broken) = select.select(readers, writers,
+                                                         [], remaining)
+            if readable or writable:
+                return (readable, writable)
+        raise FilterTimeoutError("Filter %s timed out" % self.command)
+
+    def _write(self, data, deadline):
+        """ Write all of data to the stdin of the process """
+        stdin = self._process.stdin.fileno()
+        view = memoryview(data)
+        while view:
+            self._wait([], [stdin], deadline)
+            try:
+                written = os.write(stdin, view[:_CHUNK_SIZE])
+            except OSError:
+                raise FilterError("Filter %s exited" % self.command)
+            view = view[written:]
+
+    def _fill(self, deadline):
+        """ Read the available output of the process into the buffer """
+        stdout = self._process.stdout.fileno()
+        self._wait([stdout], [], deadline)
+        chunk = os.read(stdout, 65536)
+        if not chunk:
+            raise FilterError("Filter %s exited" % self.command)
+        self._buffer.extend(chunk)
+
+    def _readline(self, deadline):
+        """ Return the next line of output, without the newline """
+        while b'\n' not in self._buffer:
+            self._fill(deadline)
+        end = self._buffer.index(b'\n')
+        line = bytes(self._buffer[:end])
+        del self._buffer[:end + 1]
+        return line
+
+    def _read(self, length, deadline):
+        """ Return the next length bytes of output """
+        while len(self._buffer) < length:
+            self._fill(deadline)
+        data = bytes(self._buffer[:length])
+        del self._buffer[:length]
+        return data
+
+    def close(self):
+        """ Close stdin, so that the process can exit, and wait for it """
+        try:
+            self._process.stdin.close()
+            self._process.stdout.close()
+        finally:
+            self._process.wait()
+
+    def kill(self):
+        """ Kill the process, and all processes that the shell started """
+        try:
+            os.killpg(self._process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        self.close()
+
+
+class FilterPool(object):
+    """ A pool of filter processes for piping many messages through the
+        shell command 'command'.
+
+            >>> pool = FilterPool('decrypt-filter', processes=4)
+            >>> for (message, error) in pool.filter_many(messages):
+            ...     if error is None:
+            ...         mailbox.add(message)
+            >>> pool.close()
+
+        With framed=True (the default), the pool keeps 'processes'
+        instances of the filter running, which speak the framing protocol
+        (see module documentation). With framed=False, the filter is started
+        for each message, and up to 'processes' of them run at the same
+        time. A filter process that takes longer than 'timeout' seconds
+        for one message is killed, and replaced by a new one.
+    """
+    def __init__(self, command, processes=None, timeout=FILTER_TIMEOUT,
+                 framed=True):
+        if processes is None:
+            processes = cpu_count()
+        self.command = command
+        self.processes = processes
+        self.timeout = timeout
+        self.framed = framed
+        self._idle = queue.Queue()
+        for index in range(processes):
+            if framed:
+                self._idle.put(_FilterProcess(command))
+            else:
+                self._idle.put(None)
+
+    def filter_bytes(self, data):
+        """ Pipe the raw message data (bytes) through the filter, and return
+            the output as bytes. Raise FilterError or FilterTimeoutError.
+        """
+        process = self._idle.get()
+        replacement = None # worker that is put back into the pool
+        try:
+            if not self.framed:
+                process = _FilterProcess(self.command)
+                return process.communicate(data, self.timeout)
+            if process is None:
+                # a worker that could not be started before
+                process = _FilterProcess(self.command)
+            replacement = process
+            return process.request(data, self.timeout)
+        except BaseException:
+            # the process may be in the middle of a message; replace it
+            replacement = None
+            if process is not None:
+                process.kill()
+            if self.framed:
+                replacement = _FilterProcess(self.command)
+            raise
+        finally:
+            # None makes the next request start a new worker
+            self._idle.put(replacement)
+
+    def filter(self, message):
+        """ Pipe the message through the filter, and return the result as
+            an ImapMessage, with the flags and internal date of message.
+            Message can be an ImapMessage or any other instance of
+            email.Message.Message, or bytes.
+        """
+        return filtered_message(message,
+                                self.filter_bytes(message_bytes(message)))
+
+    def filter_many(self, messages):
+        """ Pipe all messages in the list through the filter, using all
+            processes of the pool in parallel. Return a list of
+            (filtered message, error) tuples in the order of messages; error
+            is None for messages that were filtered successfully, and the
+            exception (usually a FilterError) otherwise.
+        """
+        messages = list(messages)
+        results = [None] * len(messages)
+        todo = queue.Queue()
+        for index in range(len(messages)):
+            todo.put(index)
+        def work():
+            """ Filter messages from todo until it is empty """
+            while True:
+                try:
+                    index = todo.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    results[index] = (self.filter(messages[index]), None)
+                except Exception:
+                    results[index] = (None, sys.exc_info()[1])
+        threads = [threading.Thread(target=work)
+                   for index in range(min(self.processes, len(messages)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def close(self):
+        """ Stop all filter processes """
+        for index in range(self.processes):
+            process = self._idle.get()
+            if process is not None:
+                process.close()
+
+
+def message_bytes(message):
+    """ Return the message (an instance of email.Message.Message, or
+        bytes) as bytes. For an unmodified ImapMessage, these are the
+        original bytes.
+    """
+    if isinstance(message, bytes):
+        return message
+    if isinstance(message, ImapMessage):
+        original = message.get_original()
+        if original is not None:
+            return original
+    memoryfile = BytesIO()
+    generator = BytesGenerator(memoryfile, mangle_from_=False)
+    generator.flatten(message)
+    return memoryfile.getvalue()
+
+def filtered_message(message, data):
+    """ Return an ImapMessage for the filter output data (bytes, or a
+        parsed email.Message.Message), with the IMAP attributes of the
+        original message (flags, internal date, and the myflags and mailbox
+        attributes used by ProcImap.ProcImap)
+    """
+    modified_message = ImapMessage(data)
+    if isinstance(message, ImapMessage):
+        modified_message.set_imapflags(message.get_imapflags())
+        modified_message.internaldate = message.internaldate
+    if hasattr(message, 'myflags'):
+        modified_message.myflags = message.myflags
+    if hasattr(message, 'mailbox'):
+        modified_message.mailbox = message.mailbox
+    return modified_message
+
+def serve(function, infile=None, outfile=None):
+    """ Run a filter that speaks the framing protocol of FilterPool: read
+        messages from infile (default stdin), and write function(message)
+        to outfile (default stdout), until infile is closed. The messages
+        are passed to function as bytes, and function must return bytes.
+        If function raises an exception, the error is reported to the
+        FilterPool, and the next message is read.
+    """
+    if infile is None:
+        infile = getattr(sys.stdin, 'buffer', sys.stdin)
+    if outfile is None:
+        outfile = getattr(sys.stdout, 'buffer', sys.stdout)
+    while True:
+        header = infile.readline()
+        if not header:
+            return
+        data = infile.read(int(header))
+        try:
+            (status, result) = (b'OK', function(data))
+        except Exception:
+            (status, result) = (b'ERR', str(sys.exc_info()[1]).encode('utf-8'))
+        outfile.write(status + (" %s\n" % len(result)).encode('ascii'))
+        outfile.write(result)
+        outfile.flush()
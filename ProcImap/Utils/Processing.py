@@ -24,97 +24,223 @@
 
 import re
 import subprocess
+from collections import Counter, OrderedDict
 import tempfile
 import os
-from email.generator import Generator
+import select
+import signal
 import sys
+import threading
+import time
 
 if sys.version_info > (3, 0):
-    from io import StringIO
+    from email.generator import BytesGenerator
+    from email.feedparser import BytesFeedParser
+    _unicode = str
 else:
-    from cStringIO import StringIO
+    from email.generator import Generator as BytesGenerator
+    from email.feedparser import FeedParser as BytesFeedParser
+    _unicode = unicode
 
-from ProcImap.ImapMessage import ImapMessage
+from ProcImap.Utils.Matching import SubstringMatcher, RegexMatcher
+from ProcImap.Utils.Matching import DomainMatcher
+from ProcImap.Utils.ListIndex import ListIndex, open_index
+from ProcImap.Utils.PipeFilter import FilterError, FilterTimeoutError
+from ProcImap.Utils.PipeFilter import filtered_message, _NEW_SESSION
 
-class AddressListFile:
+PIPE_POLL_INTERVAL = 0.1 # seconds after which pipe_message checks whether it
+                         # was cancelled
+
+LIST_CACHE_SIZE = 10000 # number of lookup results that each AddressListFile
+                        # or ReplacementListFile keeps
+
+ASCII_CACHE_SIZE = 1000 # number of strings for which unknown_to_ascii keeps
+                        # the result
+
+# Message-IDs in References and In-Reply-To header fields; ids that are
+# not separated by whitespace are found separately
+_REFERENCE_PATTERN = re.compile(r'<[^<>\s]+@[^<>\s]+>')
+
+
+class ListCache:
+    """ A dict-like cache of bounded size. If it is full, the entry that
+        was used least recently is dropped. The cache counts hits, misses,
+        evictions, and invalidations (calls to clear), see stats().
+    """
+    def __init__(self, maxsize=LIST_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+    def get(self, key, default=None):
+        """ Return the value for key, or default if it is not cached """
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data[key] = value
+        self.hits += 1
+        return value
+    def put(self, key, value):
+        """ Store value for key, dropping the least recently used entry if
+            the cache is full
+        """
+        self._data.pop(key, None)
+        self._data[key] = value
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+    def clear(self):
+        """ Remove all entries """
+        self._data.clear()
+        self.invalidations += 1
+    def stats(self):
+        """ Return a dict with the keys 'hits', 'misses', 'evictions',
+            'invalidations', 'size', and 'maxsize'
+        """
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'size': len(self._data), 'maxsize': self.maxsize}
+    def __contains__(self, key):
+        return key in self._data
+    def __len__(self):
+        return len(self._data)
+
+
+class _ListFile:
+    """ Common base class of AddressListFile and ReplacementListFile.
+        The lines of the file are loaded into memory by the function
+        self._builder (see _compiled), and loaded again whenever the file
+        is modified or replaced. Lookup results are stored in a ListCache,
+        which is cleared at the same time.
+    """
+    _MISSING = object()
+    def __init__(self, filename, builder, cachesize):
+        self.filename = filename
+        self._builder = builder
+        self._index = None
+        self._signature = None
+        self._cache = ListCache(cachesize)
+    def _load(self):
+        """ Load the file, unless it is unchanged since the last lookup """
+        signature = _file_signature(self.filename)
+        if signature == self._signature:
+            return
+        if self._builder is not None:
+            self._index = _compiled(self.filename, signature, self._builder)
+        self._signature = signature
+        self._cache.clear()
+    def _cached(self, lookupstring):
+        """ Return the cached result of _find(lookupstring) """
+        self._load()
+        result = self._cache.get(lookupstring, self._MISSING)
+        if result is self._MISSING:
+            result = self._find(lookupstring)
+            self._cache.put(lookupstring, result)
+        return result
+    def _find(self, lookupstring):
+        """ Return the lookup result for lookupstring from the loaded data.
+            To be implemented by the subclasses.
+        """
+        raise NotImplementedError
+    def _add(self, line):
+        """ Add the stripped line to the loaded data. To be implemented by
+            the subclasses.
+        """
+        raise NotImplementedError
+    def cache_stats(self):
+        """ Return the statistics of the lookup cache (see ListCache) """
+        return self._cache.stats()
+    def add(self, line):
+        """ Add line to self.filename, and to the data in memory """
+        self._load()
+        outfile = open(self.filename, "a")
+        outfile.write(line)
+        if not line[-1] == "\n":
+            outfile.write("\n")
+        outfile.close()
+        signature = _file_signature(self.filename)
+        if self._index is not None and line.strip():
+            self._add(line.strip())
+            _recompiled(self.filename, self._signature, signature,
+                        self._builder)
+        self._signature = signature
+        self._cache.clear()
+
+
+class AddressListFile(_ListFile):
     """ This class wraps around a file containing emailadresses.
         It is intended to help with Whitelisting, Blacklisting, etc.
     """
-    def __init__(self, filename, inmemory=False, regexes=False):
+    def __init__(self, filename, inmemory=False, regexes=False,
+                 cachesize=LIST_CACHE_SIZE, index=False, structured=False):
         """ Initialize AddressListFile:
-            If inmemory is True, the file is loaded into memory.
             If regexes is True, the lines in the file are compiled
             as regexes.
+            The lines are kept in memory in a matcher (see
+            ProcImap.Utils.Matching), which is rebuilt whenever the file
+            has changed on disk, and which is shared by all instances for
+            the same file. If inmemory is True, the matcher is built
+            immediately, otherwise on the first lookup.
+            If index is True (and regexes is False), the lines are looked up
+            in a compiled index file instead (see ProcImap.Utils.ListIndex),
+            which is compiled again when the file has changed. If the index
+            file cannot be written, the matcher is used.
+            If structured is True (and regexes is False), the lines are
+            email addresses and domains, which are matched against the
+            address in the lookup string as described in
+            ProcImap.Utils.Matching.DomainMatcher, instead of as substrings.
+            The results of up to 'cachesize' lookups are cached.
         """
-        self._cache = {}
-        self._data = []
-        self.filename = filename
+        builder = _address_substrings
+        if regexes:
+            builder = _address_regexes
+        elif structured:
+            builder = _address_domains
+        elif index:
+            builder = _address_index
+        _ListFile.__init__(self, filename, builder, cachesize)
         self._inmemory = inmemory
         self._use_regexes = regexes
         if self._inmemory:
-            if self._use_regexes:
-                infile = open(filename)
-                for line in infile:
-                    self._data.append(re.compile(line.strip()))
-                infile.close()
-            else:
-                infile = open(filename)
-                self._data = infile.read().split("\n")
-                self._data = [x for x in self._data if x != '']
-                infile.close()
+            self._load()
+    def _find(self, lookupstring):
+        """ Return the matching line for lookupstring, or None """
+        if self._use_regexes:
+            index = self._index.match(lookupstring)
+            if index is None:
+                return None
+            return self._index.patterns[index]
+        return self._index.search(lookupstring)
+    def _add(self, line):
+        """ Add the line to the matcher """
+        self._index.add(line)
+    def matching_rule(self, lookupstring):
+        """ Return the line in the represented file because of which
+            contains(lookupstring) is True, or None if there is no such
+            line. If several lines match, the same line as for contains is
+            returned.
+        """
+        if lookupstring is None:
+            return None
+        return self._cached(lookupstring)
     def contains(self, lookupstring):
         """ Return True if there is a line in the represented file that is
             contained in lookupstring. E.g., if you search for
             'someone@gmail.com' and the file contains a line '@gmail.com',
             True is returned.
             If regexes are used, return True if there is a regex in the file
-            that matches the lookupstring completely.
+            that matches the beginning of the lookupstring.
         """
-        if lookupstring is None:
-            return False
-        if self._cache.has_key(lookupstring):
-            return self._cache[lookupstring]
-        if self._use_regexes:
-            if self._inmemory:
-                for regex in self._data:
-                    if regex.match(lookupstring):
-                        self._cache[lookupstring] = True
-                        return True
-            else:
-                infile = open(self.filename)
-                for line in infile:
-                    regex = re.compile(line.strip())
-                    if regex.match(lookupstring):
-                        self._cache[lookupstring] = True
-                        return True
-                infile.close()
-        else:
-            if self._inmemory:
-                for in_file_string in self._data:
-                    if in_file_string in lookupstring:
-                        self._cache[lookupstring] = True
-                        return True
-            else:
-                infile = open(self.filename)
-                for line in infile:
-                    line = line.strip()
-                    if line in lookupstring:
-                        self._cache[lookupstring] = True
-                        return True
-                infile.close()
-        self._cache[lookupstring] = False
-        return False
-    def add(self, line):
-        """ Add line to self.filename  """
-        outfile = open(self.filename, "a")
-        outfile.write(line)
-        if not line[-1] == "\n":
-            outfile.write("\n")
-        outfile.close()
+        return self.matching_rule(lookupstring) is not None
 
 
 
-class ReplacementListFile:
+class ReplacementListFile(_ListFile):
     """ This class wraps around a file containing email address
         replacements.
         The text file contains lines such as
@@ -124,119 +250,434 @@ class ReplacementListFile:
         You can use this to make the from-line look nice in your email
         reader, if people send you crippled from-lines.
     """
-    def __init__(self, filename, inmemory=False, regexes=False, partial=False):
-        self._cache = {}
-        self._data = None
+    def __init__(self, filename, inmemory=False, regexes=False, partial=False,
+                 cachesize=LIST_CACHE_SIZE, index=False):
+        """ Initialize ReplacementListFile:
+            If regexes is True, the originals are compiled as regexes; they
+            are kept in memory in a RegexMatcher, as in AddressListFile.
+            Otherwise, if inmemory is True, the file is loaded into
+            memory. If partial is True, an original that is contained in
+            the search string is enough for a replacement (this is always
+            the case if inmemory and index are False).
+            If index is True, the originals are looked up in a compiled
+            index file (see ProcImap.Utils.ListIndex), as if the file was
+            in memory; if the index file cannot be written, the file is
+            loaded into memory.
+            In memory, the file is loaded again whenever it has changed on
+            disk. The results of up to 'cachesize' lookups are cached.
+        """
+        builder = None
         if regexes:
-            self._data = []
-        else:
-            self._data = {} # dicts will only work for non-regexes
-        self.filename = filename
+            builder = _replacement_regexes
+        elif index:
+            builder = _replacement_index
+            inmemory = True
+        elif inmemory:
+            builder = _replacement_dict
+        _ListFile.__init__(self, filename, builder, cachesize)
         self._inmemory = inmemory
         self._use_regexes = regexes
         self._partial = partial
         if self._inmemory:
-            if self._use_regexes:
-                infile = open(filename)
-                for line in infile:
-                    (original, replacement) = line.split("::", 1)
-                    original = re.compile(original.strip())
-                    replacement = replacement.strip()
-                    self._data.append((original, replacement))
-                infile.close()
-            else:
-                infile = open(filename)
+            self._load()
+    def _find(self, searchstring):
+        """ Return a tuple (original, replacement) for the line in the file
+            that applies to searchstring, or None
+        """
+        if self._use_regexes:
+            (matcher, replacements) = self._index
+            index = matcher.match(searchstring)
+            if index is not None:
+                return (matcher.patterns[index], replacements[index])
+        elif self._inmemory:
+            if searchstring in self._index:
+                return (searchstring, self._index[searchstring])
+            if self._partial:
+                if isinstance(self._index, ListIndex):
+                    original = self._index.search(searchstring)
+                    if original is not None:
+                        return (original, self._index[original])
+                    return None
+                for (original, replacement) in self._index.items():
+                    if  original in searchstring:
+                        return (original, replacement)
+        else:
+            infile = open(self.filename)
+            try:
                 for line in infile:
                     (original, replacement) = line.split("::", 1)
                     original = original.strip()
                     replacement = replacement.strip()
-                    self._data[original] = replacement
+                    if  original in searchstring:
+                        return (original, replacement)
+            finally:
                 infile.close()
+        return None
+    def _add(self, line):
+        """ Add the line 'original :: replacement' to the loaded data """
+        (original, replacement) = line.split("::", 1)
+        original = original.strip()
+        replacement = replacement.strip()
+        if self._use_regexes:
+            (matcher, replacements) = self._index
+            matcher.add(original)
+            replacements.append(replacement)
+        else:
+            self._index[original] = replacement
+    def matching_rule(self, searchstring):
+        """ Return the original (the part of the line before '::') of the
+            line in the file that lookup(searchstring) uses, or None if
+            there is no replacement.
+        """
+        if searchstring is None:
+            return None
+        found = self._cached(searchstring)
+        if found is None:
+            return None
+        return found[0]
     def lookup(self, searchstring):
         """ Return a replacement. If no replacement is found, return
             the searchstring.
         """
         if searchstring is None:
             return None
-        if self._cache.has_key(searchstring):
-            return self._cache[searchstring]
-        if self._use_regexes:
-            if self._inmemory:
-                for (regex, replacement) in self._data:
-                    if regex.match(searchstring):
-                        self._cache[searchstring] = replacement
-                        return replacement
-            else:
-                infile = open(self.filename)
-                for line in infile:
-                    (original, replacement) = line.split("::", 1)
-                    original = re.compile(original.strip())
-                    replacement = replacement.strip()
-                    regex = re.compile(line[:-1])
-                    if regex.match(searchstring):
-                        self._cache[searchstring] = replacement
-                        return replacement
-                infile.close()
-        else:
-            if self._inmemory:
-                if self._data.has_key(searchstring):
-                    replacement = self._data[searchstring]
-                    self._cache[searchstring] = replacement
-                    return replacement
-                else:
-                    if self._partial:
-                        for (original, replacement) in self._data.items():
-                            if  original in searchstring:
-                                self._cache[searchstring] = replacement
-                                return replacement
-                    else:
-                        return searchstring
-            else:
-                infile = open(self.filename)
-                for line in infile:
-                    (original, replacement) = line.split("::", 1)
-                    original = original.strip()
-                    replacement = replacement.strip()
-                    if  original in searchstring:
-                        self._cache[searchstring] = replacement
-                        return replacement
-                infile.close()
-        self._cache[searchstring] = searchstring
-        return searchstring
-    def add(self, line):
-        """ Add line to self.filename  """
-        outfile = open(self.filename, "a")
-        outfile.write(line)
-        if not line[-1] == "\n":
-            outfile.write("\n")
-        outfile.close()
+        found = self._cached(searchstring)
+        if found is None:
+            return searchstring
+        return found[1]
+
+
+
+_COMPILED = {} # (filename, builder) -> (file signature, compiled data)
+
+def _compiled(filename, signature, builder):
+    """ Return builder(filename), computed only once for all list files that
+        use the same file, as long as the file signature does not change
+    """
+    key = (filename, builder)
+    if key in _COMPILED and _COMPILED[key][0] == signature:
+        return _COMPILED[key][1]
+    data = builder(filename)
+    _COMPILED[key] = (signature, data)
+    return data
+
+def _recompiled(filename, old_signature, signature, builder):
+    """ Record that the compiled data for the file, which was up to date for
+        old_signature, has been updated in place to match the file with the
+        new signature
+    """
+    key = (filename, builder)
+    if key in _COMPILED and _COMPILED[key][0] == old_signature:
+        _COMPILED[key] = (signature, _COMPILED[key][1])
+
+def _read_lines(filename):
+    """ Return the non-empty lines of the file, stripped """
+    infile = open(filename)
+    try:
+        return [line.strip() for line in infile if line.strip()]
+    finally:
+        infile.close()
+
+def _address_substrings(filename):
+    """ Return a SubstringMatcher for the lines of the file """
+    return SubstringMatcher(_read_lines(filename))
+
+def _address_regexes(filename):
+    """ Return a RegexMatcher for the lines of the file """
+    return RegexMatcher(_read_lines(filename))
+
+def _replacement_regexes(filename):
+    """ Return a tuple (matcher, replacements) for a file of lines
+        'original :: replacement': a RegexMatcher for the originals, and the
+        list of the corresponding replacements
+    """
+    originals = []
+    replacements = []
+    for line in _read_lines(filename):
+        (original, replacement) = line.split("::", 1)
+        originals.append(original.strip())
+        replacements.append(replacement.strip())
+    return (RegexMatcher(originals), replacements)
+
+def _address_domains(filename):
+    """ Return a DomainMatcher for the lines of the file """
+    return DomainMatcher(_read_lines(filename))
+
+def _address_index(filename):
+    """ Return the ListIndex for the file, or a SubstringMatcher if the
+        index cannot be written
+    """
+    try:
+        return open_index(filename)
+    except (IOError, OSError):
+        return _address_substrings(filename)
+
+def _replacement_index(filename):
+    """ Return the ListIndex for a file of lines 'original :: replacement',
+        or a dict (see _replacement_dict) if the index cannot be written
+    """
+    try:
+        return open_index(filename, replacements=True)
+    except (IOError, OSError):
+        return _replacement_dict(filename)
 
+def _replacement_dict(filename):
+    """ Return a dict that maps the originals to the replacements, for a
+        file of lines 'original :: replacement'
+    """
+    result = {}
+    for line in _read_lines(filename):
+        (original, replacement) = line.split("::", 1)
+        result[original.strip()] = replacement.strip()
+    return result
 
+def _file_signature(filename):
+    """ Return a tuple that changes whenever the file is modified or
+        replaced
+    """
+    stat = os.stat(filename)
+    return (stat.st_mtime, stat.st_size, stat.st_ino)
 
-def pipe_message(message, command):
+def pipe_message(message, command, timeout=None, cancel=None):
     """ Pipe the message through a shell command:
         cat message | commmand > message
         message is assumed to be an instance of ImapMessage
         Returns modified message as instance of ImapMessage
+
+        The message is written to the command from a separate thread while
+        its output is read and parsed, so that commands that write output
+        before they have read all their input do not block. If the command
+        has not finished after 'timeout' seconds, it is killed and
+        FilterTimeoutError is raised. 'cancel' may be a threading.Event; if
+        it is set while the command runs, the command is killed and
+        FilterError is raised.
+    """
+    # the command runs in its own process group, so that it can be killed
+    # together with the processes that the shell starts for it
+    process = subprocess.Popen([command], shell=True,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, close_fds=True,
+            **_NEW_SESSION)
+    errors = []
+    def write():
+        """ Flatten the message directly into the stdin of the command """
+        try:
+            generator = BytesGenerator(process.stdin, mangle_from_=False,
+                                       maxheaderlen=60)
+            generator.flatten(message)
+            process.stdin.close()
+        except (IOError, OSError, ValueError):
+            pass # the command exited without reading all of its input
+        except Exception:
+            errors.append(sys.exc_info()[1])
+    writer = threading.Thread(target=write)
+    writer.daemon = True
+    writer.start()
+    parser = BytesFeedParser()
+    deadline = None
+    if timeout is not None:
+        deadline = time.time() + timeout
+    stdout = process.stdout.fileno()
+    exit_wait = 0.001 # seconds between checks whether the command has exited
+    try:
+        eof = False
+        while True:
+            wait = None
+            if cancel is not None:
+                if cancel.is_set():
+                    raise FilterError("Command %s was cancelled" % command)
+                wait = PIPE_POLL_INTERVAL
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise FilterTimeoutError("Command %s timed out"
+                                             % command)
+                if wait is None or remaining < wait:
+                    wait = remaining
+            if eof:
+                # the command has closed its stdout, but the timeout still
+                # applies until it has exited
+                if process.poll() is not None and not writer.is_alive():
+                    break
+                if wait is None or exit_wait < wait:
+                    wait = exit_wait
+                time.sleep(wait)
+                exit_wait = min(2 * exit_wait, PIPE_POLL_INTERVAL)
+                continue
+            if not select.select([stdout], [], [], wait)[0]:
+                continue
+            chunk = os.read(stdout, 65536)
+            if not chunk:
+                eof = True
+                continue
+            parser.feed(chunk)
+    except BaseException:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        raise
+    finally:
+        writer.join()
+        try:
+            process.stdin.close()
+        except (IOError, OSError):
+            pass # unwritten data is left in the buffer
+        process.stdout.close()
+        process.wait()
+    if errors:
+        raise errors[0]
+    return filtered_message(message, parser.close())
+
+# Non-ASCII characters that unknown_to_ascii converts: their ASCII
+# replacement, and their weight in the guessing of the encoding
+_XLATE = {
+# unicode string                                  : (replacement, weight)
+u'\N{ACUTE ACCENT}'                               : ( "", 0),
+u'\N{BROKEN BAR}'                                 : ( '|', 0),
+u'\N{CEDILLA}'                                    : ( '', 0),
+u'\N{CENT SIGN}'                                  : ( ' cent', 0),
+u'\N{COPYRIGHT SIGN}'                             : ( '(c)', 1),
+u'\N{CURRENCY SIGN}'                              : ( '', 0),
+u'\N{DEGREE SIGN}'                                : ( '', 1),
+u'\N{DIAERESIS}'                                  : ( '', 0),
+u'\N{DIVISION SIGN}'                              : ( '/', 1),
+u'\N{FEMININE ORDINAL INDICATOR}'                 : ( '', 0),
+u'\N{INVERTED EXCLAMATION MARK}'                  : ( '!', 1),
+u'\N{INVERTED QUESTION MARK}'                     : ( '?', 1),
+u'\N{LATIN CAPITAL LETTER A WITH ACUTE}'          : ( 'A', 1),
+u'\N{LATIN CAPITAL LETTER A WITH CIRCUMFLEX}'     : ( 'A', 1),
+u'\N{LATIN CAPITAL LETTER A WITH DIAERESIS}'      : ( 'Ae', 1),
+u'\N{LATIN CAPITAL LETTER A WITH GRAVE}'          : ( 'A', 1),
+u'\N{LATIN CAPITAL LETTER A WITH RING ABOVE}'     : ( 'A', 1),
+u'\N{LATIN CAPITAL LETTER A WITH TILDE}'          : ( 'A', 1),
+u'\N{LATIN CAPITAL LETTER AE}'                    : ( 'Ae', 2),
+u'\N{LATIN CAPITAL LETTER C WITH CEDILLA}'        : ( 'C', 1),
+u'\N{LATIN CAPITAL LETTER E WITH ACUTE}'          : ( 'E', 1),
+u'\N{LATIN CAPITAL LETTER E WITH CIRCUMFLEX}'     : ( 'E', 1),
+u'\N{LATIN CAPITAL LETTER E WITH DIAERESIS}'      : ( 'E', 1),
+u'\N{LATIN CAPITAL LETTER E WITH GRAVE}'          : ( 'E', 1),
+u'\N{LATIN CAPITAL LETTER ETH}'                   : ( 'Th', 1),
+u'\N{LATIN CAPITAL LETTER I WITH ACUTE}'          : ( 'I', 1),
+u'\N{LATIN CAPITAL LETTER I WITH CIRCUMFLEX}'     : ( 'I', 1),
+u'\N{LATIN CAPITAL LETTER I WITH DIAERESIS}'      : ( 'I', 1),
+u'\N{LATIN CAPITAL LETTER I WITH GRAVE}'          : ( 'I', 1),
+u'\N{LATIN CAPITAL LETTER N WITH TILDE}'          : ( 'N', 1),
+u'\N{LATIN CAPITAL LETTER O WITH ACUTE}'          : ( 'O', 1),
+u'\N{LATIN CAPITAL LETTER O WITH CIRCUMFLEX}'     : ( 'O', 1),
+u'\N{LATIN CAPITAL LETTER O WITH DIAERESIS}'      : ( 'Oe', 2),
+u'\N{LATIN CAPITAL LETTER O WITH GRAVE}'          : ( 'O', 1),
+u'\N{LATIN CAPITAL LETTER O WITH STROKE}'         : ( 'O', 1),
+u'\N{LATIN CAPITAL LETTER O WITH TILDE}'          : ( 'O', 1),
+u'\N{LATIN CAPITAL LETTER THORN}'                 : ( 'th', 1),
+u'\N{LATIN CAPITAL LETTER U WITH ACUTE}'          : ( 'U', 1),
+u'\N{LATIN CAPITAL LETTER U WITH CIRCUMFLEX}'     : ( 'U', 1),
+u'\N{LATIN CAPITAL LETTER U WITH DIAERESIS}'      : ( 'Ue', 2),
+u'\N{LATIN CAPITAL LETTER U WITH GRAVE}'          : ( 'U', 1),
+u'\N{LATIN CAPITAL LETTER Y WITH ACUTE}'          : ( 'Y', 1),
+u'\N{LATIN SMALL LETTER A WITH ACUTE}'            : ( 'a', 1),
+u'\N{LATIN SMALL LETTER A WITH CIRCUMFLEX}'       : ( 'a', 1),
+u'\N{LATIN SMALL LETTER A WITH DIAERESIS}'        : ( 'ae', 2),
+u'\N{LATIN SMALL LETTER A WITH GRAVE}'            : ( 'a', 1),
+u'\N{LATIN SMALL LETTER A WITH RING ABOVE}'       : ( 'a', 1),
+u'\N{LATIN SMALL LETTER A WITH TILDE}'            : ( 'a', 1),
+u'\N{LATIN SMALL LETTER AE}'                      : ( 'ae', 3),
+u'\N{LATIN SMALL LETTER C WITH CEDILLA}'          : ( 'c', 1),
+u'\N{LATIN SMALL LETTER E WITH ACUTE}'            : ( 'e', 1),
+u'\N{LATIN SMALL LETTER E WITH CIRCUMFLEX}'       : ( 'e', 1),
+u'\N{LATIN SMALL LETTER E WITH DIAERESIS}'        : ( 'e', 1),
+u'\N{LATIN SMALL LETTER E WITH GRAVE}'            : ( 'e', 1),
+u'\N{LATIN SMALL LETTER ETH}'                     : ( 'th', 1),
+u'\N{LATIN SMALL LETTER I WITH ACUTE}'            : ( 'i', 1),
+u'\N{LATIN SMALL LETTER I WITH CIRCUMFLEX}'       : ( 'i', 1),
+u'\N{LATIN SMALL LETTER I WITH DIAERESIS}'        : ( 'i', 1),
+u'\N{LATIN SMALL LETTER I WITH GRAVE}'            : ( 'i', 1),
+u'\N{LATIN SMALL LETTER N WITH TILDE}'            : ( 'n', 1),
+u'\N{LATIN SMALL LETTER O WITH ACUTE}'            : ( 'o', 1),
+u'\N{LATIN SMALL LETTER O WITH CIRCUMFLEX}'       : ( 'o', 1),
+u'\N{LATIN SMALL LETTER O WITH DIAERESIS}'        : ( 'oe', 2),
+u'\N{LATIN SMALL LETTER O WITH GRAVE}'            : ( 'o', 1),
+u'\N{LATIN SMALL LETTER O WITH STROKE}'           : ( 'o', 1),
+u'\N{LATIN SMALL LETTER O WITH TILDE}'            : ( 'o', 1),
+u'\N{LATIN SMALL LETTER SHARP S}'                 : ( 'ss', 2),
+u'\N{LATIN SMALL LETTER THORN}'                   : ( 'th', 0),
+u'\N{LATIN SMALL LETTER U WITH ACUTE}'            : ( 'u', 1),
+u'\N{LATIN SMALL LETTER U WITH CIRCUMFLEX}'       : ( 'u', 1),
+u'\N{LATIN SMALL LETTER U WITH DIAERESIS}'        : ( 'ue', 2),
+u'\N{LATIN SMALL LETTER U WITH GRAVE}'            : ( 'u', 1),
+u'\N{LATIN SMALL LETTER Y WITH ACUTE}'            : ( 'y', 1),
+u'\N{LATIN SMALL LETTER Y WITH DIAERESIS}'        : ( 'y', 1),
+u'\N{LEFT-POINTING DOUBLE ANGLE QUOTATION MARK}'  : ( '"', 0),
+u'\N{MACRON}'                                     : ( '', 0),
+u'\N{MASCULINE ORDINAL INDICATOR}'                : ( '', 0),
+u'\N{MICRO SIGN}'                                 : ( 'micro', 0),
+u'\N{MIDDLE DOT}'                                 : ( '*', 0),
+u'\N{MULTIPLICATION SIGN}'                        : ( '*', 0),
+u'\N{NOT SIGN}'                                   : ( 'not', 0),
+u'\N{PILCROW SIGN}'                               : ( '', 0),
+u'\N{PLUS-MINUS SIGN}'                            : ( '+/-', 0),
+u'\N{POUND SIGN}'                                 : ( ' pound', 0),
+u'\N{REGISTERED SIGN}'                            : ( '(R)', 0),
+u'\N{RIGHT-POINTING DOUBLE ANGLE QUOTATION MARK}' : ( '"', 0),
+u'\N{SECTION SIGN}'                               : ( '', 0),
+u'\N{SOFT HYPHEN}'                                : ( '-', 0),
+u'\N{SUPERSCRIPT ONE}'                            : ( '1', 0),
+u'\N{SUPERSCRIPT THREE}'                          : ( '3', 0),
+u'\N{SUPERSCRIPT TWO}'                            : ( '2', 0),
+u'\N{VULGAR FRACTION ONE HALF}'                   : ( '{1/2}', 0),
+u'\N{VULGAR FRACTION ONE QUARTER}'                : ( '{1/4}', 0),
+u'\N{VULGAR FRACTION THREE QUARTERS}'             : ( '{3/4}', 0),
+u'\N{YEN SIGN}'                                   : ('yen', 0)
+}
+
+# Translation table for unistring.translate(), built from _XLATE
+_TRANSLATION = dict((ord(character), replacement)
+                    for (character, (replacement, weight)) in _XLATE.items())
+
+# Encodings that unknown_to_ascii tries, in order of preference
+_ENCODINGS = ['utf8', 'latin_1', 'cp037', 'cp437' , 'cp850', 'cp852',
+              'cp863', 'cp865', 'cp1140', 'cp1250', 'cp1252',
+              'iso8859_15', 'mac_latin2', 'utf_16']
+
+# Characters in the standard alphabet, which are good evidence for an encoding
+_ALPHABET = u"abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ :!,"
+
+def _character_weight(character):
+    """ Return the weight of a decoded character in the guessing of the
+        encoding: translated characters contribute with their defined weight,
+        characters in the standard alphabet with a weight of 2
     """
-    p = subprocess.Popen([command], shell=True,
-            stdin=subprocess.PIPE, stdout=subprocess.PIPE, close_fds=True)
-    (child_stdout, child_stdin) = (p.stdout, p.stdin)
-
-    memoryfile = StringIO()
-    generator = Generator(memoryfile, mangle_from_=False, maxheaderlen=60)
-    generator.flatten(message)
-    child_stdin.write(memoryfile.getvalue())
-    child_stdin.close()
-    modified_message = ImapMessage(child_stdout)
-    child_stdout.close()
-    modified_message.set_imapflags(message.get_imapflags())
-    modified_message.internaldate = message.internaldate
-    if hasattr(message, 'myflags'):
-        modified_message.myflags = message.myflags
-    if hasattr(message, 'mailbox'):
-        modified_message.mailbox = message.mailbox
-    return modified_message
+    weight = 0
+    if character in _XLATE:
+        weight += _XLATE[character][1]
+    if character in _ALPHABET:
+        weight += 2
+    return weight
+
+def _byte_weights(encoding):
+    """ Return a list with the weight of each of the 256 byte values for
+        a single-byte encoding (None for bytes that cannot be decoded), or
+        None if the encoding does not decode every byte to one character.
+    """
+    weights = []
+    for byte in range(256):
+        try:
+            character = bytes(bytearray([byte])).decode(encoding)
+        except UnicodeDecodeError:
+            weights.append(None)
+            continue
+        if len(character) != 1:
+            return None
+        weights.append(_character_weight(character))
+    return weights
+
+# encoding -> list of byte weights, for the single-byte encodings
+_BYTE_WEIGHTS = {}
+for _encoding in _ENCODINGS:
+    if _encoding not in ('utf8', 'utf_16'):
+        _BYTE_WEIGHTS[_encoding] = _byte_weights(_encoding)
+del _encoding
+
+_ASCII_CACHE = ListCache(ASCII_CACHE_SIZE)
 
 def unknown_to_ascii(inputstring):
     """ This takes a string or unicode string in unknown encoding, tries to
@@ -251,159 +692,67 @@ def unknown_to_ascii(inputstring):
         characters are converted to something meaningful. Anything not
         converted is deleted.
 
+        The results for the last ASCII_CACHE_SIZE input strings are cached.
+
         Adapted from
         http://aspn.activestate.com/ASPN/Cookbook/Python/Recipe/251871
     """
-    xlate = {
-    # unicode string                                  : (replacement, weight)
-    u'\N{ACUTE ACCENT}'                               : ( "", 0),
-    u'\N{BROKEN BAR}'                                 : ( '|', 0),
-    u'\N{CEDILLA}'                                    : ( '', 0),
-    u'\N{CENT SIGN}'                                  : ( ' cent', 0),
-    u'\N{COPYRIGHT SIGN}'                             : ( '(c)', 1),
-    u'\N{CURRENCY SIGN}'                              : ( '', 0),
-    u'\N{DEGREE SIGN}'                                : ( '', 1),
-    u'\N{DIAERESIS}'                                  : ( '', 0),
-    u'\N{DIVISION SIGN}'                              : ( '/', 1),
-    u'\N{FEMININE ORDINAL INDICATOR}'                 : ( '', 0),
-    u'\N{INVERTED EXCLAMATION MARK}'                  : ( '!', 1),
-    u'\N{INVERTED QUESTION MARK}'                     : ( '?', 1),
-    u'\N{LATIN CAPITAL LETTER A WITH ACUTE}'          : ( 'A', 1),
-    u'\N{LATIN CAPITAL LETTER A WITH CIRCUMFLEX}'     : ( 'A', 1),
-    u'\N{LATIN CAPITAL LETTER A WITH DIAERESIS}'      : ( 'Ae', 1),
-    u'\N{LATIN CAPITAL LETTER A WITH GRAVE}'          : ( 'A', 1),
-    u'\N{LATIN CAPITAL LETTER A WITH RING ABOVE}'     : ( 'A', 1),
-    u'\N{LATIN CAPITAL LETTER A WITH TILDE}'          : ( 'A', 1),
-    u'\N{LATIN CAPITAL LETTER AE}'                    : ( 'Ae', 2),
-    u'\N{LATIN CAPITAL LETTER C WITH CEDILLA}'        : ( 'C', 1),
-    u'\N{LATIN CAPITAL LETTER E WITH ACUTE}'          : ( 'E', 1),
-    u'\N{LATIN CAPITAL LETTER E WITH CIRCUMFLEX}'     : ( 'E', 1),
-    u'\N{LATIN CAPITAL LETTER E WITH DIAERESIS}'      : ( 'E', 1),
-    u'\N{LATIN CAPITAL LETTER E WITH GRAVE}'          : ( 'E', 1),
-    u'\N{LATIN CAPITAL LETTER ETH}'                   : ( 'Th', 1),
-    u'\N{LATIN CAPITAL LETTER I WITH ACUTE}'          : ( 'I', 1),
-    u'\N{LATIN CAPITAL LETTER I WITH CIRCUMFLEX}'     : ( 'I', 1),
-    u'\N{LATIN CAPITAL LETTER I WITH DIAERESIS}'      : ( 'I', 1),
-    u'\N{LATIN CAPITAL LETTER I WITH GRAVE}'          : ( 'I', 1),
-    u'\N{LATIN CAPITAL LETTER N WITH TILDE}'          : ( 'N', 1),
-    u'\N{LATIN CAPITAL LETTER O WITH ACUTE}'          : ( 'O', 1),
-    u'\N{LATIN CAPITAL LETTER O WITH CIRCUMFLEX}'     : ( 'O', 1),
-    u'\N{LATIN CAPITAL LETTER O WITH DIAERESIS}'      : ( 'Oe', 2),
-    u'\N{LATIN CAPITAL LETTER O WITH GRAVE}'          : ( 'O', 1),
-    u'\N{LATIN CAPITAL LETTER O WITH STROKE}'         : ( 'O', 1),
-    u'\N{LATIN CAPITAL LETTER O WITH TILDE}'          : ( 'O', 1),
-    u'\N{LATIN CAPITAL LETTER THORN}'                 : ( 'th', 1),
-    u'\N{LATIN CAPITAL LETTER U WITH ACUTE}'          : ( 'U', 1),
-    u'\N{LATIN CAPITAL LETTER U WITH CIRCUMFLEX}'     : ( 'U', 1),
-    u'\N{LATIN CAPITAL LETTER U WITH DIAERESIS}'      : ( 'Ue', 2),
-    u'\N{LATIN CAPITAL LETTER U WITH GRAVE}'          : ( 'U', 1),
-    u'\N{LATIN CAPITAL LETTER Y WITH ACUTE}'          : ( 'Y', 1),
-    u'\N{LATIN SMALL LETTER A WITH ACUTE}'            : ( 'a', 1),
-    u'\N{LATIN SMALL LETTER A WITH CIRCUMFLEX}'       : ( 'a', 1),
-    u'\N{LATIN SMALL LETTER A WITH DIAERESIS}'        : ( 'ae', 2),
-    u'\N{LATIN SMALL LETTER A WITH GRAVE}'            : ( 'a', 1),
-    u'\N{LATIN SMALL LETTER A WITH RING ABOVE}'       : ( 'a', 1),
-    u'\N{LATIN SMALL LETTER A WITH TILDE}'            : ( 'a', 1),
-    u'\N{LATIN SMALL LETTER AE}'                      : ( 'ae', 3),
-    u'\N{LATIN SMALL LETTER C WITH CEDILLA}'          : ( 'c', 1),
-    u'\N{LATIN SMALL LETTER E WITH ACUTE}'            : ( 'e', 1),
-    u'\N{LATIN SMALL LETTER E WITH CIRCUMFLEX}'       : ( 'e', 1),
-    u'\N{LATIN SMALL LETTER E WITH DIAERESIS}'        : ( 'e', 1),
-    u'\N{LATIN SMALL LETTER E WITH GRAVE}'            : ( 'e', 1),
-    u'\N{LATIN SMALL LETTER ETH}'                     : ( 'th', 1),
-    u'\N{LATIN SMALL LETTER I WITH ACUTE}'            : ( 'i', 1),
-    u'\N{LATIN SMALL LETTER I WITH CIRCUMFLEX}'       : ( 'i', 1),
-    u'\N{LATIN SMALL LETTER I WITH DIAERESIS}'        : ( 'i', 1),
-    u'\N{LATIN SMALL LETTER I WITH GRAVE}'            : ( 'i', 1),
-    u'\N{LATIN SMALL LETTER N WITH TILDE}'            : ( 'n', 1),
-    u'\N{LATIN SMALL LETTER O WITH ACUTE}'            : ( 'o', 1),
-    u'\N{LATIN SMALL LETTER O WITH CIRCUMFLEX}'       : ( 'o', 1),
-    u'\N{LATIN SMALL LETTER O WITH DIAERESIS}'        : ( 'oe', 2),
-    u'\N{LATIN SMALL LETTER O WITH GRAVE}'            : ( 'o', 1),
-    u'\N{LATIN SMALL LETTER O WITH STROKE}'           : ( 'o', 1),
-    u'\N{LATIN SMALL LETTER O WITH TILDE}'            : ( 'o', 1),
-    u'\N{LATIN SMALL LETTER SHARP S}'                 : ( 'ss', 2),
-    u'\N{LATIN SMALL LETTER THORN}'                   : ( 'th', 0),
-    u'\N{LATIN SMALL LETTER U WITH ACUTE}'            : ( 'u', 1),
-    u'\N{LATIN SMALL LETTER U WITH CIRCUMFLEX}'       : ( 'u', 1),
-    u'\N{LATIN SMALL LETTER U WITH DIAERESIS}'        : ( 'ue', 2),
-    u'\N{LATIN SMALL LETTER U WITH GRAVE}'            : ( 'u', 1),
-    u'\N{LATIN SMALL LETTER Y WITH ACUTE}'            : ( 'y', 1),
-    u'\N{LATIN SMALL LETTER Y WITH DIAERESIS}'        : ( 'y', 1),
-    u'\N{LEFT-POINTING DOUBLE ANGLE QUOTATION MARK}'  : ( '"', 0),
-    u'\N{MACRON}'                                     : ( '', 0),
-    u'\N{MASCULINE ORDINAL INDICATOR}'                : ( '', 0),
-    u'\N{MICRO SIGN}'                                 : ( 'micro', 0),
-    u'\N{MIDDLE DOT}'                                 : ( '*', 0),
-    u'\N{MULTIPLICATION SIGN}'                        : ( '*', 0),
-    u'\N{NOT SIGN}'                                   : ( 'not', 0),
-    u'\N{PILCROW SIGN}'                               : ( '', 0),
-    u'\N{PLUS-MINUS SIGN}'                            : ( '+/-', 0),
-    u'\N{POUND SIGN}'                                 : ( ' pound', 0),
-    u'\N{REGISTERED SIGN}'                            : ( '(R)', 0),
-    u'\N{RIGHT-POINTING DOUBLE ANGLE QUOTATION MARK}' : ( '"', 0),
-    u'\N{SECTION SIGN}'                               : ( '', 0),
-    u'\N{SOFT HYPHEN}'                                : ( '-', 0),
-    u'\N{SUPERSCRIPT ONE}'                            : ( '1', 0),
-    u'\N{SUPERSCRIPT THREE}'                          : ( '3', 0),
-    u'\N{SUPERSCRIPT TWO}'                            : ( '2', 0),
-    u'\N{VULGAR FRACTION ONE HALF}'                   : ( '{1/2}', 0),
-    u'\N{VULGAR FRACTION ONE QUARTER}'                : ( '{1/4}', 0),
-    u'\N{VULGAR FRACTION THREE QUARTERS}'             : ( '{3/4}', 0),
-    u'\N{YEN SIGN}'                                   : ('yen', 0)
-    }
     try:
-        unistring = unicode(inputstring, 'ascii')
-        return inputstring # inputstring is ascii, nothing to do
-    except UnicodeDecodeError:
+        if isinstance(inputstring, _unicode):
+            inputstring.encode('ascii')
+            return inputstring # inputstring is ascii, nothing to do
+        return str(inputstring.decode('ascii'))
+    except UnicodeError:
         pass
-    if isinstance(inputstring, unicode):
+    result = _ASCII_CACHE.get(inputstring)
+    if result is not None:
+        return result
+    if isinstance(inputstring, _unicode):
         unistring = inputstring
     else:
-        # try to make string into unicode
-        encodings = ['utf8', 'latin_1', 'cp037', 'cp437' , 'cp850', 'cp852',
-                     'cp863', 'cp865', 'cp1140', 'cp1250', 'cp1252',
-                     'iso8859_15', 'mac_latin2', 'utf_16']
-        found_encoding = 'ascii'
-        alphabet = u"abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ :!,"
-        max_score = 0.0
-        for encoding in encodings:
-            # the encoding that reaches the highest score in the translation of
-            # characters is assumed correct. The score is a weighted count of
-            # successful translations, divided by the number of total characters
+        unistring = inputstring.decode(_guess_encoding(inputstring), 'replace')
+    result = unistring.translate(_TRANSLATION).encode('ascii', 'ignore')
+    if not isinstance(result, str):
+        result = result.decode('ascii')
+    _ASCII_CACHE.put(inputstring, result)
+    return result
+
+def _guess_encoding(data):
+    """ Return the encoding in which the bytes 'data' have the highest score.
+        The score is a weighted count of the characters that data decodes to
+        (see _character_weight), divided by the number of characters.
+        For single-byte encodings, it is calculated from a histogram of the
+        byte values, without decoding data.
+    """
+    histogram = Counter(bytearray(data))
+    found_encoding = 'ascii'
+    max_score = 0.0
+    for encoding in _ENCODINGS:
+        weights = _BYTE_WEIGHTS.get(encoding)
+        if weights is None:
             try:
-                unistring = unicode(inputstring, encoding)
-                successcount = 0
-                totalcount = 0
-                for character in unistring:
-                    totalcount += 1
-                    if xlate.has_key(character):
-                        # translated characters contribute with their defined
-                        # weight
-                        weight = xlate[character][1]
-                        successcount += weight
-                    if character in alphabet:
-                        # characters that are in the standard alphabet are good
-                        # They contribute with a weight of 2
-                        successcount += 2
-                score = float(successcount) / float(totalcount)
-                if score > max_score:
-                    # always take the encoding with the highest score
-                    found_encoding = encoding
-                    max_score = score
+                unistring = data.decode(encoding)
             except UnicodeDecodeError:
                 # this encoding doesn't work. Try the next one.
                 continue
-            unistring = unicode(inputstring, found_encoding, 'replace')
-    result = ''
-    for character in unistring:
-        if xlate.has_key(character):
-            result += xlate[character][0]
-        elif ord(character) >= 0x80:
-            pass
+            successcount = sum(count * _character_weight(character)
+                               for (character, count)
+                               in Counter(unistring).items())
+            totalcount = len(unistring)
+            if totalcount == 0:
+                continue # e.g. a UTF-16 byte order mark only
         else:
-            result += str(character)
-    return result
+            if any(weights[byte] is None for byte in histogram):
+                continue
+            successcount = sum(count * weights[byte]
+                               for (byte, count) in histogram.items())
+            totalcount = len(data)
+        score = float(successcount) / float(totalcount)
+        if score > max_score:
+            # always take the encoding with the highest score
+            found_encoding = encoding
+            max_score = score
+    return found_encoding
 
 def put_through_pager(displaystring, pager='less'):
     """ Put displaystring through the 'less' pager """
@@ -416,16 +765,16 @@ def put_through_pager(displaystring, pager='less'):
 
 def references_from_header(header):
     """ Extract the message ids from the "References" and "In-Reply-To" 
-        Headers.
+        Headers. To sort many messages into threads, see
+        ProcImap.Utils.ThreadIndex.
     """
-    id_pattern = re.compile('<\S+@\S+>')
     result = set()
     references = header['References']
     if references is not None:
-        for id in id_pattern.findall(references):
+        for id in _REFERENCE_PATTERN.findall(references):
             result.add(id)
     reply_to = header['In-Reply-To']
     if reply_to is not None:
-        for id in id_pattern.findall(reply_to):
+        for id in _REFERENCE_PATTERN.findall(reply_to):
             result.add(id)
     return list(result)
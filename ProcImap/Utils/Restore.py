@@ -0,0 +1,323 @@
+############################################################################
+#    Copyright (C) 2008 by Michael Goerz                                   #
+#    http://www.physik.fu-berlin.de/~goerz                                 #
+#                                                                          #
+#    This program is free software; you can redistribute it and#or modify  #
+#    it under the terms of the GNU General Public License as published by  #
+#    the Free Software Foundation; either version 3 of the License, or     #
+#    (at your option) any later version.                                   #
+#                                                                          #
+#    This program is distributed in the hope that it will be useful,       #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of        #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         #
+#    GNU General Public License for more details.                          #
+#                                                                          #
+#    You should have received a copy of the GNU General Public License     #
+#    along with this program; if not, write to the                         #
+#    Free Software Foundation, Inc.,                                       #
+#    59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.             #
+############################################################################
+
+""" This module contains the MailboxRestore class, which uploads the
+    messages of a local mbox file or Maildir to an ImapMailbox, e.g. to
+    restore a backup made with ProcImap.Utils.Backup.
+
+    The local mailbox is read sequentially, as raw bytes. The flags and the
+    internal date of each message are taken from the header fields
+        X-ProcImap-Imapflags
+        X-ProcImap-ImapInternalDate
+    which are removed from the message (as well as X-ProcImap-UID). If there
+    is a backup sidecar file next to the local mailbox, the current flags
+    recorded in it take precedence. Messages without these header fields
+    are uploaded with the flags that the local mailbox keeps for them (the
+    Status and X-Status header fields of an mbox file, which are removed,
+    or the info of a Maildir message), and with the date from their Date
+    header.
+
+    The messages are uploaded in batches over a pool of connections to the
+    server, each of which runs its own thread and appends a whole batch at
+    once (see ImapMailbox.add_many). Messages whose Message-ID is already in
+    the target mailbox are skipped, so an interrupted restore can simply be
+    started again. Because the batches are uploaded in parallel, the order
+    of the messages in the target mailbox (their UIDs) does not necessarily
+    match the order in the local mailbox.
+"""
+
+import mailbox
+import os
+import re
+import sys
+import threading
+import time
+
+if sys.version_info > (3, 0):
+    import queue
+else:
+    import Queue as queue
+
+from ProcImap.ImapMailbox import ImapMailbox, MESSAGE_ID_PATTERN
+from ProcImap.ImapMessage import LazyImapMessage, internaldate_from_string, \
+                                 flagmask_from_message
+from ProcImap.Utils.Backup import read_sidecar
+from ProcImap.Utils.Headers import header_fields, parse_date
+
+RESTORE_CONNECTIONS = 4 # number of connections over which messages are
+                        # uploaded in parallel
+
+RESTORE_BATCH_SIZE = 50 # number of messages that are uploaded together
+
+_HEADER_END_PATTERN = re.compile(br'\r?\n\r?\n')
+
+_STATUS_FIELDS = (b'status', b'x-status') # flags in mbox files
+
+
+class MailboxRestore(object):
+    """ Upload of the messages in a local mailbox to an ImapMailbox.
+
+            >>> restore = MailboxRestore('/backup/inbox.mbox', mailbox)
+            >>> (added, skipped, errors) = restore.run()
+
+        The class specific attributes are:
+
+        source          the local mailbox (instance of mailbox.Mailbox)
+        connections     number of connections that are used for uploading
+        batch_size      number of messages per upload
+        dedupe          if True, messages whose Message-ID is already in the
+                        target mailbox are skipped
+    """
+    def __init__(self, source, target, connections=RESTORE_CONNECTIONS,
+                 batch_size=RESTORE_BATCH_SIZE, dedupe=True):
+        """ Prepare uploading the messages in source to the ImapMailbox
+            target. Source may be an instance of mailbox.Mailbox, or the path
+            to an mbox file or to a Maildir (if it is a directory).
+        """
+        self._sidecar = {}
+        if not isinstance(source, mailbox.Mailbox):
+            source = source.rstrip(os.sep)
+            self._sidecar = _sidecar_flags(source)
+            if os.path.isdir(source):
+                source = mailbox.Maildir(source, factory=None, create=False)
+            else:
+                source = mailbox.mbox(source, factory=None, create=False)
+        self.source = source
+        self._target = target
+        self.connections = max(1, connections)
+        self.batch_size = batch_size
+        self.dedupe = dedupe
+
+    def run(self):
+        """ Upload all messages. Return a tuple (added, skipped, errors),
+            where added and skipped are the number of messages that were
+            uploaded resp. skipped as duplicates, and errors is a list of
+            (key, error) tuples for the messages that could not be
+            uploaded; key is the key of the message in the local mailbox,
+            error an instance of ImapNotOkError (or of the exception that
+            broke the connection).
+        """
+        known_ids = set()
+        if self.dedupe:
+            known_ids = set(self._target.get_message_ids().values())
+        pool = [ImapMailbox((self._target.server.clone(), self._target.name))
+                for index in range(self.connections)]
+        jobs = queue.Queue(2 * len(pool))
+        results = queue.Queue()
+        workers = []
+        for target in pool:
+            worker = threading.Thread(target=_upload,
+                                      args=(target, jobs, results))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        skipped = 0
+        try:
+            keys = []
+            messages = []
+            for key in self.source.iterkeys():
+                (message_id, message) = self._message(key)
+                if message_id is not None:
+                    if message_id in known_ids:
+                        skipped += 1
+                        continue
+                    known_ids.add(message_id)
+                keys.append(key)
+                messages.append(message)
+                if len(messages) >= self.batch_size:
+                    jobs.put((keys, messages))
+                    keys = []
+                    messages = []
+            if messages:
+                jobs.put((keys, messages))
+        finally:
+            for worker in workers:
+                jobs.put(None)
+            for worker in workers:
+                worker.join()
+            for target in pool:
+                target.server.logout()
+        added = 0
+        errors = []
+        while not results.empty():
+            for (key, (uid, error)) in results.get():
+                if error is None:
+                    added += 1
+                else:
+                    errors.append((key, error))
+        return (added, skipped, errors)
+
+    def _message(self, key):
+        """ Return a tuple (message_id, message) for the message with key
+            in the local mailbox. message is a LazyImapMessage of the raw
+            message, with the flags and internal date from the X-ProcImap
+            header fields, which are removed. Without these fields, the
+            flags are those of the local mailbox (see _source_flagmask), and
+            the internal date is taken from the Date header field.
+            message_id is None if the message has no Message-ID.
+        """
+        (fields, data) = split_procimap_fields(self.source.get_bytes(key))
+        status = b''
+        if isinstance(self.source, (mailbox.mbox, mailbox.MMDF)):
+            (status_fields, data) = _split_fields(data, _STATUS_FIELDS)
+            status = b''.join([status_fields.get(name, b'')
+                               for name in _STATUS_FIELDS])
+        message = LazyImapMessage(data)
+        message_id = _message_id(data)
+        flags = self._sidecar.get(message_id, fields.get('imapflags'))
+        if flags is not None:
+            message.flags_from_string(flags)
+        else:
+            message.set_flagmask(self._source_flagmask(key, status))
+        internaldate = None
+        if 'imapinternaldate' in fields:
+            internaldate = internaldate_from_string(fields['imapinternaldate'])
+        else:
+            date = parse_date(header_fields(_header(data)).get('date'))
+            if date:
+                internaldate = time.localtime(date)
+        if internaldate is not None:
+            message.internaldate = internaldate
+        return (message_id, message)
+
+    def _source_flagmask(self, key, status):
+        """ Return the IMAP flags bitmask for the flags that the local
+            mailbox keeps for the message with key: 'status' are the values
+            of the Status and X-Status header fields (bytes) of a message in
+            an mbox file; the flags of a Maildir message are in its info.
+        """
+        if isinstance(self.source, mailbox.Maildir):
+            if hasattr(self.source, 'get_flags'): # Python 3.13
+                flags = self.source.get_flags(key)
+            else:
+                flags = self.source.get_message(key).get_flags()
+            message = mailbox.MaildirMessage()
+        elif isinstance(self.source, (mailbox.mbox, mailbox.MMDF)):
+            flags = status.decode('ascii', 'replace')
+            message = mailbox.mboxMessage()
+        else:
+            return 0
+        message.set_flags(flags)
+        return flagmask_from_message(message)
+
+
+def restore(source, target, connections=RESTORE_CONNECTIONS,
+            batch_size=RESTORE_BATCH_SIZE, dedupe=True):
+    """ Upload the messages in the local mailbox source to the ImapMailbox
+        target (see MailboxRestore). Return a tuple (added, skipped, errors).
+    """
+    return MailboxRestore(source, target, connections, batch_size,
+                          dedupe).run()
+
+def split_procimap_fields(data):
+    """ Remove the X-ProcImap-* header fields from the raw message 'data'
+        (bytes). Return a tuple (fields, data), where fields is a dict that
+        maps the lowercase field names without the 'X-ProcImap-' prefix to
+        the field values, and data is the message without these fields.
+        X-ProcImap lines without a colon are not fields, and are kept.
+    """
+    (fields, data) = _split_fields(data, None)
+    result = {}
+    for (name, value) in fields.items():
+        result[name[11:].decode('ascii', 'replace')] \
+            = value.decode('ascii', 'replace')
+    return (result, data)
+
+def _split_fields(data, names):
+    """ Remove header fields from the raw message 'data' (bytes): the
+        fields with the given lowercase names (bytes), or, if names is None,
+        the X-ProcImap-* fields. Return a tuple (fields, data), where fields
+        is a dict that maps the lowercase field names to the unfolded field
+        values (bytes), and data is the message without these fields.
+    """
+    match = _HEADER_END_PATTERN.search(data)
+    if match is None:
+        header, body = data, b''
+    else:
+        header, body = data[:match.start()], data[match.start():]
+    fields = {}
+    lines = []
+    name = None # name of the X-ProcImap field that is being removed
+    for line in header.splitlines(True):
+        if line[:1] in (b' ', b'\t'):
+            if name is not None:
+                fields[name] += b' ' + line.strip()
+            else:
+                lines.append(line)
+            continue
+        name = None
+        (field, colon, value) = line.partition(b':')
+        field = field.strip().lower()
+        if colon and (field in names if names is not None
+                      else field[:11] == b'x-procimap-'):
+            name = field
+            fields[name] = value.strip()
+            continue
+        lines.append(line) # lines without a colon are kept as they are
+    if not fields:
+        return ({}, data)
+    header = b''.join(lines)
+    if match is not None and not header:
+        body = body.lstrip(b'\r\n')
+    return (fields, header.rstrip(b'\r\n') + body)
+
+def _header(data):
+    """ Return the header of the raw message """
+    match = _HEADER_END_PATTERN.search(data)
+    if match is not None:
+        return data[:match.start()]
+    return data
+
+def _message_id(data):
+    """ Return the Message-ID from the header of the raw message, or None """
+    for line in _header(data).splitlines():
+        if line[:11].lower() == b'message-id:':
+            found = MESSAGE_ID_PATTERN.search(line[11:].decode('ascii',
+                                                               'replace'))
+            if found is not None:
+                return found.group(0)
+            return None
+    return None
+
+def _sidecar_flags(path):
+    """ Return a dict that maps Message-IDs to the flags recorded in the
+        backup sidecar file for the local mailbox at path
+    """
+    result = {}
+    for entry in read_sidecar(path)['uids'].values():
+        if entry.get('message_id') is not None:
+            result[entry['message_id']] = entry['flags']
+    return result
+
+def _upload(target, jobs, results):
+    """ Upload the batches of (keys, messages) from the queue jobs to the
+        ImapMailbox target, until None is received. Put a list of
+        (key, (uid, error)) tuples into the queue results for each batch.
+    """
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        (keys, messages) = job
+        try:
+            outcome = target.add_many(messages)
+        except Exception as error:
+            outcome = [(None, error)] * len(messages)
+        results.put(list(zip(keys, outcome)))
@@ -21,8 +21,12 @@
 """ This module contains functions that work directly on an online
     ImapServer/ImapMailbox.
 """
-import email
+import base64
+import binascii
+import quopri
+import time
 from ProcImap.Utils.Processing import put_through_pager
+from ProcImap.Utils.Headers import normalize_headers
 
 DEFAULT_PAGER = 'less'
 
@@ -30,30 +34,54 @@ DEFAULT_PAGER = 'less'
 def display(mailbox, uid, pager=DEFAULT_PAGER, headerfields=None):
     """ Display a stripped down version of the message with UID in
         a pager. The displayed message will contain the the header
-        fields set in 'headerfields', and the first BODY section
-        (which is usually the human-readable part)
+        fields set in 'headerfields', and the text part of the message
+        (text/plain if there is one, see BodyStructure.text_part). Only
+        the header fields and the text part are downloaded, not the
+        attachments. Displaying a message does not mark it as seen.
 
         headerfields defaults to ['Date', 'From', 'To', 'Subject']
         contrary to the declaration.
     """
-    header = mailbox.get_header(uid)
+    if headerfields is None:
+        headerfields = ['Date', 'From', 'To', 'Subject']
+    header = mailbox.get_fields(uid, ' '.join(headerfields))
     result = ''
     # get body
     body = ''
-    (code, data) = mailbox._server.uid('fetch', uid, '(BODY[1])')
-    if code == 'OK':
-        body = data[0][1]
+    part = mailbox.get_bodystructure(uid).text_part()
+    if part is not None:
+        body = decode_part(mailbox.fetch_part(uid, part.section), part)
     # build result
-    if headerfields is None:
-        headerfields = ['Date', 'From', 'To', 'Subject']
     for field in headerfields:
-        if header.has_key(field):
+        if field in header:
             result += "%s: %s\n" % (field, header[field])
     result += "\n"
     result += body
     put_through_pager(result, pager)
 
 
+def decode_part(data, part):
+    """ Undo the content transfer encoding of the raw data of a MIME part,
+        as downloaded with BODY[section], and return it as a string decoded
+        according to the charset of the part. 'part' is the BodyStructure
+        instance describing the part.
+    """
+    if isinstance(data, str):
+        data = data.encode('ascii', 'replace')
+    if part.encoding == 'base64':
+        try:
+            data = base64.b64decode(data)
+        except (binascii.Error, ValueError):
+            pass
+    elif part.encoding == 'quoted-printable':
+        data = quopri.decodestring(data)
+    charset = part.charset or 'us-ascii'
+    try:
+        return data.decode(charset, 'replace')
+    except LookupError:
+        return data.decode('latin_1')
+
+
 def summary(mailbox, uids, printout=True, printuid=True):
     """ generates lines showing some basic information about the messages
         with the supplied uids. Non-existing UIDs in the list are
@@ -67,7 +95,7 @@ def summary(mailbox, uids, printout=True, printuid=True):
         The summary contains
         1) an index (the uid if printuid=True)
         2) the from name (or from address), truncated
-        3) the date of the message
+        3) the date of the message, in local time
         4) the subject, truncated
 
         Each line has the indicated fields truncated so that it is at
@@ -77,28 +105,22 @@ def summary(mailbox, uids, printout=True, printuid=True):
     result = [] # array of lines
     if isinstance(uids, (str, int)):
         uids = [uids]
+    uids = [int(uid) for uid in uids]
+    headers = normalize_headers(mailbox, uids)
     for uid in uids:
-        try:
-            header = mailbox.get_header(uid)
-        except: # unspecified on purpose, might be ProcImap.imaplib2.error
+        if uid not in headers:
             continue
+        (from_name, from_address, date, subject) = headers[uid]
         counter += 1
         index = counter
         if printuid:
             index = str(uid)
         index = "%2s" % index
-        (from_name, address) = email.utils.parseaddr(header['From'])
-        if from_name == '':
-            from_name = address
-        date = str(header['Date'])
-        datetuple = email.utils.parsedate_tz(date)
-        date = date[:16].ljust(16, " ")
-        if datetuple is not None:
-            date = "%02i/%02i/%04i %02i:%02i" \
-                    % tuple([datetuple[i] for i in (1,2,0,3,4)])
-        subject = str(header['Subject'])
-        subject = ' '.join([s for (s, c) in \
-                            email.header.decode_header(subject)])
+        from_name = from_name or from_address
+        if date:
+            date = time.strftime("%m/%d/%Y %H:%M", time.localtime(date))
+        else:
+            date = " " * 16
         length_from = 25-len(index) # width of ...
         length_subject = 35         # ... truncated strings
         generated_line = "%s %s %s %s" \
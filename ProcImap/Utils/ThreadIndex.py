@@ -0,0 +1,388 @@
+############################################################################
+#    Copyright (C) 2008 by Michael Goerz                                   #
+#    http://www.physik.fu-berlin.de/~goerz                                 #
+#                                                                          #
+#    This program is free software; you can redistribute it and#or modify  #
+#    it under the terms of the GNU General Public License as published by  #
+#    the Free Software Foundation; either version 3 of the License, or     #
+#    (at your option) any later version.                                   #
+#                                                                          #
+#    This program is distributed in the hope that it will be useful,       #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of        #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         #
+#    GNU General Public License for more details.                          #
+#                                                                          #
+#    You should have received a copy of the GNU General Public License     #
+#    along with this program; if not, write to the                         #
+#    Free Software Foundation, Inc.,                                       #
+#    59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.             #
+############################################################################
+
+""" This module contains the ThreadIndex class, which sorts the messages of
+    an ImapMailbox into threads, following the algorithm by Jamie Zawinski
+    (http://www.jwz.org/doc/threading.html), based on the Message-ID,
+    References and In-Reply-To header fields.
+
+        >>> index = ThreadIndex(mailbox, '/home/user/.procimap/inbox.threads')
+        >>> index.update()
+        >>> for thread in index.threads():
+        ...     for (depth, container) in thread.walk():
+        ...         print("  " * depth, container.uid)
+
+    The header fields are downloaded with one FETCH command per
+    FETCH_BATCH_SIZE messages. Only the messages that arrived since the last
+    update are fetched and linked into the existing threads.
+
+    If a file is given, the index is kept in it: a first line with the
+    folder name and the UIDVALIDITY, and then one line per message with its
+    UID, Message-ID and references (all lines are JSON). New messages are
+    appended to the file, so an update takes time in proportion to the
+    number of new messages. If the UIDVALIDITY of the folder changes, the
+    index is built again from scratch.
+
+    Threads are only formed through references; messages are not grouped
+    by their subject (the last, heuristic step of the algorithm).
+"""
+
+import json
+import os
+import tempfile
+
+from ProcImap.ImapMailbox import MESSAGE_ID_PATTERN
+from ProcImap.UIDSet import UIDSet
+from ProcImap.Utils.Headers import header_fields
+
+THREAD_FIELDS = 'HEADER.FIELDS (MESSAGE-ID REFERENCES IN-REPLY-TO)'
+
+
+class ThreadContainer(object):
+    """ A node in a thread: a message, or a placeholder for a message that
+        is referenced but not in the mailbox.
+
+        Attributes are:
+        message_id      Message-ID of the message
+        uid             UID of the message, or None for a placeholder
+        parent          ThreadContainer of the parent message, or None
+        children        list of ThreadContainers of the replies
+    """
+    __slots__ = ('message_id', 'uid', 'parent', 'children')
+
+    def __init__(self, message_id, uid=None):
+        self.message_id = message_id
+        self.uid = uid
+        self.parent = None
+        self.children = []
+
+    def walk(self):
+        """ Iterate over (depth, container) tuples for this container and
+            all its descendants, depth first
+        """
+        stack = [(0, self)]
+        while stack:
+            (depth, container) = stack.pop()
+            yield (depth, container)
+            for child in reversed(container.children):
+                stack.append((depth + 1, child))
+
+    def uids(self):
+        """ Return the UIDs of the messages in the subtree as a UIDSet """
+        return UIDSet([container.uid for (depth, container) in self.walk()
+                       if container.uid is not None])
+
+    def _has_ancestor(self, container):
+        """ Return True if container is self or one of its ancestors """
+        node = self
+        while node is not None:
+            if node is container:
+                return True
+            node = node.parent
+        return False
+
+    def _set_parent(self, parent):
+        """ Make self a child of parent (which may be None) """
+        if self.parent is not None:
+            self.parent.children.remove(self)
+        self.parent = parent
+        if parent is not None:
+            parent.children.append(self)
+
+    def __repr__(self):
+        return "<ThreadContainer %s (UID %s) with %s replies>" \
+               % (self.message_id, self.uid, len(self.children))
+
+
+class ThreadIndex(object):
+    """ Thread forest of the messages in an ImapMailbox.
+
+        The class specific attributes are:
+
+        filename        file in which the index is kept, or None
+        uidvalidity     UIDVALIDITY of the folder the index belongs to
+        last_uid        highest UID in the index
+    """
+    def __init__(self, mailbox, filename=None):
+        """ Create the index for the ImapMailbox 'mailbox'. If filename is
+            given and the file exists, the index is read from it.
+        """
+        self._mailbox = mailbox
+        self.filename = filename
+        self.uidvalidity = None
+        self.last_uid = 0
+        self._clear()
+        if filename is not None and os.path.exists(filename):
+            self._read()
+
+    def _clear(self):
+        """ Remove all messages from the index (not from the file) """
+        self._records = []    # (uid, message_id, references) in UID order
+        self._containers = {} # Message-ID -> ThreadContainer
+        self._by_uid = {}     # UID -> ThreadContainer
+        self.last_uid = 0
+
+    def update(self, check_removed=False):
+        """ Fetch the header fields of the messages that arrived since the
+            last update, and add them to the threads. Return the number of
+            added messages. If check_removed is True, messages that are no
+            longer in the mailbox are removed from the index as well; this
+            requires the list of all UIDs in the mailbox.
+        """
+        uidvalidity = self._mailbox.server.uidvalidity
+        if uidvalidity != self.uidvalidity:
+            self.uidvalidity = uidvalidity
+            self._clear()
+            self._write()
+        if check_removed and self._records:
+            existing = set(self._mailbox.search('ALL'))
+            if any(uid not in existing for (uid, message_id, references)
+                   in self._records):
+                self._rebuild([record for record in self._records
+                               if record[0] in existing])
+                self._write()
+        new_uids = [uid for uid in
+                    self._mailbox.search("UID %s:*" % (self.last_uid + 1))
+                    if uid > self.last_uid]
+        if not new_uids:
+            return 0
+        headers = self._mailbox.fetch_parts(new_uids, THREAD_FIELDS)
+        records = []
+        for uid in sorted(headers.keys()):
+            (message_id, references) = thread_fields(headers[uid])
+            records.append((uid, message_id, references))
+            self.add(uid, message_id, references)
+        self._append(records)
+        return len(records)
+
+    def add(self, uid, message_id, references):
+        """ Add the message with UID to the threads. message_id may be None,
+            references is the list of the Message-IDs that the message
+            refers to, oldest first (see thread_fields). UIDs must be added
+            in ascending order. The file is not updated.
+        """
+        uid = int(uid)
+        self._records.append((uid, message_id, list(references)))
+        self.last_uid = max(self.last_uid, uid)
+        container = None
+        if message_id is not None:
+            container = self._containers.get(message_id)
+        if container is None or container.uid is not None:
+            # a new message, or a duplicate Message-ID: the duplicate is
+            # threaded as a separate message
+            if container is not None or message_id is None:
+                message_id = "<%s@uid.procimap>" % uid
+            container = ThreadContainer(message_id)
+            self._containers[message_id] = container
+        container.uid = uid
+        self._by_uid[uid] = container
+        # link the references to each other, without changing links that
+        # were made before
+        parent = None
+        for reference in references:
+            node = self._containers.get(reference)
+            if node is None:
+                node = ThreadContainer(reference)
+                self._containers[reference] = node
+            if parent is not None and node.parent is None \
+            and not parent._has_ancestor(node):
+                node._set_parent(parent)
+            parent = node
+        # the message's own references take precedence over links made
+        # from the references of other messages
+        if parent is not None and parent._has_ancestor(container):
+            parent = None
+        if container.parent is not parent:
+            container._set_parent(parent)
+
+    def _rebuild(self, records):
+        """ Build the threads again from the list of records """
+        self._clear()
+        for (uid, message_id, references) in records:
+            self.add(uid, message_id, references)
+
+    def threads(self):
+        """ Return the threads as a list of ThreadContainers, the roots of
+            the thread trees. The trees are copies of the index, from which
+            the placeholders that are not needed to hold a thread together
+            are removed. Threads and replies are ordered by the lowest UID
+            they contain.
+        """
+        roots = []
+        for container in self._containers.values():
+            if container.parent is None:
+                roots.extend(_pruned(container))
+        roots.sort(key=lambda item: item[0])
+        return [root for (first_uid, root) in roots]
+
+    def thread(self, uid):
+        """ Return the root ThreadContainer of the thread (see threads)
+            that contains the message with UID. Raise KeyError if the
+            message is not in the index.
+        """
+        container = self._by_uid[int(uid)]
+        while container.parent is not None:
+            container = container.parent
+        return _pruned(container)[0][1]
+
+    def parent_uid(self, uid):
+        """ Return the UID of the nearest ancestor of the message with UID
+            that is in the mailbox, or None
+        """
+        container = self._by_uid[int(uid)].parent
+        while container is not None and container.uid is None:
+            container = container.parent
+        if container is None:
+            return None
+        return container.uid
+
+    def _read(self):
+        """ Read the index file """
+        infile = open(self.filename)
+        try:
+            lines = infile.readlines()
+        finally:
+            infile.close()
+        try:
+            header = json.loads(lines[0])
+        except (IndexError, ValueError):
+            return
+        if header.get('folder') != self._mailbox.name:
+            return
+        self.uidvalidity = header.get('uidvalidity')
+        for line in lines[1:]:
+            try:
+                (uid, message_id, references) = json.loads(line)
+            except ValueError:
+                break # incomplete last line of an interrupted update
+            if uid > self.last_uid:
+                self.add(uid, message_id, references)
+
+    def _write(self):
+        """ Write the complete index file, replacing it atomically """
+        if self.filename is None:
+            return
+        # a unique temporary file, so that processes that update the same
+        # index at the same time do not write into each other's file
+        (handle, tempname) = tempfile.mkstemp(
+                                dir=os.path.dirname(self.filename) or '.',
+                                prefix=os.path.basename(self.filename) + '.',
+                                suffix='.tmp')
+        try:
+            outfile = os.fdopen(handle, "w")
+            try:
+                json.dump({'folder': self._mailbox.name,
+                           'uidvalidity': self.uidvalidity}, outfile)
+                outfile.write("\n")
+                for record in self._records:
+                    json.dump(record, outfile)
+                    outfile.write("\n")
+                outfile.flush()
+                os.fsync(outfile.fileno())
+            finally:
+                outfile.close()
+            if os.path.exists(self.filename):
+                os.chmod(tempname, os.stat(self.filename).st_mode & 0o777)
+            getattr(os, 'replace', os.rename)(tempname, self.filename)
+        except BaseException:
+            os.unlink(tempname)
+            raise
+
+    def _append(self, records):
+        """ Append the records of new messages to the index file """
+        if self.filename is None:
+            return
+        outfile = open(self.filename, "a")
+        try:
+            for record in records:
+                json.dump(record, outfile)
+                outfile.write("\n")
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        finally:
+            outfile.close()
+
+    def __contains__(self, uid):
+        try:
+            return int(uid) in self._by_uid
+        except (TypeError, ValueError):
+            return False
+
+    def __len__(self):
+        """ Return the number of messages in the index """
+        return len(self._by_uid)
+
+    def __repr__(self):
+        return "<ThreadIndex of %s messages>" % len(self)
+
+
+def thread_fields(data):
+    """ Return a tuple (message_id, references) for the raw header fields
+        'data' (bytes). message_id is None if there is no Message-ID;
+        references is the list of Message-IDs from the References header
+        field, oldest first, or, if there is none, the first Message-ID in
+        In-Reply-To.
+    """
+    fields = header_fields(data)
+    message_id = None
+    match = MESSAGE_ID_PATTERN.search(
+                    fields.get('message-id', b'').decode('ascii', 'replace'))
+    if match is not None:
+        message_id = match.group(0)
+    references = MESSAGE_ID_PATTERN.findall(
+                    fields.get('references', b'').decode('ascii', 'replace'))
+    if not references:
+        references = MESSAGE_ID_PATTERN.findall(
+                  fields.get('in-reply-to', b'').decode('ascii', 'replace'))[:1]
+    # a message that refers to itself would be its own ancestor
+    references = [reference for reference in references
+                  if reference != message_id]
+    return (message_id, references)
+
+def _pruned(root):
+    """ Return a list of (lowest UID, copy) tuples for the copies of the
+        thread tree below root, with pruned descendants, that take the place
+        of root. Placeholders without children are dropped, and placeholders
+        are replaced by their children, except for a root placeholder with
+        several children. Replies are ordered by the lowest UID they contain.
+    """
+    replacements = {} # container -> list of (lowest UID, copy)
+    for (depth, container) in reversed(list(root.walk())):
+        # the children of a container are handled before the container
+        children = []
+        for child in container.children:
+            children.extend(replacements.pop(child))
+        children.sort(key=lambda item: item[0])
+        copy = ThreadContainer(container.message_id, container.uid)
+        copy.children = [child for (first_uid, child) in children]
+        for child in copy.children:
+            child.parent = copy
+        uids = [first_uid for (first_uid, child) in children]
+        if container.uid is not None:
+            uids.append(container.uid)
+        if container.uid is not None \
+        or (container is root and len(children) > 1):
+            replacements[container] = [(min(uids), copy)]
+        else:
+            replacements[container] = children
+    result = replacements[root]
+    for (first_uid, copy) in result:
+        copy.parent = None
+    return result
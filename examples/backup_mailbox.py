@@ -1,27 +1,26 @@
 #!/usr/bin/env python
 """
-    This example shows how to create a backup of an IMAP mailbox into an mbox folders.
-    The IMAP attributes are stored in each message in special header fields"
+    This example shows how to create a backup of an IMAP mailbox into an mbox
+    file (or a Maildir). The IMAP attributes are stored in each message in
+    special header fields, and in a sidecar file next to the backup.
+    Running the script again only downloads the new messages.
 """
 from ProcImap.ImapMailbox import ImapMailbox
 from ProcImap.Utils.MailboxFactory import MailboxFactory
-from mailbox import mbox
+from ProcImap.Utils.Backup import backup
 import sys
 
-# usage: backup_mailbox.py imapmailbox backupmbox
+# usage: backup_mailbox.py imapmailbox backupmbox [mbox|maildir]
 
 mailboxes = MailboxFactory('/home/goerz/.procimap/mailboxes.cfg')
 server = mailboxes.get_server('Gmail')
 mailbox = ImapMailbox((server, sys.argv[1]))
-backuptarget = mbox(sys.argv[2])
+format = 'mbox'
+if len(sys.argv) > 3:
+    format = sys.argv[3]
 
-backuptarget.lock()
-
-for message in mailbox:
-    message.add_header("X-ProcImap-Imapflags", message.flagstring())
-    message.add_header("X-ProcImap-ImapInternalDate", message.internaldatestring())
-    backuptarget.add(message)
+(added, updated) = backup(mailbox, sys.argv[2], format)
+print("%s new messages, %s messages with changed flags" % (added, updated))
 
 mailbox.close()
-backuptarget.close()
 sys.exit(0)
@@ -4,13 +4,15 @@ This example shows how to decrypt a mailbox that has GPG-encrypted emails.
 """
 import sys
 
-from ProcImap.Utils.Processing import pipe_message
+from ProcImap.Utils.PipeFilter import FilterPool
 from ProcImap.Utils.CLI import ProcImapOptParser
 from ProcImap.ImapMailbox import ImapMailbox
+from ProcImap.UIDSet import UIDSet
 from ProcImap.Utils.Gmail import GmailCache, is_gmail_box, delete
 import mailbox as Mailbox # I'm already using 'mailbox' as a variable name
 
 decryptprogram = "/Users/goerz/bin/eml_decrypt.pl -mbox -w"
+batchsize = 20 # number of messages that are downloaded and decrypted at once
 
 opt = ProcImapOptParser()
 opt.usage = '%prog [options] SERVER MAILBOXES'
@@ -44,37 +46,47 @@ if 'imap.gmail.com' in mailbox_server.servername:
         cache.update()
 
 
+pool = FilterPool(decryptprogram, timeout=120, framed=False)
+
 for mailbox_name in args[2:]:
     mailbox =  ImapMailbox((mailbox_server.clone(), mailbox_name))
     print("\n\nProcessing mailbox %s" % mailbox.name)
     encrypted = mailbox.search('UNDELETED HEADER Content-Type encrypted')
-    for uid in encrypted:
-        print("    Decrypting UID %s" % uid)
-        message = mailbox[uid]
-        labels = [mailbox_name] # all the mailboxes the mail appears (for gmail)
-        if options.backup is not None:
-            print("        Backing up the original (encrypted) message")
-            backupbox.add(message)
-        print("        Deleting the original (encrypted) message")
-        if is_gmail_box(mailbox):
-            labels = cache.get_labels("%s.%s" % (mailbox_name, uid))
-            delete(mailbox, uid)
-        else:
-            mailbox.discard(uid)
-        print("        Piping message through decryption program")
-        try:
-            message = pipe_message(message, decryptprogram)
-        except:
-            # the decryption program sometimes stalls. This try-except block
-            # allows to use Ctrl+C to get out of processing this specific mail
-            pass
-        print("        Done")
-        for labelbox_name in labels:
-            # this can be done more efficiently once we are able to find the UID
-            # of a message that was just uploaded to the mailbox
-            labelbox = ImapMailbox((mailbox_server.clone(), labelbox_name))
-            print("        Putting decrypted text into mailbox %s" % labelbox_name)
-            labelbox.add(message)
-            labelbox.close()
+    print("    Piping %s messages through decryption program" % len(encrypted))
+    # only one batch of messages is kept in memory at a time
+    for batch in UIDSet(encrypted).batches(batchsize):
+        uids = list(batch)
+        messages = [mailbox[uid] for uid in uids]
+        # the decryption program sometimes stalls; the pool kills it after
+        # the timeout, and the message is left alone
+        decrypted = pool.filter_many(messages)
+        for (uid, message, (decrypted_message, error)) \
+        in zip(uids, messages, decrypted):
+            print("    Decrypting UID %s" % uid)
+            if error is not None:
+                print("        Decryption failed: %s" % error)
+                continue
+            # all the mailboxes the mail appears in (for gmail)
+            labels = [mailbox_name]
+            if options.backup is not None:
+                print("        Backing up the original (encrypted) message")
+                backupbox.add(message)
+            print("        Deleting the original (encrypted) message")
+            if is_gmail_box(mailbox):
+                labels = cache.get_labels("%s.%s" % (mailbox_name, uid))
+                delete(mailbox, uid)
+            else:
+                mailbox.discard(uid)
+            for labelbox_name in labels:
+                # this can be done more efficiently once we are able to find
+                # the UID of a message that was just uploaded to the mailbox
+                labelbox = ImapMailbox((mailbox_server.clone(),
+                                        labelbox_name))
+                print("        Putting decrypted text into mailbox %s"
+                      % labelbox_name)
+                labelbox.add(decrypted_message)
+                labelbox.close()
+            print("        Done")
     mailbox.close()
+pool.close()
 sys.exit(0)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""
+Measure the per-message cost of converting flags between ImapMessage and
+the other mailbox.Message classes.
+
+The conversion helpers in ProcImap.ImapMessage use tables that are computed
+once at import time. For comparison, the benchmark also runs a version
+that builds and reverses the mapping dict on every call, as the helpers
+used to do.
+
+Usage: flag_conversion_benchmark.py [number of messages]
+"""
+
+import mailbox
+import sys
+import time
+
+from ProcImap.ImapMessage import ImapMessage
+from ProcImap.ImapMessage import maildirflags_from_imap_message
+from ProcImap.ImapMessage import imapflags_from_maildir_message
+from ProcImap.ImapMessage import flagmasks_from_messages
+
+
+def rebuilt_maildirflags(message):
+    """ Maildir flags from an ImapMessage, rebuilding the mapping per call """
+    mappings = {
+        'D' : '\\Draft',
+        'F' : '\\Flagged',
+        'P' : '$Forwarded',
+        'R' : '\\Answered',
+        'S' : '\\Seen',
+        'T' : '\\Deleted'
+    }
+    reverse = {}
+    for (key, value) in mappings.items():
+        reverse[value.upper()] = key
+    result = ""
+    for imapflag in message.get_imapflags():
+        if imapflag.upper() in reverse:
+            result += reverse[imapflag.upper()]
+    return result
+
+def timed(label, function, items):
+    """ Call function for all items, print time per item """
+    start = time.time()
+    for item in items:
+        function(item)
+    elapsed = time.time() - start
+    print("%-40s %8.2f us/message" % (label, 1e6 * elapsed / len(items)))
+
+def main(count):
+    """ Run the benchmark on count messages """
+    source = "From: a@example.com\nSubject: test\n\nbody\n"
+    flagsets = ['', 'S', 'RS', 'FS', 'DST', 'PRS']
+    maildir_messages = []
+    for index in range(count):
+        message = mailbox.MaildirMessage(source)
+        message.set_flags(flagsets[index % len(flagsets)])
+        maildir_messages.append(message)
+    imap_messages = [ImapMessage(message) for message in maildir_messages]
+
+    print("%s messages" % count)
+    timed("maildir flags, precomputed tables",
+          maildirflags_from_imap_message, imap_messages)
+    timed("maildir flags, mapping rebuilt per call",
+          rebuilt_maildirflags, imap_messages)
+    timed("IMAP flags from maildir message",
+          imapflags_from_maildir_message, maildir_messages)
+    start = time.time()
+    flagmasks_from_messages(maildir_messages)
+    print("%-40s %8.2f us/message" % ("flagmasks_from_messages (batch)",
+          1e6 * (time.time() - start) / count))
+    timed("full conversion MaildirMessage->Imap", ImapMessage,
+          maildir_messages)
+    timed("full conversion Imap->mboxMessage", mailbox.mboxMessage,
+          imap_messages)
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main(100000)
@@ -1,14 +1,14 @@
 #!/usr/bin/env python
 """
+    Upload all messages in an mbox file to a folder on an IMAP server.
+    Messages that are already in the folder (same Message-ID) are skipped.
 """
 
 from ProcImap.ImapMailbox import ImapMailbox
 from ProcImap.ImapServer import ImapServer
-from ProcImap.ImapMailbox import ImapNotOkError
+from ProcImap.Utils.Restore import MailboxRestore
 import sys
-import time
 import mailbox
-from email.utils import make_msgid
 
 if len(sys.argv) < 3:
     print("Usage: mbox2imap.py <mboxpath> <imapfolder>")
@@ -24,32 +24,17 @@ toboxname = sys.argv[2]
 
 tobox = ImapMailbox((toserver, toboxname))
 fromboxname = sys.argv[1]
-frombox = mailbox.mbox(fromboxname)
+frombox = mailbox.mbox(fromboxname, factory=None)
 frombox.lock()
-tobox.lock()
 
-
-i = 1
 print("Processing mbox file %s with %s messages" % (fromboxname, len(frombox)))
-for message in frombox:
-    print("%s" % i)
-    if message['Message-Id'] is None:
-        print("   WARNING: message has no message-id (mesage ID will be added)")
-        message.add_header("Message-Id", make_msgid('katamon.mbox2imap') )
-    if True:
-        try:
-            tobox.add(message)
-        except ImapNotOkError:
-            print("   ERROR: Transaction failed for message %s" % i)
-            toserver.reconnect()
-            tobox = ImapMailbox((toserver, toboxname))
-            time.sleep(5)
-        time.sleep(1)
-        number_in_tobox = len(tobox.get_all_uids())
-        #time.sleep(1)
-        print("    Added Message, %s in mailbox" % number_in_tobox)
-    i = i + 1
+(added, skipped, errors) = MailboxRestore(frombox, tobox).run()
+for (key, error) in errors:
+    print("   ERROR: Transaction failed for message %s: %s" % (key + 1, error))
+print("Added %s messages, skipped %s messages that were already in %s" \
+      % (added, skipped, toboxname))
 
+frombox.unlock()
 frombox.close()
 tobox.close()
 sys.exit(0)
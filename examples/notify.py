@@ -9,12 +9,13 @@
 
 from ProcImap.Utils.MailboxFactory import MailboxFactory
 from ProcImap.Utils.Processing import AddressListFile
+from ProcImap.Utils.Headers import normalize_headers
+from ProcImap.Utils.Server import decode_part
 from time import time
 import sys
 import os
 import subprocess
 import re
-import email
 
 if sys.version_info > (3, 0):
     import pickle
@@ -72,27 +73,24 @@ def notify(priority=False):
             pipe = subprocess.Popen(program_name, shell=True, 
                                     bufsize=0, stdin=subprocess.PIPE,
                                     env={"LC_CTYPE": "UTF-8"}).stdin
-            pipe.write('"')
-            decoded_subject = u""
-            for part in email.header.decode_header(unread_mails[uid][2]):
-                if part[1] is None:
-                    decoded_subject += unicode(part[0])
-                else:
-                    decoded_subject += part[0].decode(part[1])
-            pipe.write(decoded_subject.encode('utf-8'))
-            pipe.write('"')
-            (code, data) = inbox._server.uid('fetch', uid, '(BODY.PEEK[1])')
-            if code == 'OK':
-                pipe.write("\n")
-                body = data[0][1][:60]
-                body = body.decode(unread_mails[uid][3])
+            pipe.write(b'"')
+            pipe.write(unread_mails[uid][2].encode('utf-8'))
+            pipe.write(b'"')
+            try:
+                part = inbox.get_bodystructure(uid).text_part()
+            except KeyError:
+                part = None
+            if part is not None:
+                pipe.write(b"\n")
+                body = decode_part(inbox.fetch_part(uid, part.section, 0, 60),
+                                   part)
                 body = body.replace("\r\n", " ")
                 body = body.replace("\n", " ")
                 body = body.replace("\r", " ")
                 body = body.replace("\t", " ")
                 body = body.replace("  ", " ")
                 pipe.write(body.encode('utf-8'))
-                pipe.write("...")
+                pipe.write(b"...")
             pipe.close()
             os.system(audio)
             unread_mails[uid][4] = True # mark as notified
@@ -111,29 +109,28 @@ for uid in unread_mails.keys():
 
 # notify as necessary
 if len(unseen) > 0:
+    # the headers of all new messages are fetched and decoded at once
+    headers = normalize_headers(inbox, [uid for uid in unseen
+                                        if uid not in unread_mails])
     for uid in unseen:
-        if unread_mails.has_key(uid):
+        if uid in unread_mails:
             if (int(time()) - unread_mails[uid][0]) > notifytimeout:
                 notify()
-        else:
-            fields = inbox.get_fields(uid, "From Subject Content-Type")
-            from_address = fields['From']
-            subject = fields['Subject']
-            encoding = fields.get_content_charset()
-            if not isinstance(encoding, str):
-                encoding = 'ascii'
-            if prioritylist.contains(from_address):
+        elif uid in headers:
+            (name, address, date, subject) = headers[uid]
+            from_address = address
+            if name:
+                from_address = "%s <%s>" % (name, address)
+            record = [int(time()), from_address, subject, None, False]
+            if prioritylist.contains(address):
                 notify()
-                unread_mails[uid] = [int(time()), from_address, subject, 
-                                     encoding, False]
+                unread_mails[uid] = record
                 notify(priority=True)
-            elif notifylist.contains(from_address):
-                unread_mails[uid] = [int(time()), from_address, subject, 
-                                     encoding, False]
+            elif notifylist.contains(address):
+                unread_mails[uid] = record
                 notify()
             else:
-                unread_mails[uid] = [int(time()), from_address, subject, 
-                                     encoding, False]
+                unread_mails[uid] = record
 
 
     # pickle data to disk
@@ -18,19 +18,23 @@ def help():
     print("Press enter to quit\n")
 
 
+if '--check' in sys.argv:
+    unseen_count = mailbox.count("UNSEEN UNDELETED")
+    if unseen_count == 0:
+        print("No unread messages")
+        sys.exit(0)
+    sys.stdout.write("%s unread message" % unseen_count)
+    if unseen_count > 1:
+        sys.stdout.write("s\n")
+    else:
+        sys.stdout.write("\n")
+    sys.exit(1)
+
 unseen = mailbox.get_unseen_uids()
 if len(unseen) == 0:
     print("No unread messages")
     sys.exit(0)
 else:
-    if '--check' in sys.argv:
-        sys.stdout.write("%s unread message" % len(unseen))
-        if len(unseen) > 1:
-            sys.stdout.write("s\n")
-        else:
-            sys.stdout.write("\n")
-        sys.exit(1)
-
     # display selector
     print("")
     summary(mailbox, unseen, printuid=False)
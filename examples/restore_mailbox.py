@@ -1,11 +1,11 @@
 #!/usr/bin/env python
 """
-    This example shows how to restore a backup created by backup_mailbox.py"
+    This example shows how to restore a backup created by backup_mailbox.py
+    Messages that are already in the IMAP mailbox are skipped.
 """
 from ProcImap.ImapMailbox import ImapMailbox
-from ProcImap.ImapMessage import ImapMessage
 from ProcImap.Utils.MailboxFactory import MailboxFactory
-from mailbox import mbox
+from ProcImap.Utils.Restore import restore
 import sys
 
 # usage: restore_mailbox.py backupmbox imapmailbox
@@ -13,17 +13,11 @@ import sys
 mailboxes = MailboxFactory('/home/goerz/.procimap/mailboxes.cfg')
 server = mailboxes.get_server('Gmail')
 mailbox = ImapMailbox((server, sys.argv[2]))
-backupsource = mbox(sys.argv[1], factory=ImapMessage)
 
-for message in backupsource:
-    if message.has_key("X-ProcImap-Imapflags"):
-        message.flags_from_string(message["X-ProcImap-Imapflags"])
-        del message["X-ProcImap-Imapflags"]
-    if message.has_key("X-ProcImap-ImapInternalDate"):
-        message. internaldate_from_string(message["X-ProcImap-ImapInternalDate"])
-        del message["X-ProcImap-ImapInternalDate"]
-    mailbox.add(message)
+(added, skipped, errors) = restore(sys.argv[1], mailbox)
+for (key, error) in errors:
+    print("ERROR: %s" % error)
+print("%s messages restored, %s already in mailbox" % (added, skipped))
 
 mailbox.close()
-backupsource.close()
 sys.exit(0)
@@ -0,0 +1,61 @@
+############################################################################
+#    Copyright (C) 2008 by Michael Goerz                                   #
+#    http://www.physik.fu-berlin.de/~goerz                                 #
+#                                                                          #
+#    This program is free software; you can redistribute it and#or modify  #
+#    it under the terms of the GNU General Public License as published by  #
+#    the Free Software Foundation; either version 3 of the License, or     #
+#    (at your option) any later version.                                   #
+#                                                                          #
+#    This program is distributed in the hope that it will be useful,       #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of        #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         #
+#    GNU General Public License for more details.                          #
+#                                                                          #
+#    You should have received a copy of the GNU General Public License     #
+#    along with this program; if not, write to the                         #
+#    Free Software Foundation, Inc.,                                       #
+#    59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.             #
+############################################################################
+
+
+""" Tests for the ImapMessage and LazyImapMessage classes. Run them with
+    'python -m unittest discover tests' from the top directory.
+"""
+
+import unittest
+
+from ProcImap.ImapMessage import ImapMessage, LazyImapMessage
+from ProcImap.Utils.PipeFilter import message_bytes
+
+MESSAGE = b'From: a@example.com\r\nSubject: old\r\n\r\nbody\r\n'
+
+
+class ModifiedMessageTest(unittest.TestCase):
+    """ A modified message must not be sent as its original bytes """
+
+    def test_unmodified(self):
+        for cls in (ImapMessage, LazyImapMessage):
+            message = cls(MESSAGE)
+            self.assertEqual(message.get_original(), MESSAGE)
+            self.assertEqual(message_bytes(message), MESSAGE)
+
+    def test_replace_header(self):
+        for cls in (ImapMessage, LazyImapMessage):
+            message = cls(MESSAGE)
+            message.replace_header('Subject', 'new')
+            self.assertEqual(message.get_original(), None)
+            self.assertTrue(b'Subject: new' in message_bytes(message))
+
+    @unittest.skipUnless(hasattr(ImapMessage, 'set_raw'),
+                         "email.message.Message has no set_raw")
+    def test_set_raw(self):
+        for cls in (ImapMessage, LazyImapMessage):
+            message = cls(MESSAGE)
+            message.set_raw('X-Spam-Flag', 'YES')
+            self.assertEqual(message.get_original(), None)
+            self.assertTrue(b'X-Spam-Flag: YES' in message_bytes(message))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+############################################################################
+#    Copyright (C) 2008 by Michael Goerz                                   #
+#    http://www.physik.fu-berlin.de/~goerz                                 #
+#                                                                          #
+#    This program is free software; you can redistribute it and#or modify  #
+#    it under the terms of the GNU General Public License as published by  #
+#    the Free Software Foundation; either version 3 of the License, or     #
+#    (at your option) any later version.                                   #
+#                                                                          #
+#    This program is distributed in the hope that it will be useful,       #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of        #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         #
+#    GNU General Public License for more details.                          #
+#                                                                          #
+#    You should have received a copy of the GNU General Public License     #
+#    along with this program; if not, write to the                         #
+#    Free Software Foundation, Inc.,                                       #
+#    59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.             #
+############################################################################
+
+
+""" Tests for ProcImap.Utils.Restore. Run them with
+    'python -m unittest discover tests' from the top directory.
+"""
+
+import calendar
+import mailbox
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from ProcImap.ImapFlags import SEEN, ANSWERED, FLAGGED
+from ProcImap.Utils.Restore import MailboxRestore
+
+MESSAGE = (b'From: a@example.com\n'
+           b'Subject: plain\n'
+           b'Date: Tue, 02 Jan 2001 03:04:05 +0000\n'
+           b'Message-ID: <plain@example.com>\n')
+DATE = calendar.timegm((2001, 1, 2, 3, 4, 5))
+
+
+class RestoreMessageTest(unittest.TestCase):
+    """ Messages from a local mailbox that was not made by
+        ProcImap.Utils.Backup keep their flags and date
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_plain_mbox(self):
+        path = os.path.join(self.directory, 'plain.mbox')
+        mboxfile = open(path, 'wb')
+        try:
+            mboxfile.write(b'From MAILER-DAEMON Tue Jan  2 03:04:05 2001\n'
+                           + MESSAGE + b'Status: RO\nX-Status: A\n\nbody\n')
+        finally:
+            mboxfile.close()
+        restore = MailboxRestore(path, None)
+        key = list(restore.source.iterkeys())[0]
+        (message_id, message) = restore._message(key)
+        restore.source.close()
+        self.assertEqual(message_id, '<plain@example.com>')
+        self.assertEqual(message.get_flagmask(), SEEN | ANSWERED)
+        self.assertEqual(time.mktime(message.internaldate), DATE)
+        data = message.get_original()
+        self.assertTrue(data.startswith(MESSAGE))
+        self.assertFalse(b'Status' in data)
+        self.assertTrue(data.endswith(b'\n\nbody\n'))
+
+    def test_plain_maildir(self):
+        path = os.path.join(self.directory, 'plain')
+        maildir = mailbox.Maildir(path, create=True)
+        message = mailbox.MaildirMessage(MESSAGE + b'\nbody\n')
+        message.set_flags('FS')
+        key = maildir.add(message)
+        restore = MailboxRestore(path, None)
+        (message_id, message) = restore._message(key)
+        restore.source.close()
+        self.assertEqual(message.get_flagmask(), SEEN | FLAGGED)
+        self.assertEqual(time.mktime(message.internaldate), DATE)
+
+    def test_procimap_fields(self):
+        path = os.path.join(self.directory, 'backup.mbox')
+        mboxfile = open(path, 'wb')
+        try:
+            mboxfile.write(b'From MAILER-DAEMON Tue Jan  2 03:04:05 2001\n'
+                           b'X-ProcImap-UID: 7\n'
+                           b'X-ProcImap-Imapflags: (\\Flagged)\n'
+                           b'X-ProcImap-ImapInternalDate: '
+                           b'"03-Jan-2001 03:04:05 +0000"\n'
+                           + MESSAGE + b'Status: RO\n\nbody\n')
+        finally:
+            mboxfile.close()
+        restore = MailboxRestore(path, None)
+        key = list(restore.source.iterkeys())[0]
+        (message_id, message) = restore._message(key)
+        restore.source.close()
+        self.assertEqual(message.get_flagmask(), FLAGGED)
+        self.assertEqual(time.mktime(message.internaldate), DATE + 86400)
+        self.assertTrue(message.get_original().startswith(MESSAGE))
+
+
+if __name__ == '__main__':
+    unittest.main()